@@ -0,0 +1,5 @@
+"""
+Benchmarks for the transcription api. Run from the project root, e.g.:
+
+    python -m benchmarks.startup
+"""
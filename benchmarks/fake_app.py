@@ -0,0 +1,45 @@
+"""
+The app, but with in-memory firestore and storage (transcription/fakes.py) that take a set amount of time per call
+- for load testing the web server without touching Google (see benchmarks/pollers.py)
+- seeds FAKE_REQUESTS transcribing requests, request-0 through request-N, all for user "user-0"
+- env vars: FAKE_LATENCY_SECONDS (default 0.05), FAKE_REQUESTS (default 100), and ASYNC_VIEWS like the real app
+
+    gunicorn benchmarks.fake_app:application
+    gunicorn benchmarks.fake_app:asgi_application -k uvicorn.workers.UvicornWorker
+"""
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+import django
+django.setup()
+
+from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
+
+from benchmarks.pollers import request_payload
+from transcription.fakes import FakeFirestore, FakeBucket
+from transcription.helpers import clients, TRANSCRIPTION_STATUSES
+
+LATENCY_SECONDS = float(os.environ.get("FAKE_LATENCY_SECONDS", 0.05))
+REQUEST_COUNT = int(os.environ.get("FAKE_REQUESTS", 100))
+
+
+def seed(db):
+    db.write("users/user-0", {"email": "someone@example.com"})
+    for index in range(REQUEST_COUNT):
+        db.write(f"users/user-0/transcribeRequests/request-{index}", {
+            **request_payload(index),
+            "status": TRANSCRIPTION_STATUSES[3], # transcribing
+            "transaction_id": f"operation-{index}",
+            "updated_at": "20200425T212207Z",
+            "transcript_metadata": {"progress_percent": 42},
+        })
+
+
+db = FakeFirestore(latency_seconds=LATENCY_SECONDS)
+seed(db)
+clients.override("db", db)
+clients.override("bucket", FakeBucket(latency_seconds=LATENCY_SECONDS))
+
+application = get_wsgi_application()
+asgi_application = get_asgi_application()
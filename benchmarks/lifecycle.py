@@ -0,0 +1,292 @@
+"""
+Times a whole request, offline: transcribe -> check_status (until Google is done) -> handle_transcript_results, plus serializing transcripts of different sizes
+- db, bucket, speech_client and operations_api (what get_operation goes through) are the in-memory fakes from transcription/fakes.py, each call taking --latency seconds. So the numbers are round trips * latency, plus our own CPU
+- reports how many RPCs each step made. Those should only change when we mean them to, so a jump there (or in the times) is a regression
+- app info logs are off unless --verbose
+- serialization: cleanup_dictionary, and packing/compressing (transcript_storage.build_documents) then reading back every page, for synthetic transcripts of --sizes words
+
+    python -m benchmarks.lifecycle --runs 5 --latency 0.02 --sizes 1000,10000,100000
+    python -m benchmarks.lifecycle --json > before.json
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+import uuid
+from collections import Counter, defaultdict
+from unittest import mock
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+import django
+django.setup()
+
+from django.conf import settings
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from transcription import transcript_storage, views
+from transcription.fakes import FakeBucket, FakeFirestore, FakeSpeech
+from transcription.helpers import clients, TRANSCRIPTION_STATUSES
+from transcription.transcribe_class import TranscribeRequest
+from transcription.users import user_cache
+
+USER_ID = "user-0"
+# what check_status does once Google is done: turn the results into dicts, then write the transcript
+NESTED_STEPS = ["handle_transcript_results", "persist_transcript_data"]
+
+# so every step runs in the request like it would without the worker, and nothing happens in the background where we can't time it
+BENCHMARK_SETTINGS = {
+    "OPERATION_POLLER": {**settings.OPERATION_POLLER, "ENABLED": False},
+    "STORAGE_CLEANUP": {**settings.STORAGE_CLEANUP, "BACKGROUND": False},
+    "CHUNKING": {**settings.CHUNKING, "ENABLED": False},
+    "ADMISSION": {**settings.ADMISSION, "ENABLED": False},
+    "JOB_QUEUE": {**settings.JOB_QUEUE, "ENABLED": False},
+}
+
+
+#########################
+# synthetic transcripts
+#########################
+
+def make_utterances(word_count, words_per_utterance=25):
+    """
+    results shaped like what Google sends back, with word offsets and confidence
+    - Khmer-ish words from a vocabulary of 500, like a real sermon repeats itself
+    """
+    utterances = []
+    for first in range(0, word_count, words_per_utterance):
+        words = []
+        for index in range(first, min(first + words_per_utterance, word_count)):
+            words.append({
+                "word": f"ពាក្យ{index % 500}",
+                "startTime": f"{index // 2}.{(index % 2) * 5}00s",
+                "endTime": f"{(index + 1) // 2}.{((index + 1) % 2) * 5}00s",
+                "confidence": 0.9,
+            })
+
+        utterances.append({
+            "alternatives": [{
+                "transcript": " ".join(word["word"] for word in words),
+                "confidence": 0.9,
+                "words": words,
+            }],
+            "languageCode": "km-kh",
+        })
+
+    return utterances
+
+
+#########################
+# lifecycle
+#########################
+
+class Fakes:
+    def __init__(self, latency, words):
+        self.db = FakeFirestore(latency_seconds=latency)
+        self.bucket = FakeBucket(latency_seconds=latency)
+        results = make_utterances(words)
+        self.speech = FakeSpeech(results_fn=lambda name: results, latency_seconds=latency)
+
+        self.db.write(f"users/{USER_ID}", {"email": "someone@example.com"})
+        for name, fake in [("db", self.db), ("bucket", self.bucket), ("speech_client", self.speech), ("operations_api", self.speech)]:
+            clients.override(name, fake)
+
+    def rpc_counts(self):
+        counts = Counter()
+        for prefix, fake in [("firestore", self.db), ("storage", self.bucket), ("speech", self.speech)]:
+            for name, count in fake.rpc_counts.items():
+                counts[f"{prefix}.{name}"] += count
+
+        return counts
+
+    def close(self):
+        for name in ["db", "bucket", "speech_client", "operations_api"]:
+            clients.override(name, None)
+
+
+def flac_header(duration_seconds, sample_rate=16000, channels=1, bits_per_sample=16):
+    """
+    just enough of a FLAC file for audio_probe: "fLaC", then a STREAMINFO block (last metadata block)
+    """
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36) | (duration_seconds * sample_rate)
+    streaminfo = bytes(10) + packed.to_bytes(8, "big") + bytes(16)
+    return b"fLaC" + bytes([0x80, 0, 0, len(streaminfo)]) + streaminfo
+
+
+def new_request(fakes):
+    """
+    what the client does before calling transcribe: uploads the file and makes the request doc
+    - different bytes every time, so the transcript cache never has it
+    """
+    request_id = uuid.uuid4().hex
+    payload = {
+        "id": request_id,
+        "filename": f"sermon-{request_id}.flac",
+        "file_last_modified": 1588000000000,
+        "user_id": USER_ID,
+        "file_type": "audio/flac",
+        "file_size": 1048576,
+        "file_path": f"uploads/{request_id}.flac",
+    }
+    fakes.bucket.blobs[payload["file_path"]] = flac_header(duration_seconds=600) + uuid.uuid4().bytes * 1024
+    fakes.db.write(f"users/{USER_ID}/transcribeRequests/{request_id}", {**payload, "status": TRANSCRIPTION_STATUSES[1]})
+    return payload
+
+
+def post(view, payload):
+    request = RequestFactory().post("/", data=json.dumps(payload), content_type="application/json")
+    response = view(request)
+    if response.status_code != 200:
+        raise RuntimeError(f"{view.__name__} returned {response.status_code}")
+
+    return json.loads(response.content)
+
+
+def run_lifecycle(fakes):
+    """
+    returns {step: (seconds, rpc counts, number of calls)}
+    """
+    steps = {}
+    payload = new_request(fakes)
+    # users get cached per process, so the first request pays for it and the rest don't. Measure the first kind
+    user_cache.clear()
+
+    def measure(step, fn):
+        before = fakes.rpc_counts()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        # check_status gets called until it's done, so these are totals over every call
+        seconds, counts, calls = steps.get(step, (0, Counter(), 0))
+        steps[step] = (seconds + elapsed, counts + (fakes.rpc_counts() - before), calls + 1)
+        return result
+
+    def timed(name):
+        original = getattr(TranscribeRequest, name)
+        return lambda *args, **kwargs: measure(name, lambda: original(*args, **kwargs))
+
+    measure("transcribe", lambda: post(views.transcribe, payload))
+
+    # these run inside the last check_status, so that check's time and rpcs include theirs too
+    patches = [mock.patch.object(TranscribeRequest, name, autospec=True, side_effect=timed(name)) for name in NESTED_STEPS]
+    for patch in patches:
+        patch.start()
+
+    try:
+        status = None
+        checks = 0
+        while status != TRANSCRIPTION_STATUSES[5]:
+            data = measure("check_status", lambda: post(views.check_status, payload))
+            status = data["current_request_data"]["status"]
+            checks += 1
+            if checks > 100:
+                raise RuntimeError(f"never finished, status is {status}")
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    return steps
+
+
+def benchmark_lifecycle(runs, latency, words):
+    fakes = Fakes(latency, words)
+    times = defaultdict(list)
+    rpc_counts = {}
+    call_counts = {}
+    try:
+        with override_settings(**BENCHMARK_SETTINGS):
+            for _ in range(runs):
+                for step, (seconds, counts, calls) in run_lifecycle(fakes).items():
+                    times[step].append(seconds)
+                    # same every run, unless something's off
+                    rpc_counts[step] = dict(sorted(counts.items()))
+                    call_counts[step] = calls
+    finally:
+        fakes.close()
+
+    return {
+        step: {
+            "median_ms": statistics.median(values) * 1000,
+            "max_ms": max(values) * 1000,
+            "rpcs": rpc_counts[step],
+            "rpc_total": sum(rpc_counts[step].values()),
+            "calls": call_counts[step],
+        }
+        for step, values in times.items()
+    }
+
+
+#########################
+# serialization
+#########################
+
+def time_it(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+
+    return statistics.median(durations) * 1000, result
+
+
+def benchmark_serialization(word_count, repeat):
+    utterances = make_utterances(word_count)
+    transcript_data = {"id": "request-1", "filename": "sermon.flac", "user_id": USER_ID, "utterances": utterances, "transaction_id": None, "error": None}
+
+    cleanup_ms, _ = time_it(lambda: TranscribeRequest.cleanup_dictionary(transcript_data), repeat)
+    build_ms, (manifest, pages) = time_it(lambda: transcript_storage.build_documents({"id": "request-1"}, utterances), repeat)
+    read_ms, _ = time_it(lambda: [utterance for page in pages for utterance in transcript_storage.unpack_page(transcript_storage.decompress_page(page["blob"]))], repeat)
+
+    return {
+        "cleanup_dictionary_ms": cleanup_ms,
+        "build_documents_ms": build_ms,
+        "read_pages_ms": read_ms,
+        "pages": len(pages),
+        "stored_bytes": sum(len(page["blob"]) for page in pages),
+        "raw_json_bytes": len(json.dumps(utterances, ensure_ascii=False).encode("utf-8")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of lifecycles to time")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds each fake firestore/storage/speech call takes")
+    parser.add_argument("--words", type=int, default=1000, help="words in the lifecycle's transcript")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated transcript sizes (words) for serialization")
+    parser.add_argument("--repeat", type=int, default=5, help="times to repeat each serialization step")
+    parser.add_argument("--json", action="store_true", help="print results as json, e.g., to diff against an earlier run")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's info logs (they log every request doc, which adds up)")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    results = {
+        "settings": {"runs": args.runs, "latency": args.latency, "words": args.words},
+        "lifecycle": benchmark_lifecycle(args.runs, args.latency, args.words),
+        "serialization": {int(size): benchmark_serialization(int(size), args.repeat) for size in args.sizes.split(",")},
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"\nlifecycle ({args.runs} runs, {args.latency * 1000:.0f} ms per call, {args.words} words)")
+    for step, result in results["lifecycle"].items():
+        rpcs = ", ".join(f"{name} {count}" for name, count in result["rpcs"].items())
+        nested = "  (in check_status)" if step in NESTED_STEPS else ""
+        print(f"  {step:>26}: median {result['median_ms']:8.1f} ms   max {result['max_ms']:8.1f} ms   {result['rpc_total']:3} rpcs ({rpcs}) over {result['calls']} calls{nested}")
+
+    print("\nserialization")
+    for size, result in results["serialization"].items():
+        print(
+            f"  {size:>7} words: cleanup_dictionary {result['cleanup_dictionary_ms']:7.2f} ms   build_documents {result['build_documents_ms']:8.1f} ms   "
+            f"read pages {result['read_pages_ms']:8.1f} ms   {result['pages']:3} pages   {result['stored_bytes'] / 1024:7.1f} KiB stored ({result['raw_json_bytes'] / 1024:7.1f} KiB as json)"
+        )
+
+
+if __name__ == "__main__":
+    main()
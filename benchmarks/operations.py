@@ -0,0 +1,108 @@
+"""
+Compares the two ways we can fetch a long running operation from Google (what check_status does on every poll)
+- discovery: get_operation_via_discovery, the old path. Builds a new discovery client (parses the discovery doc, new http client) on every call
+- grpc: get_operation, which goes through the cached operations_api client and reuses one channel
+
+By default runs offline: the discovery path gets a mocked http response, and the grpc path talks to a fake operations server on localhost. So the numbers are mostly our own overhead, not Google's latency.
+Pass --operation with a real operation name (and have credentials set) to hit Google instead.
+
+    python -m benchmarks.operations --calls 50
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent import futures
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+import django
+django.setup()
+
+import grpc
+from google.api_core import operations_v1
+from google.cloud.speech_v1p1beta1.proto import cloud_speech_pb2
+from google.longrunning import operations_pb2, operations_pb2_grpc
+from googleapiclient import discovery
+from googleapiclient.http import HttpMockSequence
+from google.protobuf.json_format import MessageToDict
+
+from transcription import helpers
+
+FAKE_OPERATION_NAME = "1234567890"
+
+
+def fake_operation():
+    operation = operations_pb2.Operation(name=FAKE_OPERATION_NAME, done=False)
+    metadata = cloud_speech_pb2.LongRunningRecognizeMetadata(progress_percent=42)
+    metadata.start_time.GetCurrentTime()
+    metadata.last_update_time.GetCurrentTime()
+    operation.metadata.Pack(metadata)
+    return operation
+
+
+class FakeOperationsServicer(operations_pb2_grpc.OperationsServicer):
+    def GetOperation(self, request, context):
+        return fake_operation()
+
+
+def start_fake_server():
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    operations_pb2_grpc.add_OperationsServicer_to_server(FakeOperationsServicer(), server)
+    port = server.add_insecure_port("localhost:0")
+    server.start()
+    return server, port
+
+
+def offline_discovery_call(operation_name):
+    """
+    same as get_operation_via_discovery, but with a mocked http response instead of going out to Google
+    """
+    body = json.dumps(MessageToDict(fake_operation()))
+    http = HttpMockSequence([({"status": "200"}, body)])
+    speech_service = discovery.build('speech', 'v1p1beta1', http=http)
+    return speech_service.operations().get(name=operation_name).execute()
+
+
+def time_calls(fn, operation_name, calls):
+    durations = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn(operation_name)
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def report(label, durations):
+    durations = sorted(durations)
+    p95 = durations[int(len(durations) * 0.95) - 1]
+    print(f"{label:>10}: median {statistics.median(durations) * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms   total {sum(durations):6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--operation", help="real operation name to fetch from Google")
+    args = parser.parse_args()
+
+    if args.operation:
+        operation_name = args.operation
+        discovery_fn = helpers.get_operation_via_discovery
+
+    else:
+        operation_name = FAKE_OPERATION_NAME
+        discovery_fn = offline_discovery_call
+        server, port = start_fake_server()
+        channel = grpc.insecure_channel(f"localhost:{port}")
+        helpers.clients.override("operations_api", operations_v1.OperationsClient(channel))
+
+    # warm up, so grpc's first connection isn't counted against it
+    helpers.get_operation(operation_name)
+
+    report("discovery", time_calls(discovery_fn, operation_name, args.calls))
+    report("grpc", time_calls(helpers.get_operation, operation_name, args.calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Load test: how many clients polling check-status one dyno can keep up with, under each way of running the web server
+- starts the app (benchmarks/fake_app.py, so firestore is in memory but each call still takes FAKE_LATENCY_SECONDS) under gunicorn in each mode:
+    - wsgi: sync workers, what the Procfile runs by default
+    - wsgi-threads: gthread workers, several requests per worker in threads
+    - asgi: uvicorn workers with the async views (ASYNC_VIEWS=true)
+- then for more and more pollers, each one calls check-status, waits --interval seconds, and does it again
+- a mode "handles" that many pollers if none of their requests errored and p95 latency stayed under --slo seconds
+
+    python -m benchmarks.pollers --workers 2 --pollers 10,50,100,200,400
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    "wsgi": ["benchmarks.fake_app:application"],
+    "wsgi-threads": ["benchmarks.fake_app:application", "-k", "gthread", "--threads", "8"],
+    "asgi": ["benchmarks.fake_app:asgi_application", "-k", "uvicorn.workers.UvicornWorker"],
+}
+
+
+def request_payload(index):
+    """
+    what a client sends to check on one of the requests fake_app seeds
+    """
+    return {
+        "id": f"request-{index}",
+        "filename": f"sermon-{index}.flac",
+        "file_last_modified": 1588000000000,
+        "user_id": "user-0",
+        "file_type": "audio/flac",
+        "file_size": 1048576,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, workers, latency, request_count):
+    env = {
+        **os.environ,
+        "ASYNC_VIEWS": "true" if mode == "asgi" else "false",
+        "FAKE_LATENCY_SECONDS": str(latency),
+        "FAKE_REQUESTS": str(request_count),
+        "SECRET_KEY": os.environ.get("SECRET_KEY", "benchmark"),
+    }
+    args = [
+        sys.executable, "-m", "gunicorn", *MODES[mode],
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers),
+        "--log-level", "warning",
+        # the app logs every request at info, which would be most of what we measure
+        "--error-logfile", os.devnull,
+    ]
+    server = subprocess.Popen(args, cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # wait for it to come up
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            post(port, "/wake-up/", {})
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.kill()
+    raise RuntimeError(f"server for {mode} didn't start")
+
+
+def post(port, path, payload, timeout=30):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        connection.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run_pollers(port, pollers, seconds, interval, request_count):
+    """
+    returns (list of latencies, number of errors)
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def poll(index):
+        payload = request_payload(index % request_count)
+        # spread out the first requests, like real clients would be
+        time.sleep(random.random() * interval)
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                ok = post(port, "/check-status/", payload) == 200
+            except OSError:
+                ok = False
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+            time.sleep(max(interval - elapsed, 0))
+
+    threads = [threading.Thread(target=poll, args=(i,), daemon=True) for i in range(pollers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors[0]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated, from: " + ", ".join(MODES))
+    parser.add_argument("--pollers", default="10,50,100,200", help="comma separated numbers of pollers to try")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers, e.g., what fits on one dyno")
+    parser.add_argument("--seconds", type=float, default=15, help="how long to run each number of pollers")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between a poller's requests")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds each firestore call takes")
+    parser.add_argument("--slo", type=float, default=1, help="p95 latency (seconds) that still counts as keeping up")
+    args = parser.parse_args()
+
+    poller_counts = [int(count) for count in args.pollers.split(",")]
+    request_count = max(poller_counts)
+    summary = {}
+
+    for mode in args.modes.split(","):
+        port = free_port()
+        server = start_server(mode, port, args.workers, args.latency, request_count)
+        print(f"\n{mode} ({args.workers} workers)")
+        try:
+            for pollers in poller_counts:
+                latencies, errors = run_pollers(port, pollers, args.seconds, args.interval, request_count)
+                p95 = percentile(latencies, 0.95)
+                print(f"  {pollers:>5} pollers: {len(latencies) / args.seconds:7.1f} req/s   median {statistics.median(latencies) * 1000:7.1f} ms   p95 {p95 * 1000:7.1f} ms   errors {errors}")
+                if errors == 0 and p95 <= args.slo:
+                    summary[mode] = pollers
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"\nmost pollers handled with p95 under {args.slo}s and no errors:")
+    for mode in args.modes.split(","):
+        print(f"  {mode:>12}: {summary.get(mode, 'none of the tried counts')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures how long it takes to boot the Django app (what every gunicorn worker, dyno cold start and manage.py command pays)
+- each run is a fresh python process, so nothing is cached between runs
+- also reports which Google clients were built during boot. Should be none, since the ClientRegistry builds them on first use
+- pass --with-clients to also time building every client up front (the old import-time behavior). Needs real credentials
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT_NAMES = ["firebase_app", "db", "speech_client", "operations_api", "bucket"]
+
+# runs inside the child process
+BOOT_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+import django
+django.setup()
+import config.urls
+booted = time.perf_counter()
+
+from transcription.helpers import clients
+names = {names}
+initialized = [name for name in names if clients.is_initialized(name)]
+
+client_seconds = {{}}
+if {with_clients}:
+    for name in names:
+        client_start = time.perf_counter()
+        clients.get(name)
+        client_seconds[name] = time.perf_counter() - client_start
+
+print(json.dumps({{
+    "boot_seconds": booted - start,
+    "initialized_at_boot": initialized,
+    "client_seconds": client_seconds,
+}}))
+"""
+
+
+def run_once(with_clients):
+    script = BOOT_SCRIPT.format(names=repr(CLIENT_NAMES), with_clients=with_clients)
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    # django or the google libs might print other stuff first, so just take the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--with-clients", action="store_true", help="also build every client after booting")
+    args = parser.parse_args()
+
+    results = [run_once(args.with_clients) for _ in range(args.runs)]
+    boot_times = [result["boot_seconds"] for result in results]
+
+    print(f"runs: {args.runs}")
+    print(f"boot (median): {statistics.median(boot_times) * 1000:.1f} ms")
+    print(f"boot (min/max): {min(boot_times) * 1000:.1f} / {max(boot_times) * 1000:.1f} ms")
+    print(f"clients initialized at boot: {results[0]['initialized_at_boot'] or 'none'}")
+
+    if args.with_clients:
+        for name in CLIENT_NAMES:
+            seconds = statistics.median(result["client_seconds"][name] for result in results)
+            print(f"  building {name}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
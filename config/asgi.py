@@ -0,0 +1,19 @@
+"""
+ASGI config for Khmer speech to text API project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Run with uvicorn workers (and ASYNC_VIEWS=true, so the transcription endpoints are async), e.g.:
+
+    gunicorn config.asgi -k uvicorn.workers.UvicornWorker
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+from django.core.asgi import get_asgi_application
+
+application = get_asgi_application()
@@ -0,0 +1,31 @@
+"""
+gunicorn settings for the web dyno (see Procfile)
+- with JOB_QUEUE_ENABLED=true, also starts the job worker (manage.py run_jobs) next to gunicorn. The queue is a sqlite file, so the worker has to be on this dyno's filesystem. A worker dyno has its own disk and would never see the jobs
+- poller and sweepers stay on the worker dyno (run_jobs --no-jobs), they only need firestore
+- if the job worker dies, the web process notices its heartbeat stopped and goes back to transcribing in the request (see transcription/jobs.py should_enqueue)
+"""
+import os
+import subprocess
+import sys
+
+job_worker = None
+
+
+def when_ready(server):
+    global job_worker
+    if os.environ.get("JOB_QUEUE_ENABLED", "false").lower() != "true":
+        return
+
+    job_worker = subprocess.Popen([sys.executable, "manage.py", "run_jobs", "--no-poller", "--no-sweeper", "--no-stuck-sweeper"])
+    server.log.info(f"started job worker (pid {job_worker.pid})")
+
+
+def on_exit(server):
+    if job_worker is None:
+        return
+
+    job_worker.terminate()
+    try:
+        job_worker.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        job_worker.kill()
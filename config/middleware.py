@@ -0,0 +1,44 @@
+"""
+Middleware that has to be both sync and async, so the async views (transcription/async_views.py) stay async under ASGI
+"""
+import asyncio
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware as BaseWhiteNoiseMiddleware
+
+
+class WhiteNoiseMiddleware(BaseWhiteNoiseMiddleware):
+    """
+    django_heroku adds whitenoise to serve static files, but whitenoise's middleware is sync only
+    - under ASGI, django runs everything after a sync only middleware (including our async views) in one shared thread, so requests end up handled one at a time
+    - this version passes requests that aren't for static files straight on to the next middleware when async
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=None):
+        if settings is None:
+            super().__init__(get_response)
+        else:
+            super().__init__(get_response, settings)
+
+        self._is_async = asyncio.iscoroutinefunction(get_response)
+        if self._is_async:
+            # so django knows to await us
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self._is_async:
+            return self.__acall__(request)
+
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+
+        return await self.get_response(request)
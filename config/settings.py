@@ -72,6 +72,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "config.wsgi.application"
+ASGI_APPLICATION = "config.asgi.application"
+
+# use the async views (transcription/async_views.py). Turn on when running config.asgi (e.g., with uvicorn workers)
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS", "false").lower() == "true"
 
 
 # Database
@@ -151,6 +155,198 @@ LOGGING = {
     }
 }
 
+# background worker that asks Google how transcriptions are going (see transcription/poller.py)
+# if not enabled, check-status asks Google itself every time a client polls
+OPERATION_POLLER = {
+    "ENABLED": os.environ.get("OPERATION_POLLER_ENABLED", "true").lower() == "true",
+    # how often to check an operation. Backs off towards the max while progress isn't moving
+    "MIN_INTERVAL_SECONDS": float(os.environ.get("OPERATION_POLLER_MIN_INTERVAL_SECONDS", 5)),
+    "MAX_INTERVAL_SECONDS": float(os.environ.get("OPERATION_POLLER_MAX_INTERVAL_SECONDS", 60)),
+    # max number of operations to check at the same time
+    "MAX_WORKERS": int(os.environ.get("OPERATION_POLLER_MAX_WORKERS", 8)),
+    # how long to sleep between checking whichever operations are due
+    "TICK_SECONDS": float(os.environ.get("OPERATION_POLLER_TICK_SECONDS", 2)),
+    # how often to ask firestore which requests are transcribing. Each time is a read per transcribing request, so not every tick
+    "REFRESH_SECONDS": float(os.environ.get("OPERATION_POLLER_REFRESH_SECONDS", 30)),
+    # check-status/ asks Google itself if the poller hasn't checked on the operation in this long (e.g., no worker running)
+    "STALE_AFTER_SECONDS": float(os.environ.get("OPERATION_POLLER_STALE_AFTER_SECONDS", 180)),
+}
+
+# per process cache of users' email and custom quotas (see transcription/users.py)
+USER_CACHE = {
+    "MAX_SIZE": int(os.environ.get("USER_CACHE_MAX_SIZE", 1000)),
+    "TTL_SECONDS": float(os.environ.get("USER_CACHE_TTL_SECONDS", 300)),
+    # listen to firestore for changes to the user's docs, so changes show up before the entry expires
+    "WATCH": os.environ.get("USER_CACHE_WATCH", "false").lower() == "true",
+}
+
+# requests that are done (or errored), so reading their status again doesn't need firestore (see transcription/request_cache.py)
+REQUEST_CACHE = {
+    "ENABLED": os.environ.get("REQUEST_CACHE_ENABLED", "true").lower() == "true",
+    "MAX_SIZE": int(os.environ.get("REQUEST_CACHE_MAX_SIZE", 5000)),
+    # how long the shared cache keeps them. transcription-processed doesn't change unless it's sent again, and that drops it from the shared cache
+    "TTL_SECONDS": float(os.environ.get("REQUEST_CACHE_TTL_SECONDS", 60 * 60)),
+    # how long each process keeps its own copy. Another process that resumes or resends the request can't tell ours to drop it, so this is how long we might keep saying "done" or "error" after that
+    "LOCAL_TTL_SECONDS": float(os.environ.get("REQUEST_CACHE_LOCAL_TTL_SECONDS", 30)),
+    # also keep them in django's cache (e.g., redis or memcached, set in CACHES), so every process can use them
+    "SHARED": os.environ.get("REQUEST_CACHE_SHARED", "false").lower() == "true",
+    "CACHE_ALIAS": os.environ.get("REQUEST_CACHE_ALIAS", "default"),
+}
+
+# concurrent check_transcription_progress calls for the same operation share one call to Google (see transcription/coalescing.py)
+COALESCING = {
+    "ENABLED": os.environ.get("COALESCING_ENABLED", "true").lower() == "true",
+    # also take a lease doc in firestore, so other processes (other gunicorn workers, other dynos) don't ask Google at the same time either
+    # costs a write (and a delete) per check, so only worth it if lots of clients poll the same request
+    "LEASE": os.environ.get("COALESCING_LEASE", "false").lower() == "true",
+    # longest anyone holds a lease, e.g., if the process holding it dies. Should be more than a whole check (including writing the transcript) takes
+    "LEASE_SECONDS": int(os.environ.get("COALESCING_LEASE_SECONDS", 30)),
+}
+
+# about how many words go in each page of a stored transcript (see transcription/transcript_storage.py)
+TRANSCRIPT_PAGE_WORDS = int(os.environ.get("TRANSCRIPT_PAGE_WORDS", 5000))
+# also keep utterances on the transcript doc itself if they're under this (as json), since the frontend reads them from there. Has to leave room for the rest of the doc under firestore's 1 MiB. 0 to only write pages
+TRANSCRIPT_INLINE_UTTERANCES_MAX_BYTES = int(os.environ.get("TRANSCRIPT_INLINE_UTTERANCES_MAX_BYTES", 700 * 1024))
+
+# converting uploads to mono flac before sending to Google (see transcription/transcoding.py)
+# needs ffmpeg installed (on heroku, add an ffmpeg buildpack). If it isn't, files get sent as they are
+TRANSCODING = {
+    "ENABLED": os.environ.get("TRANSCODING_ENABLED", "true").lower() == "true",
+    "FFMPEG": os.environ.get("FFMPEG_PATH", "ffmpeg"),
+    # max number of ffmpeg processes running at the same time
+    "MAX_PROCESSES": int(os.environ.get("TRANSCODING_MAX_PROCESSES", 2)),
+    "TIMEOUT_SECONDS": float(os.environ.get("TRANSCODING_TIMEOUT_SECONDS", 240)),
+    # same, but when converting in a web request. 0 means web requests don't convert at all, and send the original (the worker still converts, with the job queue on)
+    # NOTE if setting this, keep it well under gunicorn's timeout (30s by default), since the rest of the request still has to happen after
+    "WEB_TIMEOUT_SECONDS": float(os.environ.get("TRANSCODING_WEB_TIMEOUT_SECONDS", 0)),
+}
+
+# reusing transcripts when the same audio gets uploaded again (see transcription/transcript_cache.py)
+TRANSCRIPT_CACHE = {
+    "ENABLED": os.environ.get("TRANSCRIPT_CACHE_ENABLED", "true").lower() == "true",
+}
+
+# retrying long running requests when Google errors (see transcription/retry_policy.py)
+RETRY = {
+    # per request, including the first try
+    "MAX_ATTEMPTS": int(os.environ.get("RETRY_MAX_ATTEMPTS", 5)),
+    # max total time one request spends waiting between tries, in the worker (job queue, stuck request sweeper)
+    "BUDGET_SECONDS": float(os.environ.get("RETRY_BUDGET_SECONDS", 20)),
+    # same, but when sending from a web request. Keep it short, since it holds up a web worker (and gunicorn's default timeout is 30s)
+    "WEB_BUDGET_SECONDS": float(os.environ.get("RETRY_WEB_BUDGET_SECONDS", 5)),
+    "BASE_DELAY_SECONDS": float(os.environ.get("RETRY_BASE_DELAY_SECONDS", 1)),
+    "MAX_DELAY_SECONDS": float(os.environ.get("RETRY_MAX_DELAY_SECONDS", 10)),
+}
+
+# splitting long audio at silences and sending the chunks to Google at the same time (see transcription/chunking.py)
+# only for requests that ask for it ("chunked": true)
+CHUNKING = {
+    "ENABLED": os.environ.get("CHUNKING_ENABLED", "true").lower() == "true",
+    # files shorter than this just go as one operation
+    "MIN_DURATION_SECONDS": float(os.environ.get("CHUNKING_MIN_DURATION_SECONDS", 20 * 60)),
+    "TARGET_CHUNK_SECONDS": float(os.environ.get("CHUNKING_TARGET_CHUNK_SECONDS", 10 * 60)),
+    "MAX_CHUNK_SECONDS": float(os.environ.get("CHUNKING_MAX_CHUNK_SECONDS", 15 * 60)),
+    # max number of chunks with Google at the same time, per request
+    "MAX_CONCURRENT_OPERATIONS": int(os.environ.get("CHUNKING_MAX_CONCURRENT_OPERATIONS", 4)),
+    # times a chunk gets sent to Google before an error from it errors the whole request
+    "MAX_CHUNK_ATTEMPTS": int(os.environ.get("CHUNKING_MAX_CHUNK_ATTEMPTS", 3)),
+    # anything quieter than this for at least MIN_SILENCE_SECONDS counts as silence
+    "SILENCE_DB": int(os.environ.get("CHUNKING_SILENCE_DB", -35)),
+    "MIN_SILENCE_SECONDS": float(os.environ.get("CHUNKING_MIN_SILENCE_SECONDS", 0.4)),
+}
+
+# making requests to Google wait their turn instead of going over quota (see transcription/admission.py)
+# NOTE requests per minute and MAX_CONCURRENT are per process, so split the project's quota between web and worker processes. MAX_OPERATIONS isn't
+ADMISSION = {
+    "ENABLED": os.environ.get("ADMISSION_ENABLED", "true").lower() == "true",
+    "REQUESTS_PER_MINUTE": float(os.environ.get("ADMISSION_REQUESTS_PER_MINUTE", 60)),
+    # how many can go right away, before it's limited to REQUESTS_PER_MINUTE
+    "BURST": int(os.environ.get("ADMISSION_BURST", 10)),
+    # max number of long_running_recognize calls in flight at the same time
+    "MAX_CONCURRENT": int(os.environ.get("ADMISSION_MAX_CONCURRENT", 8)),
+    # max number of operations Google is working on at the same time (transcribing requests and chunks). For every process together, counted from firestore
+    "MAX_OPERATIONS": int(os.environ.get("ADMISSION_MAX_OPERATIONS", 20)),
+    # how often to count them again
+    "OPERATIONS_REFRESH_SECONDS": float(os.environ.get("ADMISSION_OPERATIONS_REFRESH_SECONDS", 5)),
+    # how long a request waits for its turn before giving up
+    "MAX_WAIT_SECONDS": float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", 60)),
+    # same, but from a web request, where someone's waiting on the response. After that they get a 503 and try again
+    "WEB_MAX_WAIT_SECONDS": float(os.environ.get("ADMISSION_WEB_MAX_WAIT_SECONDS", 5)),
+}
+
+# running the transcribe steps in the worker instead of the web request (see transcription/job_queue.py and jobs.py)
+# NOTE the queue is a sqlite file, so web and worker need the same filesystem (locally, or both on one dyno: on Heroku config/gunicorn.py starts the worker inside the web dyno)
+JOB_QUEUE = {
+    # if off, request-transcribe/ does everything itself like before. run_jobs still works either way
+    "ENABLED": os.environ.get("JOB_QUEUE_ENABLED", "false").lower() == "true",
+    "PATH": os.environ.get("JOB_QUEUE_PATH", os.path.join(BASE_DIR, "jobs.sqlite3")),
+    # max number of jobs running at the same time, per worker process
+    "WORKER_THREADS": int(os.environ.get("JOB_QUEUE_WORKER_THREADS", 4)),
+    "WORKER_PROCESSES": int(os.environ.get("JOB_QUEUE_WORKER_PROCESSES", 1)),
+    # a claimed job goes back in the queue if the worker doesn't finish it (or say it's still working on it) by then
+    "VISIBILITY_TIMEOUT_SECONDS": float(os.environ.get("JOB_QUEUE_VISIBILITY_TIMEOUT_SECONDS", 5 * 60)),
+    "MAX_ATTEMPTS": int(os.environ.get("JOB_QUEUE_MAX_ATTEMPTS", 5)),
+    # how long the worker waits before checking for new jobs
+    "POLL_SECONDS": float(os.environ.get("JOB_QUEUE_POLL_SECONDS", 0.5)),
+    # how often the worker says it's still there. If no worker has for 3x this, the web process stops enqueueing and transcribes in the request
+    "HEARTBEAT_SECONDS": float(os.environ.get("JOB_QUEUE_HEARTBEAT_SECONDS", 10)),
+}
+
+# deleting uploads from storage once they're transcribed (see transcription/storage_cleanup.py)
+STORAGE_CLEANUP = {
+    # delete in a background pool. If off, deletes right after the transcript is saved, like before (still without the exists check)
+    "BACKGROUND": os.environ.get("STORAGE_CLEANUP_BACKGROUND", "true").lower() == "true",
+    "MAX_WORKERS": int(os.environ.get("STORAGE_CLEANUP_MAX_WORKERS", 8)),
+    # the sweeper leaves new ledger entries alone for this long, since they're probably being deleted right now
+    "GRACE_SECONDS": float(os.environ.get("STORAGE_CLEANUP_GRACE_SECONDS", 10 * 60)),
+    # backoff between tries of a failed delete
+    "RETRY_BASE_SECONDS": float(os.environ.get("STORAGE_CLEANUP_RETRY_BASE_SECONDS", 60)),
+    "RETRY_MAX_SECONDS": float(os.environ.get("STORAGE_CLEANUP_RETRY_MAX_SECONDS", 6 * 60 * 60)),
+    "MAX_ATTEMPTS": int(os.environ.get("STORAGE_CLEANUP_MAX_ATTEMPTS", 10)),
+    # how often the worker's sweeper looks at the ledger, and how many entries it takes at once
+    "SWEEP_INTERVAL_SECONDS": float(os.environ.get("STORAGE_CLEANUP_SWEEP_INTERVAL_SECONDS", 5 * 60)),
+    "SWEEP_BATCH_SIZE": int(os.environ.get("STORAGE_CLEANUP_SWEEP_BATCH_SIZE", 100)),
+}
+
+# getting requests going again (or giving up on them) when nothing has happened for too long, e.g., the browser went away (see transcription/stuck_requests.py)
+STUCK_REQUESTS = {
+    # runs in the worker (run_jobs). Can also run it on its own: python manage.py sweep_stuck_requests
+    "ENABLED": os.environ.get("STUCK_REQUESTS_ENABLED", "true").lower() == "true",
+    "SWEEP_INTERVAL_SECONDS": float(os.environ.get("STUCK_REQUESTS_SWEEP_INTERVAL_SECONDS", 60)),
+    # max number of requests to look at per status, per sweep
+    "SWEEP_BATCH_SIZE": int(os.environ.get("STUCK_REQUESTS_SWEEP_BATCH_SIZE", 50)),
+    # once the sweeper has resumed a request this many times and it gets stuck again, it gets marked as errored instead
+    "MAX_RESUMES": int(os.environ.get("STUCK_REQUESTS_MAX_RESUMES", 1)),
+    # max number of requests being resumed at the same time
+    "MAX_WORKERS": int(os.environ.get("STUCK_REQUESTS_MAX_WORKERS", 4)),
+}
+
+# sending a bunch of files in one request (see transcription/batch_submission.py)
+BATCH_SUBMISSION = {
+    "MAX_ITEMS": int(os.environ.get("BATCH_SUBMISSION_MAX_ITEMS", 100)),
+    # max number of files being read/converted/sent to Google at the same time, per batch
+    "MAX_CONCURRENT": int(os.environ.get("BATCH_SUBMISSION_MAX_CONCURRENT", 4)),
+}
+
+# server-sent events for request progress (see transcription/progress_stream.py)
+PROGRESS_STREAM = {
+    # how often a request's watcher reads it
+    "POLL_SECONDS": float(os.environ.get("PROGRESS_STREAM_POLL_SECONDS", 2)),
+    # send a comment if nothing else was sent for this long, so the connection doesn't get dropped as idle
+    "HEARTBEAT_SECONDS": float(os.environ.get("PROGRESS_STREAM_HEARTBEAT_SECONDS", 15)),
+    # number of events kept per request, for clients reconnecting with Last-Event-ID
+    "HISTORY_SIZE": int(os.environ.get("PROGRESS_STREAM_HISTORY_SIZE", 20)),
+    # close the stream after this long. The client reconnects on its own
+    "MAX_STREAM_SECONDS": float(os.environ.get("PROGRESS_STREAM_MAX_STREAM_SECONDS", 10 * 60)),
+    # how long the client waits before reconnecting
+    "RECONNECT_MS": int(os.environ.get("PROGRESS_STREAM_RECONNECT_MS", 3000)),
+}
+
+# so the frontend can send back the ETag check-status gave it, and read it in the first place
+from corsheaders.defaults import default_headers
+CORS_ALLOW_HEADERS = list(default_headers) + ["if-none-match"]
+CORS_EXPOSE_HEADERS = ["ETag"]
+
 if os.environ.get('DJANGO_ENV') != "PRODUCTION":
     DEBUG = True
     ENV = "DEVELOPMENT"
@@ -186,3 +382,9 @@ else:
             ]
 
 django_heroku.settings(locals())
+
+# whitenoise's own middleware is sync only, which would make django run the async views one at a time under ASGI (see config/middleware.py)
+MIDDLEWARE = [
+    "config.middleware.WhiteNoiseMiddleware" if middleware == "whitenoise.middleware.WhiteNoiseMiddleware" else middleware
+    for middleware in MIDDLEWARE
+]
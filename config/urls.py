@@ -3,11 +3,16 @@ from django.http import HttpResponseServerError
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import path, include
 
+from django.conf import settings
 from django.contrib import admin
 
 admin.autodiscover()
 
 import transcription.views
+import transcription.async_views
+
+# async versions when running under ASGI (config/asgi.py), so one worker can handle many requests that are waiting on Google/firestore
+views = transcription.async_views if settings.ASYNC_VIEWS else transcription.views
 
 # To add a new path, first import the app:
 # import blog
@@ -18,9 +23,15 @@ import transcription.views
 # Learn more here: https://docs.djangoproject.com/en/2.1/topics/http/urls/
 
 urlpatterns = [
-    path("request-transcribe/", transcription.views.transcribe, name="transcribe"),
-    path("resume-request/", transcription.views.resume_request, name="resume-request"),
-    path("check-status/", transcription.views.check_status, name="check-status"),
+    path("request-transcribe/", views.transcribe, name="transcribe"),
+    path("request-transcribe-batch/", views.transcribe_batch, name="transcribe-batch"),
+    path("resume-request/", views.resume_request, name="resume-request"),
+    path("check-status/", views.check_status, name="check-status"),
+    path("progress/", views.progress, name="progress"),
+    path("transcript/", views.transcript, name="transcript"),
+    # reads are quick, so same view whether async or not
+    path("admission-stats/", transcription.views.admission_stats, name="admission-stats"),
+    path("metrics/", transcription.views.prometheus_metrics, name="metrics"),
     # something to add for when using heroku hobby dynos
     path("wake-up/", csrf_exempt(lambda request: HttpResponse('transcription World! Waking up')), name="wake-up"),
     path("admin/", admin.site.urls),
@@ -0,0 +1,246 @@
+"""
+Keeping us under Google's Speech API quotas, by making requests wait their turn instead of sending them all at once
+- every long_running_recognize goes through admit() first (the request's own, and each chunk's, see chunking.py)
+- three limits:
+    - requests per minute: token bucket. Holds up to ADMISSION["BURST"] tokens, and refills at REQUESTS_PER_MINUTE / 60 per second. Each request takes one. Per process (so if running several workers/dynos, divide the quota between them)
+    - requests at the same time: at most ADMISSION["MAX_CONCURRENT"] long_running_recognize calls in flight. Also per process. The call itself only takes a moment, so this is mostly for bursts
+    - operations at the same time: at most ADMISSION["MAX_OPERATIONS"] operations that Google is still working on, across every process. Counted from firestore (transcribing requests, plus transcribing chunks of chunked ones, see OperationCount), so a slot frees up once an operation finishes or errors and whoever checks on it writes that down
+- over either limit => waits until there's room, for up to ADMISSION["MAX_WAIT_SECONDS"] (or WEB_MAX_WAIT_SECONDS from a web request, see TranscribeRequest.admission_wait). Only then do we give up (AdmissionTimeout), and that doesn't count as Google's error, so the request isn't marked transcribing-error (see request_long_running_recognize). From the job queue, it just gets retried later. From a web request, the client gets a 503 and tries again (see views._log_error)
+- stats() has how many are waiting and how long they waited, for sizing quotas against real load
+"""
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from .helpers import clients, db, TRANSCRIPTION_STATUSES
+from . import metrics
+import logging
+logger = logging.getLogger('testlogger')
+
+
+class AdmissionTimeout(Exception):
+    """
+    waited ADMISSION["MAX_WAIT_SECONDS"] and there still wasn't room
+    """
+
+
+class TokenBucket:
+    """
+    NOTE not thread safe on its own, AdmissionController holds its lock while using it
+    """
+
+    def __init__(self, rate_per_second, capacity, now):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def take(self, now):
+        """
+        takes a token if there is one and returns 0. Otherwise returns how many seconds until there will be one
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate_per_second
+
+
+def count_operations_at_google():
+    """
+    how many operations Google is working on for us right now, according to firestore
+    - count queries, so about one read per 1000 matches instead of one per doc
+    - NOTE needs the single field index on status enabled for collection group scope, for both transcribeRequests and chunks (the poller needs the first one too)
+    """
+    transcribing = TRANSCRIPTION_STATUSES[3]
+    requests_query = db.collection_group("transcribeRequests").where("status", "==", transcribing)
+    # from chunking.CHUNKS_COLLECTION and CHUNK_STATUSES[1] (chunking imports us, so can't import it)
+    chunks_query = db.collection_group("chunks").where("status", "==", "transcribing")
+
+    with metrics.external_call("firestore", "count"):
+        requests = _count(requests_query)
+        # a chunked request's operations are its chunks, so it doesn't count on its own
+        chunked_requests = _count(requests_query.where("chunked", "==", True))
+        chunks = _count(chunks_query)
+
+    return requests - chunked_requests + chunks
+
+
+def _count(query):
+    return query.count().get()[0][0].value
+
+
+class OperationCount:
+    """
+    the number of operations at Google, from count_fn (firestore), read again at most every refresh_seconds
+    - plus however many we started in this process since then, so a burst doesn't all see the same old count
+    - NOTE other processes' operations only show up when we read again, so all together we can go a little over for up to refresh_seconds
+    """
+
+    def __init__(self, count_fn, refresh_seconds, clock):
+        self.count_fn = count_fn
+        self.refresh_seconds = refresh_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._count = 0
+        self._started_since = 0
+        self._read_at = None
+
+    def current(self):
+        with self._lock:
+            if self._read_at is not None and self.clock() - self._read_at < self.refresh_seconds:
+                return self._count + self._started_since
+
+            try:
+                self._count = self.count_fn()
+                self._started_since = 0
+            except Exception as error:
+                # keep going with what we had, it only makes the count a little off
+                logger.error("couldn't count operations at Google")
+                logger.error(error)
+
+            self._read_at = self.clock()
+            return self._count + self._started_since
+
+    def started(self):
+        with self._lock:
+            self._started_since += 1
+
+
+class AdmissionController:
+    def __init__(self, requests_per_minute=None, burst=None, max_concurrent=None, max_wait_seconds=None, max_operations=None, count_operations=None, clock=time.monotonic):
+        config = settings.ADMISSION
+        self.enabled = config["ENABLED"]
+        self.max_concurrent = max_concurrent or config["MAX_CONCURRENT"]
+        self.max_operations = max_operations or config["MAX_OPERATIONS"]
+        self.operations = OperationCount(count_operations or count_operations_at_google, config["OPERATIONS_REFRESH_SECONDS"], clock)
+        self.max_wait_seconds = config["MAX_WAIT_SECONDS"] if max_wait_seconds is None else max_wait_seconds
+        self.clock = clock
+        self.bucket = TokenBucket(
+            (requests_per_minute or config["REQUESTS_PER_MINUTE"]) / 60,
+            burst or config["BURST"],
+            clock(),
+        )
+
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        # how many are waiting right now
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.admitted = 0
+        # admitted, but had to wait first
+        self.delayed = 0
+        self.timed_out = 0
+        # had to wait because of MAX_OPERATIONS
+        self.waited_for_operations = 0
+        self.wait_seconds_total = 0
+        self.wait_seconds_max = 0
+
+    @contextmanager
+    def admit(self, max_wait_seconds=None):
+        """
+        with admission.admit():
+            speech_client.long_running_recognize(...)
+        - max_wait_seconds: if this one won't wait as long as the controller's max_wait_seconds (e.g., from a web request)
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self._wait_for_room(self.max_wait_seconds if max_wait_seconds is None else min(max_wait_seconds, self.max_wait_seconds))
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                # someone waiting on the concurrency limit can go now
+                self._condition.notify()
+
+    def _wait_for_room(self, max_wait_seconds):
+        started_at = self.clock()
+        deadline = started_at + max_wait_seconds
+        had_to_wait = False
+        operations_were_full = False
+
+        with self._condition:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        try:
+            while True:
+                # not holding the lock for this, since it might have to ask firestore
+                operations_full = self.operations.current() >= self.max_operations
+
+                with self._condition:
+                    now = self.clock()
+                    if operations_full:
+                        # only changes when we count again
+                        operations_were_full = True
+                        wait = self.operations.refresh_seconds
+                    else:
+                        # only take a token once we know we can go, so tokens aren't used up by requests that are still waiting
+                        wait = self.bucket.take(now) if self.in_flight < self.max_concurrent else None
+                        if wait == 0:
+                            self.in_flight += 1
+                            break
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise AdmissionTimeout(f"Too many requests to Google right now, waited {max_wait_seconds}s")
+
+                    # None => wait until something finishes (notify), or until we run out of time
+                    had_to_wait = True
+                    self._condition.wait(remaining if wait is None else min(wait, remaining))
+
+        finally:
+            with self._condition:
+                self.queue_depth -= 1
+
+        self.operations.started()
+        waited = self.clock() - started_at
+        with self._condition:
+            self.admitted += 1
+            if had_to_wait:
+                self.delayed += 1
+            if operations_were_full:
+                self.waited_for_operations += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+        if waited > 1:
+            logger.info(f"waited {waited:.1f}s to send to Google")
+
+    def stats(self):
+        # not holding the lock for this, since it might have to ask firestore
+        operations_at_google = self.operations.current()
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self.admitted,
+                "delayed": self.delayed,
+                "timed_out": self.timed_out,
+                "waited_for_operations": self.waited_for_operations,
+                "operations_at_google": operations_at_google,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+            }
+
+
+clients.register("admission", AdmissionController)
+
+
+def admit(max_wait_seconds=None):
+    return clients.get("admission").admit(max_wait_seconds)
+
+
+def stats():
+    return clients.get("admission").stats()
+
+
+metrics.register_stats("admission", stats)
@@ -0,0 +1,194 @@
+"""
+Async versions of the views in views.py, for running under ASGI (config/asgi.py)
+- same endpoints, same responses. urls.py uses these when settings.ASYNC_VIEWS is on
+- firestore, storage and Google clients are all blocking, so every call to them runs in a thread (see _in_thread). While it waits, the event loop is free to handle other requests, instead of the whole worker being stuck like with gunicorn's sync workers
+- reads that don't depend on each other run at the same time (asyncio.gather)
+"""
+import asyncio
+import json
+import traceback
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
+from .transcribe_class import TranscribeRequest
+from .users import get_user_profile
+from .views import ALREADY_DONE_MESSAGE, _batch_response, _enqueued_response, _legacy_transcript, _log_error, _progress_params, _progress_response, _resume, _resume_response, _conditional_status_response, _transcribe_response
+from . import progress_stream
+from . import batch_submission
+from . import jobs
+from . import request_cache
+import logging
+logger = logging.getLogger('testlogger')
+
+
+def _in_thread(fn, *args):
+    """
+    runs blocking fn in a thread
+    - thread_sensitive=False, so calls can run at the same time. Otherwise they'd all wait in line for the same thread
+    """
+    return sync_to_async(fn, thread_sensitive=False)(*args)
+
+
+def _csrf_exempt(view):
+    # django's csrf_exempt (before 5.0) wraps the view in a sync function, which would make django think it isn't async anymore
+    view.csrf_exempt = True
+    return view
+
+
+@_csrf_exempt
+async def transcribe(req):
+    """
+    see views.transcribe
+    """
+    transcribe_request = False
+
+    try:
+        if req.method != "POST":
+            logger.info(req.method)
+            return HttpResponse("<html><body>Needs to be a post....</body></html>")
+
+        file_data = json.loads(req.body)
+        transcribe_request = TranscribeRequest(file_data)
+
+        if await _in_thread(jobs.should_enqueue):
+            return _enqueued_response(transcribe_request, await _in_thread(jobs.enqueue_transcribe, file_data))
+
+        # the reads that validating needs (user's quotas and the file's header) don't depend on each other. Neither touches transcribe_request, so they can run at the same time
+        profile, audio_info = await asyncio.gather(
+            _in_thread(get_user_profile, transcribe_request.user_id),
+            _in_thread(transcribe_request.probe_audio_file),
+        )
+        # only this thread changes the request
+        transcribe_request.custom_quotas = profile["custom_quotas"]
+        transcribe_request.audio_info = audio_info
+        await _in_thread(transcribe_request.mark_as_received)
+
+        # normally has everything it needs by now, but if reading the header failed, tries again
+        await _in_thread(transcribe_request.validate_request)
+        logger.debug("transcribe request validated!")
+
+        await _in_thread(transcribe_request.send_to_google)
+
+        return _transcribe_response(transcribe_request)
+
+    except Exception as error:
+        logger.info("error transcribing file")
+        return await _in_thread(_log_error, error, transcribe_request)
+
+
+@_csrf_exempt
+async def resume_request(req):
+    """
+    see views.resume_request
+    """
+    transcribe_request = False
+
+    try:
+        file_data = json.loads(req.body)
+        transcribe_request = TranscribeRequest(file_data)
+
+        if await _in_thread(request_cache.load, transcribe_request, request_cache.FINISHED_STATUSES):
+            # already done, so no need for quotas either
+            return _resume_response(ALREADY_DONE_MESSAGE)
+
+        # request doc and the user's quotas at the same time
+        # - quotas get read on their own and set afterwards, so only one thread at a time changes transcribe_request
+        # - event logs only get read if _resume needs them (server_has_received)
+        _, profile = await asyncio.gather(
+            _in_thread(request_cache.refresh, transcribe_request, request_cache.FINISHED_STATUSES),
+            _in_thread(get_user_profile, transcribe_request.user_id),
+        )
+        transcribe_request.user_email = profile["email"]
+        transcribe_request.custom_quotas = profile["custom_quotas"]
+        logger.info(f"Status is now {transcribe_request.status}")
+
+        if transcribe_request.transaction_complete():
+            return _resume_response(ALREADY_DONE_MESSAGE)
+
+        # might still need to read the file's header
+        await _in_thread(transcribe_request.validate_request)
+        logger.debug("transcribe request validated!")
+
+        message = await _in_thread(_resume, transcribe_request)
+
+        return _resume_response(message)
+
+    except Exception as error:
+        logger.error("error resuming request")
+        return await _in_thread(_log_error, error, transcribe_request)
+
+
+@_csrf_exempt
+async def check_status(req):
+    """
+    see views.check_status
+    """
+    transcribe_request = False
+
+    try:
+        file_data = json.loads(req.body)
+        seen_version = file_data.pop("version", None)
+        transcribe_request = TranscribeRequest(file_data)
+
+        await _in_thread(request_cache.refresh, transcribe_request)
+
+        if transcribe_request.should_check_with_google():
+            await _in_thread(transcribe_request.check_transcription_progress)
+
+        return _conditional_status_response(req, transcribe_request, seen_version)
+
+    except Exception as error:
+        logger.error("error checking status")
+        return await _in_thread(_log_error, error, transcribe_request)
+
+
+@_csrf_exempt
+async def transcribe_batch(req):
+    """
+    see views.transcribe_batch
+    """
+    try:
+        if req.method != "POST":
+            return HttpResponse("<html><body>Needs to be a post....</body></html>")
+
+        file_datas = json.loads(req.body)["files"]
+        # already sends them at the same time in its own threads, so just has to not block the event loop while it does
+        results = await _in_thread(batch_submission.submit_batch, file_datas)
+
+        return _batch_response(results)
+
+    except Exception as error:
+        logger.error(traceback.format_exc())
+        return HttpResponseBadRequest(str(error))
+
+
+async def progress(req):
+    """
+    see views.progress
+    - waiting for the next event doesn't take up a thread, so one worker can keep lots of these open
+    - NOTE streaming from an async generator needs django 4.2+. Before that, django iterates streaming responses right in the event loop, so a stream would hold up every other request. So sends one event per response instead, and lets EventSource reconnect (see progress_stream.snapshot)
+    """
+    params = _progress_params(req)
+    if params is None:
+        return HttpResponseBadRequest("needs id and user_id")
+
+    if django.VERSION < (4, 2):
+        return _progress_response([await _in_thread(progress_stream.snapshot, *params)])
+
+    return _progress_response(progress_stream.async_stream(*params))
+
+
+async def transcript(req):
+    """
+    see views.transcript
+    """
+    params = _progress_params(req)
+    if params is None:
+        return HttpResponseBadRequest("needs id and user_id")
+
+    document = await _in_thread(_legacy_transcript, *params[:2])
+    if document is None:
+        return HttpResponseNotFound("no transcript for this request")
+
+    return HttpResponse(json.dumps(document), content_type='application/json')
@@ -0,0 +1,292 @@
+"""
+Reads just the header of an audio file to find its channel count, sample rate, encoding and duration
+- lets us build the right config for Google on the first try (e.g., stereo files), instead of waiting for Google to error and then trying again
+- pure python, only needs the first few KB of the file. For files in storage we only download that much (ranged read)
+- handles FLAC (STREAMINFO block), WAV (fmt and data chunks) and MP3 (first frame header, plus the Xing/Info/VBRI header if there is one)
+
+Returns dict like:
+    {"format": "flac", "encoding": "FLAC", "channels": 2, "sample_rate_hertz": 44100, "bits_per_sample": 16, "duration_seconds": 312.5}
+Anything we can't figure out is None.
+"""
+import os
+import struct
+
+# how much to download from the start of the file. Should cover almost every header, unless there's a big ID3 tag (e.g., album art), and then we read again after it
+PROBE_BYTES = 64 * 1024
+
+
+class AudioProbeError(Exception):
+    pass
+
+
+def _result(audio_format, encoding=None, channels=None, sample_rate_hertz=None, bits_per_sample=None, duration_seconds=None):
+    return {
+        "format": audio_format,
+        "encoding": encoding,
+        "channels": channels,
+        "sample_rate_hertz": sample_rate_hertz,
+        "bits_per_sample": bits_per_sample,
+        "duration_seconds": duration_seconds,
+    }
+
+
+#########################
+# ID3
+#########################
+
+def id3_size(data):
+    """
+    returns size in bytes of the ID3v2 tag at the start of the data (including its header), or 0 if there isn't one
+    - mp3s almost always have one, and some flacs do too even though they shouldn't
+    """
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+
+    # size is "syncsafe", 7 bits per byte
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+#########################
+# FLAC
+#########################
+
+def probe_flac(data):
+    """
+    data should start at "fLaC"
+    https://xiph.org/flac/format.html#metadata_block_streaminfo
+    """
+    if len(data) < 4 + 4 + 34:
+        raise AudioProbeError("Not enough data for FLAC STREAMINFO")
+
+    block_type = data[4] & 0x7F
+    if block_type != 0:
+        raise AudioProbeError("FLAC file doesn't start with STREAMINFO")
+
+    streaminfo = data[8:8 + 34]
+    # skip min/max block size (2 bytes each) and min/max frame size (3 bytes each)
+    # then 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+    packed = int.from_bytes(streaminfo[10:18], "big")
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits_per_sample = ((packed >> 36) & 0x1F) + 1
+    total_samples = packed & 0xFFFFFFFFF
+
+    # total samples of 0 means unknown
+    duration = total_samples / sample_rate if sample_rate and total_samples else None
+
+    return _result("flac", "FLAC", channels, sample_rate, bits_per_sample, duration)
+
+
+#########################
+# WAV
+#########################
+
+# format tag => Google encoding
+_WAV_ENCODINGS = {
+    1: "LINEAR16",
+    7: "MULAW",
+}
+_WAV_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def probe_wav(data, file_size=None):
+    """
+    data should start at "RIFF"
+    http://soundfile.sapp.org/doc/WaveFormat/
+    """
+    if len(data) < 12 or data[8:12] != b"WAVE":
+        raise AudioProbeError("Not a WAVE file")
+
+    offset = 12
+    fmt = None
+    data_size = None
+    data_offset = None
+
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        chunk_size = struct.unpack("<I", data[offset + 4:offset + 8])[0]
+
+        if chunk_id == b"fmt ":
+            fmt = data[offset + 8:offset + 8 + chunk_size]
+        elif chunk_id == b"data":
+            data_size = chunk_size
+            data_offset = offset + 8
+            break
+
+        # chunks are padded to an even number of bytes
+        offset += 8 + chunk_size + (chunk_size % 2)
+
+    if fmt is None or len(fmt) < 16:
+        raise AudioProbeError("WAV fmt chunk not found in header")
+
+    format_tag, channels, sample_rate, byte_rate, block_align, bits_per_sample = struct.unpack("<HHIIHH", fmt[:16])
+    if format_tag == _WAV_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        # real format is the first two bytes of the sub format guid
+        format_tag = struct.unpack("<H", fmt[24:26])[0]
+
+    encoding = _WAV_ENCODINGS.get(format_tag)
+    if encoding == "LINEAR16" and bits_per_sample != 16:
+        # Google only takes 16 bit pcm
+        encoding = None
+
+    # some encoders write 0 or 0xFFFFFFFF for the data size when streaming, so fall back on the file size
+    if data_size in [None, 0, 0xFFFFFFFF] and file_size and data_offset:
+        data_size = file_size - data_offset
+
+    duration = data_size / byte_rate if data_size and byte_rate else None
+
+    return _result("wav", encoding, channels, sample_rate, bits_per_sample, duration)
+
+
+#########################
+# MP3
+#########################
+
+# bitrates in kbps, by [version is mpeg1][layer][index]
+_MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# by version bits
+_MP3_SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000], # MPEG 1
+    0b10: [22050, 24000, 16000], # MPEG 2
+    0b00: [11025, 12000, 8000],  # MPEG 2.5
+}
+_MP3_LAYERS = {0b11: 1, 0b10: 2, 0b01: 3}
+
+
+def _parse_mp3_frame_header(header):
+    """
+    returns dict with frame info, or None if these 4 bytes aren't a valid frame header
+    """
+    if header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+
+    version_bits = (header[1] >> 3) & 0x3
+    layer = _MP3_LAYERS.get((header[1] >> 1) & 0x3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x3
+
+    if version_bits == 0b01 or layer is None or bitrate_index in [0, 15] or sample_rate_index == 3:
+        return None
+
+    is_mpeg1 = version_bits == 0b11
+    channel_mode = header[3] >> 6
+    return {
+        "is_mpeg1": is_mpeg1,
+        "layer": layer,
+        "bitrate": _MP3_BITRATES[(is_mpeg1, layer)][bitrate_index] * 1000,
+        "sample_rate": _MP3_SAMPLE_RATES[version_bits][sample_rate_index],
+        # 0b11 is mono, everything else (stereo, joint stereo, dual channel) is 2 channels
+        "channels": 1 if channel_mode == 0b11 else 2,
+        # samples per frame
+        "samples": 384 if layer == 1 else (1152 if is_mpeg1 or layer == 2 else 576),
+    }
+
+
+def _mp3_frame_count(data, offset, frame):
+    """
+    VBR files have a Xing/Info or VBRI header in the first frame with the total number of frames
+    """
+    # Xing/Info comes after the side info, which depends on version and channels
+    if frame["is_mpeg1"]:
+        side_info = 17 if frame["channels"] == 1 else 32
+    else:
+        side_info = 9 if frame["channels"] == 1 else 17
+
+    xing_offset = offset + 4 + side_info
+    if data[xing_offset:xing_offset + 4] in [b"Xing", b"Info"]:
+        flags = struct.unpack(">I", data[xing_offset + 4:xing_offset + 8])[0]
+        if flags & 0x1:
+            return struct.unpack(">I", data[xing_offset + 8:xing_offset + 12])[0]
+
+    vbri_offset = offset + 4 + 32
+    if data[vbri_offset:vbri_offset + 4] == b"VBRI":
+        return struct.unpack(">I", data[vbri_offset + 14:vbri_offset + 18])[0]
+
+    return None
+
+
+def probe_mp3(data, file_size=None, audio_offset=0):
+    """
+    data should start at the first frame, or just before it (sometimes there's junk before the first frame)
+    - audio_offset is where data starts in the file (e.g., after the ID3 tag), for estimating duration from file size
+    """
+    for offset in range(0, max(len(data) - 3, 0)):
+        frame = _parse_mp3_frame_header(data[offset:offset + 4])
+        if frame is not None:
+            break
+    else:
+        raise AudioProbeError("No MP3 frame header found")
+
+    frame_count = _mp3_frame_count(data, offset, frame)
+    if frame_count:
+        duration = frame_count * frame["samples"] / frame["sample_rate"]
+    elif file_size:
+        # assume constant bitrate
+        duration = (file_size - audio_offset - offset) * 8 / frame["bitrate"]
+    else:
+        duration = None
+
+    return _result("mp3", "MP3", frame["channels"], frame["sample_rate"], None, duration)
+
+
+#########################
+# entry points
+#########################
+
+def probe_bytes(data, file_size=None, audio_offset=0):
+    """
+    takes the first bytes of an audio file
+    - data should be after any ID3 tag. audio_offset is where data starts in the file
+    """
+    if data[:4] == b"fLaC":
+        return probe_flac(data)
+    elif data[:4] == b"RIFF":
+        return probe_wav(data, file_size)
+    else:
+        return probe_mp3(data, file_size, audio_offset)
+
+
+def probe_blob(blob, file_size=None):
+    """
+    probes file in cloud storage, only downloading the start of it
+    - blob is a google.cloud.storage Blob (or anything with download_as_bytes(start, end))
+    """
+    # NOTE end is inclusive
+    data = blob.download_as_bytes(start=0, end=PROBE_BYTES - 1)
+
+    audio_offset = id3_size(data)
+    if audio_offset:
+        if audio_offset + 1024 > len(data):
+            # tag is bigger than what we downloaded, so get what comes after it
+            data = blob.download_as_bytes(start=audio_offset, end=audio_offset + PROBE_BYTES - 1)
+        else:
+            data = data[audio_offset:]
+
+    return probe_bytes(data, file_size, audio_offset)
+
+
+def probe_file(path):
+    """
+    probes local file, for scripts and tests
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        data = f.read(PROBE_BYTES)
+        audio_offset = id3_size(data)
+        if audio_offset:
+            f.seek(audio_offset)
+            data = f.read(PROBE_BYTES)
+
+    return probe_bytes(data, file_size, audio_offset)
@@ -0,0 +1,146 @@
+"""
+Submitting a bunch of files in one request (request-transcribe-batch/), e.g., a whole folder of sermons
+- looks up each user's quotas once for the whole batch, instead of once per file
+- headers get read at the same time, then every file's new status (received, or server-error if it didn't pass validation) goes out in one batched write
+- then sends them to Google at the same time, but no more than BATCH_SUBMISSION["MAX_CONCURRENT"] at once (converting to flac is heavy, and Google has quotas)
+- one file failing doesn't stop the others. Returns a result per file, in the same order they were sent
+- with the job queue on (JOB_QUEUE["ENABLED"], and a worker claiming from it, see jobs.should_enqueue), does none of that here. Each file becomes its own transcribe job, same as request-transcribe/ (see jobs.py)
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .helpers import *
+from .transcribe_class import TranscribeRequest
+from .users import get_user_profile
+from . import admission
+from . import jobs
+logger = logging.getLogger('testlogger')
+
+
+def _result(index, transcribe_request=None, error=None, job_id=None):
+    result = {
+        "index": index,
+        "ok": error is None,
+        "error": str(error) if error is not None else "",
+    }
+    if transcribe_request is not None:
+        result["current_request_data"] = transcribe_request.response_data()
+    if job_id is not None:
+        result["job_id"] = job_id
+
+    return result
+
+
+def _run_all(fn, items, max_workers):
+    """
+    runs fn on every item in a bounded pool. Returns list of (value, error), in the same order
+    """
+    def run(item):
+        try:
+            return fn(item), None
+        except Exception as error:
+            logger.error(traceback.format_exc())
+            return None, error
+
+    if not items:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix="batch") as executor:
+        return list(executor.map(run, items))
+
+
+def _validate(transcribe_request):
+    transcribe_request.validate_request()
+
+
+def enqueue_batch(file_datas):
+    """
+    what submit_batch does when the job queue is on: one job per file, and the worker does the rest
+    """
+    results = []
+    for index, file_data in enumerate(file_datas):
+        try:
+            transcribe_request = TranscribeRequest(file_data)
+        except Exception as error:
+            results.append(_result(index, error=error))
+            continue
+
+        results.append(_result(index, transcribe_request, job_id=jobs.enqueue_transcribe(file_data)))
+
+    return results
+
+
+def submit_batch(file_datas, send=None):
+    """
+    file_datas is list of the same dicts that request-transcribe/ takes
+    send is what to do with each valid request to get it to Google (TranscribeRequest.send_to_google, unless testing)
+    - returns list of results, one per file_data
+    """
+    max_items = settings.BATCH_SUBMISSION["MAX_ITEMS"]
+    if len(file_datas) > max_items:
+        raise ValueError(f"Can't send more than {max_items} files at once")
+
+    if jobs.should_enqueue():
+        return enqueue_batch(file_datas)
+
+    send = send or TranscribeRequest.send_to_google
+
+    max_concurrent = settings.BATCH_SUBMISSION["MAX_CONCURRENT"]
+    results = [None] * len(file_datas)
+    # index => TranscribeRequest, for the ones we could make
+    transcribe_requests = {}
+
+    for index, file_data in enumerate(file_datas):
+        try:
+            transcribe_requests[index] = TranscribeRequest(file_data)
+        except Exception as error:
+            # e.g., missing filename. Nothing in firestore to mark as failed, so just tell the client
+            results[index] = _result(index, error=error)
+
+    # one quota lookup per user, not per file
+    profiles = {}
+    for index, transcribe_request in list(transcribe_requests.items()):
+        user_id = transcribe_request.user_id
+        try:
+            if user_id not in profiles:
+                profiles[user_id] = get_user_profile(user_id)
+
+            transcribe_request.custom_quotas = profiles[user_id]["custom_quotas"]
+
+        except Exception as error:
+            results[index] = _result(index, error=error)
+            del transcribe_requests[index]
+
+    # reading headers for the duration check is a storage call per file, so all at once
+    indexes = list(transcribe_requests)
+    validations = _run_all(lambda index: _validate(transcribe_requests[index]), indexes, max_concurrent)
+    invalid = {index: error for index, (_, error) in zip(indexes, validations) if error is not None}
+
+    with TranscribeRequest.batched_writes_for(list(transcribe_requests.values())):
+        for index, transcribe_request in transcribe_requests.items():
+            if index in invalid:
+                transcribe_request.mark_as_server_error(invalid[index])
+            else:
+                transcribe_request.mark_as_received()
+
+    for index, error in invalid.items():
+        results[index] = _result(index, transcribe_requests[index], error)
+
+    to_send = [index for index in indexes if index not in invalid]
+    sent = _run_all(lambda index: send(transcribe_requests[index]), to_send, max_concurrent)
+
+    for index, (_, error) in zip(to_send, sent):
+        transcribe_request = transcribe_requests[index]
+        if error is not None and "error" not in transcribe_request.status and not isinstance(error, admission.AdmissionTimeout):
+            # same as views._log_error. If it is already an error status, it was already handled (e.g., Google said no). Too busy isn't an error with the file, so its status stays as it is
+            try:
+                transcribe_request.mark_as_server_error(error)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+        if error is None and "error" in transcribe_request.status:
+            # didn't raise, but didn't make it to Google either
+            error = transcribe_request.error
+
+        results[index] = _result(index, transcribe_request, error)
+
+    return results
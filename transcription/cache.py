@@ -0,0 +1,102 @@
+"""
+Small in-process caches, shared by every request that a worker process handles
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded LRU cache where entries also expire after ttl seconds
+    - thread safe, since the poller and batch submissions use threads
+    - keeps hit/miss counts so we can see if it's actually helping
+    - on_evict gets called with (key, value) whenever something leaves the cache (expired, pushed out, or invalidated)
+    """
+
+    def __init__(self, max_size=1000, ttl=300, on_evict=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.clock = clock
+
+        # key => (expires_at, value). Least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._evict(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+            expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+            self._entries[key] = (expires_at, value)
+
+            while len(self._entries) > self.max_size:
+                oldest_key = next(iter(self._entries))
+                self._evict(oldest_key)
+
+    def expire(self):
+        """
+        drops everything that's expired, without waiting for someone to read it (so on_evict runs for it now)
+        - returns how many
+        """
+        with self._lock:
+            now = self.clock()
+            expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                self._evict(key)
+
+            return len(expired)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > self.clock()
+
+    def _evict(self, key):
+        expires_at, value = self._entries.pop(key)
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, value)
@@ -0,0 +1,399 @@
+"""
+Chunked recognition for long audio (opt in, by sending "chunked": true with the request)
+- instead of one long running operation for the whole file, splits the audio at silences into chunks of about CHUNKING["TARGET_CHUNK_SECONDS"], and sends each chunk to Google as its own operation
+- at most CHUNKING["MAX_CONCURRENT_OPERATIONS"] chunks are with Google at a time. The rest wait, and get sent as others finish (whenever we check progress)
+- when every chunk is done, their results get stitched back into one list of utterances, with word times moved back onto the original file's timeline
+- each chunk's status lives in the transcribeRequests doc's "chunks" subcollection:
+    {"index": 0, "start_ms": 0, "end_ms": 612000, "file_path": "...", "status": "transcribing", "transaction_id": "...", "progress_percent": 40, "attempts": 0, "sent_at": "...", "start_time": "...", "last_updated_at": "..."}
+  and once it's done, its results too (compressed the same way as transcript pages, see transcript_storage.py)
+- a chunk that errors gets sent again on its own. If the request errors anyway, the chunks (docs and files) stay put, like the upload does, so resuming picks up where it was instead of starting over. The chunk files get deleted once the transcript is done
+"""
+import re
+from datetime import datetime, timedelta
+from django.conf import settings
+from .helpers import *
+from . import transcoding
+from . import transcript_storage
+from . import retry_policy
+from . import storage_cleanup
+from . import admission
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+CHUNKS_COLLECTION = "chunks"
+
+CHUNK_STATUSES = [
+    # 0
+    # cut and uploaded, waiting for a free spot to send to Google
+    "pending",
+    # 1
+    "transcribing",
+    # 2
+    "done",
+    # 3
+    "error",
+]
+
+_SILENCE_START_PATTERN = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END_PATTERN = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+#########################
+# planning the chunks
+#########################
+
+def detect_silences(source_blob, noise_db=None, min_silence_seconds=None):
+    """
+    returns list of (start_seconds, end_seconds) of every silence in the file
+    - runs ffmpeg's silencedetect filter over the whole file, streamed from the bucket
+    """
+    noise_db = noise_db or settings.CHUNKING["SILENCE_DB"]
+    min_silence_seconds = min_silence_seconds or settings.CHUNKING["MIN_SILENCE_SECONDS"]
+    args = [
+        settings.TRANSCODING["FFMPEG"], "-hide_banner", "-nostdin",
+        "-i", "pipe:0",
+        "-af", f"silencedetect=noise={noise_db}dB:d={min_silence_seconds}",
+        "-f", "null", "-",
+    ]
+
+    silences = []
+    silence_start = []
+    def on_stderr_line(line):
+        start = _SILENCE_START_PATTERN.search(line)
+        if start:
+            silence_start[:] = [max(float(start.group(1)), 0)]
+
+        end = _SILENCE_END_PATTERN.search(line)
+        if end and silence_start:
+            silences.append((silence_start.pop(), float(end.group(1))))
+
+    transcoding.stream_transcode(source_blob, None, args=args, on_stderr_line=on_stderr_line)
+    return silences
+
+
+def plan_chunks(duration_seconds, silences, target_seconds=None, max_seconds=None):
+    """
+    returns list of (start_seconds, end_seconds) covering the whole file
+    - cuts in the middle of whichever silence is closest to target_seconds into the chunk, as long as the chunk is at least half the target and no longer than max_seconds
+    - if there's no silence in that range, just cuts at max_seconds
+    """
+    target_seconds = target_seconds or settings.CHUNKING["TARGET_CHUNK_SECONDS"]
+    max_seconds = max_seconds or settings.CHUNKING["MAX_CHUNK_SECONDS"]
+    cut_points = [(start + end) / 2 for start, end in silences]
+
+    chunks = []
+    chunk_start = 0
+    while duration_seconds - chunk_start > max_seconds:
+        candidates = [
+            point for point in cut_points
+            if chunk_start + target_seconds / 2 <= point <= chunk_start + max_seconds
+        ]
+        if candidates:
+            cut = min(candidates, key=lambda point: abs(point - (chunk_start + target_seconds)))
+        else:
+            cut = chunk_start + max_seconds
+
+        chunks.append((chunk_start, cut))
+        chunk_start = cut
+
+    chunks.append((chunk_start, duration_seconds))
+    return chunks
+
+
+def chunk_path_for(file_path, index):
+    """
+    e.g., "uploads/sermon.mp3" => "uploads/sermon.mp3-chunks/00003.flac"
+    """
+    return f"{file_path}-chunks/{index:05d}.flac"
+
+
+def _ffmpeg_input_for(blob):
+    """
+    a url ffmpeg can read the blob from. Unlike piping it in, this lets ffmpeg seek straight to where the chunk starts (with range requests)
+    """
+    return blob.generate_signed_url(expiration=timedelta(hours=1), version="v4")
+
+
+def cut_chunks(source_blob, plan, file_path, bucket_to_use=None):
+    """
+    cuts each chunk out of the source as mono flac and uploads it. Chunks get cut at the same time, in the transcoding pool
+    - returns list of chunk file paths, in order
+    """
+    bucket_to_use = bucket_to_use or bucket
+    source_url = _ffmpeg_input_for(source_blob)
+
+    futures = []
+    paths = []
+    for index, (start, end) in enumerate(plan):
+        path = chunk_path_for(file_path, index)
+        args = [
+            settings.TRANSCODING["FFMPEG"], "-hide_banner", "-loglevel", "error", "-nostdin",
+            "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}",
+            "-i", source_url,
+            "-ac", "1",
+            "-c:a", "flac", "-f", "flac",
+            "pipe:1",
+        ]
+        futures.append(clients.get("transcoding_pool").submit(transcoding.stream_transcode, None, bucket_to_use.blob(path), args=args))
+        paths.append(path)
+
+    for future in futures:
+        # raises if any of them failed
+        future.result()
+
+    return paths
+
+
+#########################
+# stitching results back together
+#########################
+
+def _shift(duration, offset_ms):
+    if duration is None:
+        return None
+
+    return transcript_storage.ms_to_duration(transcript_storage.duration_to_ms(duration) + offset_ms)
+
+
+def rebase_utterances(utterances, offset_ms):
+    """
+    returns copy of utterances, with every time moved later by offset_ms
+    """
+    rebased = []
+    for utterance in utterances:
+        alternatives = []
+        for alternative in utterance.get("alternatives", []):
+            alternative = dict(alternative)
+            if "words" in alternative:
+                alternative["words"] = [{
+                    **word,
+                    "startTime": _shift(word.get("startTime"), offset_ms),
+                    "endTime": _shift(word.get("endTime"), offset_ms),
+                } for word in alternative["words"]]
+            alternatives.append(alternative)
+
+        utterance = {**utterance, "alternatives": alternatives}
+        if "resultEndTime" in utterance:
+            utterance["resultEndTime"] = _shift(utterance["resultEndTime"], offset_ms)
+        rebased.append(utterance)
+
+    return rebased
+
+
+def stitch(chunks):
+    """
+    takes chunk docs (with their results) and returns one list of utterances for the whole file
+    """
+    utterances = []
+    for chunk in sorted(chunks, key=lambda chunk: chunk["index"]):
+        chunk_utterances = transcript_storage.unpack_page(transcript_storage.decompress_page(chunk["results"]))
+        utterances.extend(rebase_utterances(chunk_utterances, chunk["start_ms"]))
+
+    return utterances
+
+
+#########################
+# driving a chunked request
+#########################
+
+def _rfc3339_now():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _send_chunk(config, audio, max_wait_seconds=None):
+    # each chunk counts against the quota like any other request (see admission.py)
+    with admission.admit(max_wait_seconds), metrics.external_call("speech", "long_running_recognize"):
+        return speech_client.long_running_recognize(config, audio, retry=reset_retry)
+
+
+class ChunkedRecognition:
+    """
+    chunked recognition for a single TranscribeRequest
+    """
+
+    def __init__(self, transcribe_request):
+        self.transcribe_request = transcribe_request
+
+    def chunks_ref(self):
+        return self.transcribe_request.transcribe_request_ref().collection(CHUNKS_COLLECTION)
+
+    def can_chunk(self):
+        """
+        only worth it (and only possible) if we know how long the file is, and it's long
+        """
+        duration_seconds = (self.transcribe_request.get_audio_info() or {}).get("duration_seconds")
+        return bool(duration_seconds) and duration_seconds >= settings.CHUNKING["MIN_DURATION_SECONDS"]
+
+    def start(self, config):
+        """
+        splits the file into chunks, uploads them and sends the first ones to Google
+        - if this request already has chunks (e.g., resuming after a chunk errored), reuses them: done ones stay done, ones with Google stay with Google, and only the errored ones get sent again. No cutting, uploading or paying for the rest twice
+        - returns list of chunk dicts
+        """
+        transcribe_request = self.transcribe_request
+        chunks = self.load_chunks()
+        if chunks and chunks[0]["file_path"] == chunk_path_for(transcribe_request.file_path, 0):
+            logger.info(f"reusing {len(chunks)} chunks for {transcribe_request.file_path}")
+            with transcribe_request.batched_writes():
+                for chunk in chunks:
+                    if chunk["status"] == CHUNK_STATUSES[3]:
+                        self._reset_chunk(chunk, attempts=0)
+                        self._persist_chunk(chunk)
+
+        else:
+            stale = chunks
+            source_blob = bucket.blob(transcribe_request.file_path)
+            duration_seconds = transcribe_request.get_audio_info()["duration_seconds"]
+
+            silences = detect_silences(source_blob)
+            plan = plan_chunks(duration_seconds, silences)
+            logger.info(f"splitting {transcribe_request.file_path} into {len(plan)} chunks")
+            paths = cut_chunks(source_blob, plan, transcribe_request.file_path)
+
+            chunks = [{
+                "index": index,
+                "start_ms": round(start * 1000),
+                "end_ms": round(end * 1000),
+                "file_path": path,
+                "status": CHUNK_STATUSES[0],
+                "progress_percent": 0,
+                "attempts": 0,
+            } for index, ((start, end), path) in enumerate(zip(plan, paths))]
+
+            # all of them, before any goes to Google. Then sending only has to update the ones it sent
+            with transcribe_request.batched_writes() as unit_of_work:
+                for chunk in stale:
+                    # from a different file uploaded with the same request id
+                    unit_of_work.delete(self._chunk_ref(chunk))
+                for chunk in chunks:
+                    self._persist_chunk(chunk)
+
+        self.submit_pending(chunks, config)
+        return chunks
+
+    def load_chunks(self):
+        return [doc.to_dict() for doc in self.chunks_ref().order_by("index").stream()]
+
+    def submit_pending(self, chunks, config):
+        """
+        sends pending chunks to Google, until MAX_CONCURRENT_OPERATIONS are with Google
+        - each chunk gets written as soon as it's sent, so if sending a later one raises, we still know which operations we started (and don't pay for them twice)
+        """
+        in_flight = len([chunk for chunk in chunks if chunk["status"] == CHUNK_STATUSES[1]])
+
+        for chunk in chunks:
+            if in_flight >= settings.CHUNKING["MAX_CONCURRENT_OPERATIONS"]:
+                break
+            if chunk["status"] != CHUNK_STATUSES[0]:
+                continue
+
+            audio = {"uri": f"gs://{BUCKET_NAME}/{chunk['file_path']}"}
+            operation_future = retry_policy.call_with_retries(
+                lambda: _send_chunk(config, audio, self.transcribe_request.admission_wait()),
+                budget=self.transcribe_request.retry_budget(),
+            )
+            chunk["status"] = CHUNK_STATUSES[1]
+            chunk["transaction_id"] = operation_future.operation.name
+            # until Google tells us its own times (see get_operation)
+            chunk["sent_at"] = _rfc3339_now()
+            in_flight += 1
+            logger.info(f"sent chunk {chunk['index']} to Google: {chunk['transaction_id']}")
+            self._write_chunk_now(chunk)
+
+    def get_operation(self, config):
+        """
+        checks on every chunk that's with Google, sends more if there's room, and returns a dict shaped like a single operation from Google (see helpers.get_operation), so the request can handle it the same way
+        - a chunk that errors gets sent again, up to CHUNKING["MAX_CHUNK_ATTEMPTS"] times. Only after that does the request error, and even then the chunks stay as they are, so resuming only sends the errored ones again (see start)
+        - once every chunk is done, the response has the stitched results
+        """
+        chunks = self.load_chunks()
+        error = None
+
+        for chunk in chunks:
+            if chunk["status"] != CHUNK_STATUSES[1]:
+                continue
+
+            operation_dict = get_operation(chunk["transaction_id"])
+            metadata = operation_dict.get("metadata", {})
+            chunk["progress_percent"] = metadata.get("progressPercent", 0)
+            for key, name in [("startTime", "start_time"), ("lastUpdateTime", "last_updated_at")]:
+                if metadata.get(key):
+                    chunk[name] = metadata[key]
+
+            if operation_dict.get("error"):
+                logger.error(f"chunk {chunk['index']} errored: {operation_dict['error']}")
+                if chunk.get("attempts", 0) + 1 < settings.CHUNKING["MAX_CHUNK_ATTEMPTS"]:
+                    self._reset_chunk(chunk, attempts=chunk.get("attempts", 0) + 1)
+                else:
+                    chunk["status"] = CHUNK_STATUSES[3]
+                    chunk["error"] = str(operation_dict["error"])
+                    error = operation_dict["error"]
+
+            elif operation_dict.get("done"):
+                results = operation_dict.get("response", {}).get("results", [])
+                chunk["status"] = CHUNK_STATUSES[2]
+                chunk["progress_percent"] = 100
+                chunk["results"] = transcript_storage.compress_page(transcript_storage.pack_page(results))
+
+        # chunk statuses get their own batch, since by now they've been sent to Google whether or not the rest of this cycle works
+        with self.transcribe_request.batched_writes():
+            for chunk in chunks:
+                self._persist_chunk(chunk)
+
+        if error is None:
+            self.submit_pending(chunks, config)
+
+        total_ms = sum(chunk["end_ms"] - chunk["start_ms"] for chunk in chunks) or 1
+        progress_percent = round(sum(chunk["progress_percent"] * (chunk["end_ms"] - chunk["start_ms"]) for chunk in chunks) / total_ms)
+
+        # from Google's times for the chunks, so they only move when one of the operations does (see TranscribeRequest._made_progress)
+        start_times = [chunk.get("start_time") or chunk["sent_at"] for chunk in chunks if chunk.get("sent_at")]
+        updated_times = [chunk.get("last_updated_at") or chunk["sent_at"] for chunk in chunks if chunk.get("sent_at")]
+        operation_dict = {
+            "name": self.transcribe_request.transaction_id,
+            "metadata": {
+                "progressPercent": progress_percent,
+                "startTime": min(start_times, key=to_timestamp) if start_times else _rfc3339_now(),
+                "lastUpdateTime": max(updated_times, key=to_timestamp) if updated_times else _rfc3339_now(),
+            },
+        }
+
+        if error is not None:
+            operation_dict["error"] = error
+
+        elif chunks and all(chunk["status"] == CHUNK_STATUSES[2] for chunk in chunks):
+            operation_dict["done"] = True
+            operation_dict["response"] = {"results": stitch(chunks)}
+            self.delete_chunk_files(chunks)
+
+        return operation_dict
+
+    def delete_chunk_files(self, chunks):
+        # in the background, once the transcript is saved (see storage_cleanup.py)
+        with self.transcribe_request.batched_writes() as unit_of_work:
+            storage_cleanup.schedule([chunk["file_path"] for chunk in chunks], unit_of_work)
+
+    def _chunk_ref(self, chunk):
+        return self.chunks_ref().document(f"{chunk['index']:05d}")
+
+    def _persist_chunk(self, chunk):
+        self.transcribe_request._set_document(self._chunk_ref(chunk), chunk, merge=True)
+
+    def _write_chunk_now(self, chunk):
+        """
+        not in whatever batch we're in, since that could still get thrown out
+        """
+        with metrics.external_call("firestore", "set"):
+            self._chunk_ref(chunk).set(chunk, merge=True)
+
+    def _reset_chunk(self, chunk, attempts):
+        """
+        back to pending, so it gets sent again. Same file, it's still uploaded
+        """
+        chunk.update({
+            "status": CHUNK_STATUSES[0],
+            "progress_percent": 0,
+            "attempts": attempts,
+            "transaction_id": None,
+            "error": None,
+        })
@@ -0,0 +1,201 @@
+"""
+Singleflight for check_transcription_progress: when several calls check on the same operation at once (other tabs, a client retrying), only one asks Google and writes what it got back. The rest wait for it and take its result
+- keyed by user and transaction_id. Per process, so it's threads (gthread, ASGI's thread pool, the poller) sharing
+    * not just transaction_id, since ours for chunked and cached requests (chunked-{id}, cache-{id}) only have the request id in them, and two users can have the same one. Waiters copy the leader's fields, user_id included, so they'd end up with someone else's request
+- optionally across processes too, with a lease doc (COALESCING["LEASE"]): whoever creates it first asks Google, everyone else just reads what's in firestore (which is what check-status does anyway when the poller is on)
+    * lease docs are per LEASE_SECONDS window, so a lease whose process died only blocks until the window's over, no need to expire anything. Set a TTL policy on expires_at to clear out any left behind
+- metrics: coalesced_calls_total (calls that didn't need Google, by how), and duplicate_operation_calls_total (calls to Google while another for the same operation was already going in this process, i.e., what this would save if it's off)
+"""
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from google.api_core.exceptions import AlreadyExists
+from .helpers import *
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+LEASES_COLLECTION = "operationLeases"
+
+coalesced_calls = metrics.registry.counter(
+    "coalesced_calls_total",
+    "check_transcription_progress calls that used someone else's call to Google instead of making their own",
+    ["how"],
+)
+duplicate_calls = metrics.registry.counter(
+    "duplicate_operation_calls_total",
+    "Calls to Google for an operation that another call in this process was already checking on",
+)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    do(key, fn): runs fn, unless a call for key is already running, in which case waits for that one and returns what it returned (or raises what it raised)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key => _Call
+        self._calls = {}
+        # key => number of calls running through counting (i.e., with coalescing off)
+        self._running = Counter()
+
+    def do(self, key, fn):
+        """
+        returns (result, shared). shared is True if someone else ran fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+
+        except BaseException as error:
+            call.error = error
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def counting(self, key, fn):
+        """
+        runs fn no matter what, but counts it as a duplicate if another call for key is running
+        """
+        with self._lock:
+            if self._running[key]:
+                duplicate_calls.inc()
+            self._running[key] += 1
+
+        try:
+            return fn()
+        finally:
+            with self._lock:
+                self._running[key] -= 1
+                if not self._running[key]:
+                    del self._running[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+            }
+
+
+operation_flights = SingleFlight()
+metrics.register_stats("coalescing", operation_flights.stats)
+
+
+#########################
+# leases
+#########################
+
+def lease_ref(user_id, transaction_id, now=None):
+    window = int((now or time.time()) // settings.COALESCING["LEASE_SECONDS"])
+    return db.collection(LEASES_COLLECTION).document(f"{user_id}-{transaction_id}-{window}")
+
+
+def acquire_lease(user_id, transaction_id):
+    """
+    returns the lease's ref if we got it, False if someone else has it, or None if we didn't try (or couldn't tell)
+    """
+    if not settings.COALESCING["LEASE"]:
+        return None
+
+    ref = lease_ref(user_id, transaction_id)
+    try:
+        with metrics.external_call("firestore", "create"):
+            ref.create({
+                "user_id": user_id,
+                "transaction_id": transaction_id,
+                "expires_at": utc_now() + timedelta(seconds=settings.COALESCING["LEASE_SECONDS"]),
+            })
+
+    except AlreadyExists:
+        return False
+
+    except Exception as error:
+        # the lease is only to save calls, so if firestore won't take it, just go ahead without one
+        logger.error(f"couldn't take the lease for {transaction_id}")
+        logger.error(error)
+        return None
+
+    return ref
+
+
+def release_lease(ref):
+    try:
+        with metrics.external_call("firestore", "delete"):
+            ref.delete()
+
+    except Exception as error:
+        # it'll stop counting once its window is over anyway
+        logger.error(f"couldn't release lease {ref.id}")
+        logger.error(error)
+
+
+#########################
+# check_transcription_progress
+#########################
+
+def _check_or_read(transcribe_request, check):
+    """
+    what the one call that goes through does: checks with Google if no other process is, otherwise reads what's in firestore
+    - returns the request's fields afterwards, for the calls that waited on it
+    """
+    lease = acquire_lease(transcribe_request.user_id, transcribe_request.transaction_id)
+    if lease is False:
+        logger.info(f"another process is checking on {transcribe_request.transaction_id}, reading from firestore instead")
+        coalesced_calls.inc(how="lease")
+        transcribe_request.refresh_from_db()
+
+    else:
+        try:
+            check()
+        finally:
+            if lease is not None:
+                release_lease(lease)
+
+    return transcribe_request.to_dict(type(transcribe_request).PAYLOAD_FIELDS)
+
+
+def check_progress(transcribe_request, check):
+    """
+    runs check (TranscribeRequest._check_transcription_progress) for transcribe_request, unless another call for the same operation is already running, in which case takes its result
+    """
+    if not transcribe_request.transaction_id:
+        # nothing sent to Google yet, so nothing to share
+        check()
+        return
+
+    key = (transcribe_request.user_id, transcribe_request.transaction_id)
+
+    if not settings.COALESCING["ENABLED"]:
+        operation_flights.counting(key, check)
+        return
+
+    file_data, shared = operation_flights.do(key, lambda: _check_or_read(transcribe_request, check))
+    if shared:
+        logger.info(f"used another call's check on {key}")
+        coalesced_calls.inc(how="local")
+        # a copy, since every call that waited gets the same dict
+        transcribe_request._set_attributes_from_dictionary(deepcopy(file_data))
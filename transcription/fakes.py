@@ -0,0 +1,552 @@
+"""
+In-memory stand-ins for the Google clients in helpers.py, for tests and benchmarks
+- swap them in with helpers.clients.override, e.g., clients.override("db", FakeFirestore())
+- every fake counts the RPCs it would have made, so we can check how many round trips something costs
+- only implements the parts of each api we actually use
+"""
+import io
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from copy import deepcopy
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1.transforms import Increment
+
+_FILTER_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+}
+
+
+def _record_rpc(fake, name):
+    """
+    counts the RPC, and takes as long as the fake's latency_seconds
+    """
+    with fake._lock:
+        fake.rpc_counts[name] += 1
+
+    if fake.latency_seconds:
+        time.sleep(fake.latency_seconds)
+
+
+def _merge(existing, updates):
+    """
+    firestore's set(merge=True): nested dicts get merged, everything else gets replaced
+    - Increment adds to what's there (or to 0, if nothing is)
+    """
+    merged = deepcopy(existing)
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        elif isinstance(value, Increment):
+            current = merged.get(key)
+            merged[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+        else:
+            merged[key] = deepcopy(value)
+
+    return merged
+
+
+class FakeFirestore:
+    """
+    stand-in for firestore.Client
+    - documents are stored by their full path, e.g., "users/abc/transcribeRequests/123"
+    - rpc_counts["commit"] goes up once per set/add/delete or per batch commit, like the real thing
+    - latency_seconds: how long each RPC takes, for benchmarks
+    """
+
+    def __init__(self, latency_seconds=0):
+        self.documents = {}
+        self.rpc_counts = Counter()
+        self.latency_seconds = latency_seconds
+        self._lock = threading.Lock()
+
+    def _rpc(self, name):
+        _record_rpc(self, name)
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def collection_group(self, collection_id):
+        return FakeQuery(self, collection_id=collection_id, group=True)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    # helpers for tests (not part of the real api)
+    def write(self, path, data):
+        self.documents[path] = deepcopy(data)
+
+    def read(self, path):
+        return deepcopy(self.documents.get(path))
+
+    def _apply_set(self, path, data, merge=False):
+        if merge and path in self.documents:
+            self.documents[path] = _merge(self.documents[path], data)
+        else:
+            self.documents[path] = _merge({}, data)
+
+
+class FakeCollectionReference:
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self.id = path.split("/")[-1]
+
+    @property
+    def parent(self):
+        parts = self._path.split("/")
+        if len(parts) == 1:
+            return None
+
+        return FakeDocumentReference(self._client, "/".join(parts[:-1]))
+
+    def document(self, document_id=None):
+        document_id = document_id or uuid.uuid4().hex
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id}")
+
+    def add(self, data):
+        doc_ref = self.document()
+        self._client._rpc("commit")
+        self._client._apply_set(doc_ref._path, data)
+        return None, doc_ref
+
+    def _query(self):
+        return FakeQuery(self._client, collection_path=self._path)
+
+    def where(self, field, op, value):
+        return self._query().where(field, op, value)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._query().order_by(field, direction)
+
+    def limit(self, count):
+        return self._query().limit(count)
+
+    def stream(self):
+        return self._query().stream()
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self.id = path.split("/")[-1]
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, "/".join(self._path.split("/")[:-1]))
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, f"{self._path}/{name}")
+
+    def get(self):
+        self._client._rpc("get")
+        return FakeDocumentSnapshot(self, self._client.documents.get(self._path))
+
+    def set(self, data, merge=False):
+        self._client._rpc("commit")
+        self._client._apply_set(self._path, data, merge=merge)
+
+    def update(self, data):
+        self.set(data, merge=True)
+
+    def create(self, data):
+        """
+        like set, but fails if the doc is already there
+        """
+        self._client._rpc("commit")
+        with self._client._lock:
+            if self._path in self._client.documents:
+                raise AlreadyExists(f"Document already exists: {self._path}")
+
+            self._client._apply_set(self._path, data)
+
+    def delete(self):
+        self._client._rpc("commit")
+        self._client.documents.pop(self._path, None)
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = deepcopy(data)
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return deepcopy(self._data)
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeQuery:
+    """
+    - collection_path: query a single collection
+    - collection_id + group: query every collection with that id, anywhere (collection_group)
+    """
+
+    def __init__(self, client, collection_path=None, collection_id=None, group=False):
+        self._client = client
+        self._collection_path = collection_path
+        self._collection_id = collection_id
+        self._group = group
+        self._filters = []
+        self._orders = []
+        self._limit = None
+        self._start_after = None
+
+    def _copy(self):
+        query = FakeQuery(self._client, self._collection_path, self._collection_id, self._group)
+        query._filters = list(self._filters)
+        query._orders = list(self._orders)
+        query._limit = self._limit
+        query._start_after = self._start_after
+        return query
+
+    def where(self, field, op, value):
+        query = self._copy()
+        query._filters.append((field, _FILTER_OPERATORS[op], value))
+        return query
+
+    def order_by(self, field, direction="ASCENDING"):
+        query = self._copy()
+        query._orders.append((field, direction))
+        return query
+
+    def limit(self, count):
+        query = self._copy()
+        query._limit = count
+        return query
+
+    def start_after(self, snapshot):
+        query = self._copy()
+        query._start_after = snapshot
+        return query
+
+    def _sort_key(self, path, data):
+        # like firestore, ties are broken by document path
+        return [data.get(field) for field, direction in self._orders] + [path]
+
+    def _matches_collection(self, path):
+        parts = path.split("/")
+        collection_path = "/".join(parts[:-1])
+        if self._group:
+            return parts[-2] == self._collection_id
+
+        return collection_path == self._collection_path
+
+    def stream(self):
+        self._client._rpc("query")
+        results = []
+        # copy, since other threads might be writing
+        for path, data in list(self._client.documents.items()):
+            if not self._matches_collection(path):
+                continue
+            if all(compare(data.get(field), value) for field, compare, value in self._filters):
+                results.append((path, data))
+
+        # apply orders from last to first, so the first order_by wins
+        results.sort(key=lambda item: item[0])
+        for field, direction in reversed(self._orders):
+            results.sort(key=lambda item: item[1].get(field), reverse=direction == "DESCENDING")
+
+        if self._start_after is not None:
+            # NOTE only handles ascending orders
+            cursor_key = self._sort_key(self._start_after.reference.path, self._start_after._data)
+            results = [item for item in results if self._sort_key(*item) > cursor_key]
+
+        if self._limit is not None:
+            results = results[:self._limit]
+
+        for path, data in results:
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path), data)
+
+    def get(self):
+        return list(self.stream())
+
+    def count(self, alias=None):
+        return _FakeCountQuery(self, alias)
+
+
+class _FakeCountQuery:
+    """
+    like the real AggregationQuery: get() returns [[AggregationResult]]
+    """
+
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias
+
+    def get(self):
+        self._query._client._rpc("count")
+        # not through stream(), so it doesn't count as a query
+        matches = [
+            path for path, data in list(self._query._client.documents.items())
+            if self._query._matches_collection(path) and all(compare(data.get(field), value) for field, compare, value in self._query._filters)
+        ]
+        return [[_FakeAggregationResult(self._alias, len(matches))]]
+
+
+class _FakeAggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append(("set", ref, data, merge))
+
+    def update(self, ref, data):
+        self._writes.append(("set", ref, data, True))
+
+    def delete(self, ref):
+        self._writes.append(("delete", ref, None, False))
+
+    def commit(self):
+        self._client._rpc("commit")
+        for action, ref, data, merge in self._writes:
+            if action == "set":
+                self._client._apply_set(ref._path, data, merge=merge)
+            else:
+                self._client.documents.pop(ref._path, None)
+
+        self._writes = []
+
+
+class FakeBucket:
+    """
+    stand-in for a google.cloud.storage Bucket
+    - blobs are kept in memory, by path
+    - rpc_counts counts each call that would have gone to storage
+    - latency_seconds: how long each call takes, for benchmarks
+    """
+
+    def __init__(self, blobs=None, latency_seconds=0):
+        self.blobs = dict(blobs or {})
+        self.rpc_counts = Counter()
+        self.latency_seconds = latency_seconds
+        self._lock = threading.Lock()
+
+    def _rpc(self, name):
+        _record_rpc(self, name)
+
+    def blob(self, path):
+        return FakeBlob(self, path)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def _data(self):
+        from google.api_core.exceptions import NotFound
+
+        if self.name not in self.bucket.blobs:
+            raise NotFound(f"No such object: {self.name}")
+
+        return self.bucket.blobs[self.name]
+
+    def exists(self):
+        self.bucket._rpc("exists")
+        return self.name in self.bucket.blobs
+
+    def download_as_bytes(self, start=None, end=None):
+        """
+        NOTE like the real thing, end is inclusive
+        """
+        self.bucket._rpc("download")
+        data = self._data()
+        start = start or 0
+        return data[start:None if end is None else end + 1]
+
+    def open(self, mode="rb", **kwargs):
+        if mode == "rb":
+            self.bucket._rpc("download")
+            return io.BytesIO(self._data())
+
+        return _FakeBlobWriter(self)
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket._rpc("upload")
+        self.bucket.blobs[self.name] = data if isinstance(data, bytes) else data.encode("utf-8")
+
+    def delete(self):
+        self.bucket._rpc("delete")
+        self._data()
+        del self.bucket.blobs[self.name]
+
+
+class _FakeBlobWriter(io.BytesIO):
+    """
+    like the real BlobWriter, nothing shows up in the bucket until it's closed
+    """
+    def __init__(self, blob):
+        super().__init__()
+        self._blob = blob
+
+    def close(self):
+        if not self.closed:
+            self._blob.upload_from_string(self.getvalue())
+        super().close()
+
+
+class FilesystemBucket(FakeBucket):
+    """
+    bucket backed by a local directory, for when we need real files (e.g., to run ffmpeg on)
+    """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+
+    def blob(self, path):
+        return FilesystemBlob(self, path)
+
+
+class FilesystemBlob(FakeBlob):
+    def _path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    def exists(self):
+        self.bucket._rpc("exists")
+        return os.path.exists(self._path())
+
+    def _data(self):
+        from google.api_core.exceptions import NotFound
+
+        if not os.path.exists(self._path()):
+            raise NotFound(f"No such object: {self.name}")
+
+        with open(self._path(), "rb") as f:
+            return f.read()
+
+    def open(self, mode="rb", **kwargs):
+        if mode == "rb":
+            self.bucket._rpc("download")
+            if not os.path.exists(self._path()):
+                self._data()
+            return open(self._path(), "rb")
+
+        return _FilesystemBlobWriter(self._path())
+
+    def generate_signed_url(self, **kwargs):
+        # ffmpeg reads local paths just like urls
+        return self._path()
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket._rpc("upload")
+        os.makedirs(os.path.dirname(self._path()), exist_ok=True)
+        with open(self._path(), "wb") as f:
+            f.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+
+    def delete(self):
+        self.bucket._rpc("delete")
+        self._data()
+        os.remove(self._path())
+
+
+class _FilesystemBlobWriter:
+    """
+    writes to a temp file next to the target, and only moves it into place when closed
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._file = open(f"{path}.partial", "wb")
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            os.replace(f"{self._path}.partial", self._path)
+
+
+class FakeSpeech:
+    """
+    stand-in for both the speech client (long_running_recognize) and operations_api (get_operation)
+    - swap the same instance in for both: clients.override("speech_client", speech) and clients.override("operations_api", speech)
+    - each operation moves forward progress_step percent every time it's checked, and once it's at 100 it's done with results_fn(operation name) as its results
+    - get_operation returns the same protobuf message the real operations client does, so helpers.get_operation (and MessageToDict) runs like it normally would
+    """
+
+    def __init__(self, results_fn=None, progress_step=50, latency_seconds=0):
+        self.results_fn = results_fn or (lambda name: [])
+        self.progress_step = progress_step
+        self.latency_seconds = latency_seconds
+        self.rpc_counts = Counter()
+        # operation name => progress percent
+        self.operations = {}
+        # operation name => packed results, built once. Real Google doesn't build them on every check either, so neither should we (e.g., when timing check_status)
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def _rpc(self, name):
+        _record_rpc(self, name)
+
+    def long_running_recognize(self, config, audio, retry=None):
+        self._rpc("long_running_recognize")
+        name = uuid.uuid4().hex
+        with self._lock:
+            self.operations[name] = 0
+
+        return _FakeOperationFuture(name)
+
+    def get_operation(self, name):
+        from google.cloud.speech_v1p1beta1.proto import cloud_speech_pb2
+        from google.longrunning import operations_pb2
+        from google.protobuf.json_format import ParseDict
+
+        self._rpc("get_operation")
+        with self._lock:
+            progress = self.operations[name] = min(self.operations[name] + self.progress_step, 100)
+
+        operation = operations_pb2.Operation(name=name, done=progress == 100)
+        metadata = cloud_speech_pb2.LongRunningRecognizeMetadata(progress_percent=progress)
+        metadata.start_time.GetCurrentTime()
+        metadata.last_update_time.GetCurrentTime()
+        operation.metadata.Pack(metadata)
+
+        if progress == 100:
+            if name not in self._responses:
+                self._responses[name] = ParseDict({"results": self.results_fn(name)}, cloud_speech_pb2.LongRunningRecognizeResponse())
+            operation.response.Pack(self._responses[name])
+
+        return operation
+
+
+class _FakeOperationFuture:
+    def __init__(self, name):
+        self.operation = _FakeOperation(name)
+
+
+class _FakeOperation:
+    def __init__(self, name):
+        self.name = name
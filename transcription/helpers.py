@@ -1,6 +1,7 @@
-# NOTE/TODO if ever import into more than one file, will need to conditionally initialize some of these services to make sure they only run once
+# NOTE clients (firestore, storage, speech) are built lazily by the ClientRegistry below, so it's fine to import this into as many files as we want
 import os
 import asyncio
+import threading
 from django.conf import settings
 import firebase_admin
 from firebase_admin import credentials
@@ -8,13 +9,15 @@ from firebase_admin import storage
 from firebase_admin import firestore
 from google.cloud import speech_v1p1beta1
 from google.cloud.speech_v1p1beta1 import enums
-from datetime import datetime
+from datetime import datetime, timezone
 from googleapiclient import discovery
 from google.api_core import operations_v1
+from google.protobuf.json_format import MessageToDict
 from oauth2client.client import GoogleCredentials
 from pprint import pprint
 from urllib3.exceptions import ProtocolError
 from google.api_core import retry
+from . import metrics
 
 
 # experiment with logging
@@ -40,12 +43,94 @@ default_key_location = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
 # don't need to set the credentials, everything is automatically derived from system GOOGLE_APPLICATION_CREDENTIALS env var. But if need a different credential, can set it 
 service_account = admin_key_location or default_key_location
 
-cred = credentials.Certificate(service_account)
-firebase_admin.initialize_app(cred, {
-    'storageBucket': BUCKET_NAME,
-    'projectId': APP_NAME,
-    'databaseURL': f"https://{APP_NAME}.firebaseio.com/",
-})
+class ClientRegistry:
+    """
+    Builds each Google client the first time it is actually used, rather than at import time
+    - so gunicorn workers, dyno cold starts and manage.py commands only pay for the clients they touch
+    - remembers which process built the clients. grpc channels (and the storage http session) made before a fork don't work in the child (e.g., gunicorn --preload), so if we find ourselves in a new process we throw them out and build them again
+    - tests and benchmarks can swap in their own client using override()
+    """
+
+    def __init__(self):
+        # name => function that builds the client
+        self._factories = {}
+        # name => client that was built in this process
+        self._clients = {}
+        # name => client that was swapped in, e.g., an in-memory fake. Survives forks
+        self._overrides = {}
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+
+    def get(self, name):
+        if name in self._overrides:
+            return self._overrides[name]
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # we were forked after building clients, so don't reuse the parent's
+                self.reset()
+
+            if name not in self._clients:
+                logger.debug(f"initializing client: {name}")
+                self._clients[name] = self._factories[name]()
+
+            return self._clients[name]
+
+    def is_initialized(self, name):
+        return name in self._clients and self._pid == os.getpid()
+
+    def override(self, name, client):
+        """
+        - use instead of whatever the factory would build. Pass in None to go back to the real client
+        """
+        if client is None:
+            self._overrides.pop(name, None)
+        else:
+            self._overrides[name] = client
+
+    def reset(self):
+        """
+        drop every client built so far. Next time one is used, it gets built again
+        """
+        self._clients = {}
+        self._pid = os.getpid()
+
+
+class LazyClient:
+    """
+    Stands in for a client from the registry, so that the rest of the code can keep doing e.g., `db.collection(...)`
+    - nothing gets initialized until an attribute is accessed
+    """
+
+    def __init__(self, name, registry):
+        # set through __dict__ so we don't hit our own __getattr__
+        self.__dict__["_name"] = name
+        self.__dict__["_registry"] = registry
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._name), attr)
+
+    def __repr__(self):
+        return f"<LazyClient {self._name}>"
+
+
+clients = ClientRegistry()
+# child processes (e.g., gunicorn workers) should never use the clients their parent built
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=clients.reset)
+
+
+def _init_firebase_app():
+    cred = credentials.Certificate(service_account)
+    # name the app by process, since firebase_admin caches the storage client on the app, and we don't want the child to get the parent's one after a fork
+    return firebase_admin.initialize_app(cred, {
+        'storageBucket': BUCKET_NAME,
+        'projectId': APP_NAME,
+        'databaseURL': f"https://{APP_NAME}.firebaseio.com/",
+    }, name=f"{APP_NAME}-{os.getpid()}")
 
 # for getting operation_futures
 # don't know if this will work, officially they have sample like so: 
@@ -56,38 +141,46 @@ firebase_admin.initialize_app(cred, {
 # but trying to use the firebase admin creds for now
 # google_api_service = discovery.build('cloudresourcemanager', 'v1', credentials=credentials)
 
-# not sure why, but doing admin.firestore.Client() doesn't work on its own
-# NOTE should now, we're setting the GOOGLE_APPLICATION_CREDENTIALS now
-db = firestore.Client.from_service_account_json(service_account)
-
 # alias so don't have to write out the beta part
 # for now only using the beta
-
 speech = speech_v1p1beta1
-speech_client = speech.SpeechClient.from_service_account_json(service_account)
 
-operations_api = operations_v1.OperationsClient(speech_client.transport.channel)
-def get_operation_old(operation_name):
-    """
-    - I'm currently not using this, but reserving this code for future use especially since it is difficult to locate within the documentation
-    - Borrowing code from https://github.com/googleapis/python-speech/issues/8
-    - To get metadata: get_operation(name).metadata
-    """
-    op = operations_api.get_operation(operation_name)
-    return op
+clients.register("firebase_app", _init_firebase_app)
+# not sure why, but doing admin.firestore.Client() doesn't work on its own
+# NOTE should now, we're setting the GOOGLE_APPLICATION_CREDENTIALS now
+clients.register("db", lambda: firestore.Client.from_service_account_json(service_account))
+clients.register("speech_client", lambda: speech.SpeechClient.from_service_account_json(service_account))
+# shares the speech client's channel
+clients.register("operations_api", lambda: operations_v1.OperationsClient(clients.get("speech_client").transport.channel))
+clients.register("bucket", lambda: storage.bucket(app=clients.get("firebase_app")))
+
+db = LazyClient("db", clients)
+speech_client = LazyClient("speech_client", clients)
+operations_api = LazyClient("operations_api", clients)
+bucket = LazyClient("bucket", clients)
 
 def get_operation(operation_name):
     """
     - Borrowing code from https://github.com/googleapis/python-speech/issues/8
     - operation returned is similar to what is returned by the original long-running request, but is a dict
+    - goes through operations_api, which shares the speech client's grpc channel. So every poll reuses the same pooled connection, instead of fetching/parsing the discovery doc and making a new http client each time (see get_operation_via_discovery)
+    - the dict is the same shape the REST api returns (camelCase keys, e.g., metadata.progressPercent), so callers don't need to care which one we used
+    """
+    with metrics.external_call("speech", "get_operation"):
+        operation = operations_api.get_operation(operation_name)
+
+    return MessageToDict(operation)
+
+def get_operation_via_discovery(operation_name):
+    """
+    - what get_operation used to do. Builds a new discovery client on every call
+    - not used by the app anymore, but kept so benchmarks/operations.py can compare against it
     """
     speech_service = discovery.build('speech', 'v1p1beta1')
     request = speech_service.operations().get(name=operation_name)
     operation_dict = request.execute()
     return operation_dict
 
-bucket = storage.bucket()
-
 cwd = os.getcwd()
 destination_filename = cwd + "/tmp/"
 
@@ -96,9 +189,15 @@ destination_filename = cwd + "/tmp/"
 FILE_TYPES = ["flac", "mp3", "wav", "mpeg", "x-wav"] 
 file_types_sentence = ", ".join(FILE_TYPES[0:-1]) + ", and " + FILE_TYPES[-1]
 
+# these get converted to flac before sending to Google, if we can (see TranscribeRequest.makeItFlac)
+TRANSCODE_TO_FLAC_TYPES = ["mp3", "mpeg", "wav", "x-wav"]
+
 # not using right now
 # isDev = settings.ENV == "DEVELOPMENT"
 
+# subcollection of each transcribeRequests doc
+EVENT_LOGS_COLLECTION = "eventLogs"
+
 REQUEST_TYPES = [
     "initial-request", 
     "continue-transcribing-request",
@@ -168,11 +267,32 @@ def timestamp():
     return datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") 
 
 
+def utc_now():
+    # timezone aware, like the datetimes firestore gives back
+    return datetime.now(timezone.utc)
+
+
+def parse_timestamp(string):
+    """
+    takes what timestamp() returns, gives back a datetime
+    """
+    return datetime.strptime(string, "%Y%m%dT%H%M%SZ")
+
+
+def seconds_since(string):
+    """
+    real seconds since a timestamp() string (only to the second, like the string)
+    """
+    return (datetime.utcnow() - parse_timestamp(string)).total_seconds()
+
+
 def to_timestamp(string):
     """
-    NOTE only takes strings in one format for now
+    takes RFC 3339 strings like Google sends, e.g., '2020-04-25T21:22:07.436054Z'
+    - the fractional seconds get left off when they're zero, e.g., '2020-04-25T21:22:07Z'
     """
-    date_time_obj = datetime.strptime(string, '%Y-%m-%dT%H:%M:%S.%fZ')
+    time_format = '%Y-%m-%dT%H:%M:%S.%fZ' if "." in string else '%Y-%m-%dT%H:%M:%SZ'
+    date_time_obj = datetime.strptime(string, time_format)
     return date_time_obj.strftime("%Y%m%dT%H%M%SZ") 
 
 # derived from https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348, to reset if "reset by peer connection" or whatever
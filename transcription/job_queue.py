@@ -0,0 +1,268 @@
+"""
+Queue for work that shouldn't happen inside the web request (validating, converting to flac, sending to Google)
+- web process enqueues and returns right away. The worker process (python manage.py run_jobs, see jobs.py) claims jobs and runs them
+- JobQueue is what everything else uses. SQLiteJobQueue is the only implementation for now, so web and worker have to share a filesystem, i.e., run locally or on a single dyno (on Heroku, config/gunicorn.py starts the worker inside the web dyno). Register something else as "job_queue" to use something else
+- workers write a heartbeat to the queue. If no worker has in a while (e.g., it's on another dyno with its own disk, or it died), the web process doesn't enqueue and does the work itself (see jobs.should_enqueue)
+- at least once: claiming a job hides it for JOB_QUEUE["VISIBILITY_TIMEOUT_SECONDS"]. If the worker doesn't finish (or extend) it by then, e.g., because it died, another worker gets it. So jobs have to be ok running twice
+- a job that keeps failing gets retried with backoff, then after JOB_QUEUE["MAX_ATTEMPTS"] it's dead and stays in the table to look at
+"""
+import abc
+import sqlite3
+import time
+import uuid
+from django.conf import settings
+from .helpers import *
+from . import retry_policy
+logger = logging.getLogger('testlogger')
+
+JOB_STATES = [
+    "queued",
+    "running",
+    "done",
+    "dead",
+]
+
+
+class Job:
+    """
+    one claimed job
+    - stage is the request's TRANSCRIPTION_STATUSES stage the job had gotten to, so a retry can tell where it left off
+    """
+    __slots__ = ("id", "kind", "payload", "stage", "attempts", "lease_id")
+
+    def __init__(self, id, kind, payload, stage, attempts, lease_id):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.stage = stage
+        self.attempts = attempts
+        self.lease_id = lease_id
+
+
+class JobQueue(abc.ABC):
+    """
+    what a queue needs to do. See SQLiteJobQueue for what each one means
+    """
+
+    @abc.abstractmethod
+    def enqueue(self, kind, payload, stage=None):
+        pass
+
+    @abc.abstractmethod
+    def claim(self, limit=1):
+        pass
+
+    @abc.abstractmethod
+    def extend(self, job):
+        pass
+
+    @abc.abstractmethod
+    def set_stage(self, job, stage):
+        pass
+
+    @abc.abstractmethod
+    def complete(self, job):
+        pass
+
+    @abc.abstractmethod
+    def fail(self, job, error):
+        pass
+
+    @abc.abstractmethod
+    def counts(self):
+        pass
+
+    @abc.abstractmethod
+    def heartbeat(self, worker_id):
+        pass
+
+    @abc.abstractmethod
+    def has_worker(self, within_seconds):
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    every job is a row in a sqlite table. Claiming is one write transaction, so two workers (threads or processes) never get the same job at the same time
+    """
+
+    def __init__(self, path=None, visibility_timeout=None, max_attempts=None):
+        config = settings.JOB_QUEUE
+        self.path = path or config["PATH"]
+        self.visibility_timeout = visibility_timeout or config["VISIBILITY_TIMEOUT_SECONDS"]
+        self.max_attempts = max_attempts or config["MAX_ATTEMPTS"]
+        # sqlite connections can't be shared between threads, so each thread gets its own
+        self._local = threading.local()
+        self._create_table()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # we do our own transactions (see _transaction)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            if self.path != ":memory:":
+                # readers don't block the writer, so the web process can enqueue while the worker claims
+                connection.execute("PRAGMA journal_mode=WAL")
+
+            self._local.connection = connection
+
+        return connection
+
+    def _transaction(self, fn):
+        """
+        runs fn(connection) in a write transaction. BEGIN IMMEDIATE takes the write lock up front, so nobody can claim the same rows in between our select and our update
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(connection)
+            connection.execute("COMMIT")
+            return result
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _create_table(self):
+        connection = self._connection()
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                stage TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                -- can't be claimed before this. For queued jobs it's for backoff, for running ones it's when the lease runs out
+                available_at REAL NOT NULL,
+                lease_id TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (state, available_at);
+            -- one row per worker process, so the web process can tell if anyone's claiming from this file
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            );
+        """)
+
+    def enqueue(self, kind, payload, stage=None):
+        """
+        returns the new job's id
+        """
+        now = time.time()
+        def insert(connection):
+            cursor = connection.execute(
+                "INSERT INTO jobs (kind, payload, state, stage, available_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), JOB_STATES[0], stage, now, now, now),
+            )
+            return cursor.lastrowid
+
+        return self._transaction(insert)
+
+    def claim(self, limit=1):
+        """
+        returns up to limit jobs that are queued, or whose lease ran out, and hides them for visibility_timeout
+        """
+        now = time.time()
+        def claim_rows(connection):
+            rows = connection.execute(
+                "SELECT id, kind, payload, state, stage, attempts FROM jobs WHERE state IN (?, ?) AND available_at <= ? ORDER BY available_at LIMIT ?",
+                (JOB_STATES[0], JOB_STATES[1], now, limit),
+            ).fetchall()
+
+            jobs = []
+            for row in rows:
+                if row["state"] == JOB_STATES[1] and row["attempts"] >= self.max_attempts:
+                    # lease ran out on its last attempt, e.g., it keeps killing the worker. Don't keep handing it out
+                    connection.execute(
+                        "UPDATE jobs SET state = ?, lease_id = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                        (JOB_STATES[3], "lease ran out", now, row["id"]),
+                    )
+                    logger.error(f"job {row['id']} ran out of attempts without finishing")
+                    continue
+
+                # new lease every claim, so a worker whose lease ran out can't finish a job someone else has now
+                lease_id = uuid.uuid4().hex
+                connection.execute(
+                    "UPDATE jobs SET state = ?, attempts = attempts + 1, available_at = ?, lease_id = ?, updated_at = ? WHERE id = ?",
+                    (JOB_STATES[1], now + self.visibility_timeout, lease_id, now, row["id"]),
+                )
+                jobs.append(Job(row["id"], row["kind"], json.loads(row["payload"]), row["stage"], row["attempts"] + 1, lease_id))
+
+            return jobs
+
+        return self._transaction(claim_rows)
+
+    def _update_leased(self, job, assignments, values):
+        """
+        only touches the job if we still hold its lease. Returns False if we don't
+        """
+        def update(connection):
+            cursor = connection.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND lease_id = ? AND state = ?",
+                (*values, time.time(), job.id, job.lease_id, JOB_STATES[1]),
+            )
+            return cursor.rowcount == 1
+
+        held = self._transaction(update)
+        if not held:
+            logger.info(f"lost lease on job {job.id}, someone else has it now")
+
+        return held
+
+    def extend(self, job):
+        """
+        still working on it, so keep it hidden for another visibility_timeout
+        """
+        return self._update_leased(job, "available_at = ?", (time.time() + self.visibility_timeout,))
+
+    def set_stage(self, job, stage):
+        job.stage = stage
+        return self._update_leased(job, "stage = ?", (stage,))
+
+    def complete(self, job):
+        return self._update_leased(job, "state = ?, lease_id = NULL", (JOB_STATES[2],))
+
+    def fail(self, job, error):
+        """
+        puts it back in the queue after a backoff, or marks it dead if it's out of attempts
+        - returns True if it's dead
+        """
+        if job.attempts >= self.max_attempts:
+            self._update_leased(job, "state = ?, lease_id = NULL, last_error = ?", (JOB_STATES[3], str(error)))
+            return True
+
+        delay = retry_policy.backoff_delay(job.attempts - 1)
+        self._update_leased(job, "state = ?, lease_id = NULL, available_at = ?, last_error = ?", (JOB_STATES[0], time.time() + delay, str(error)))
+        return False
+
+    def counts(self):
+        """
+        number of jobs in each state
+        """
+        rows = self._connection().execute("SELECT state, COUNT(*) AS count FROM jobs GROUP BY state").fetchall()
+        return {**{state: 0 for state in JOB_STATES}, **{row["state"]: row["count"] for row in rows}}
+
+    def heartbeat(self, worker_id):
+        """
+        worker is still claiming jobs from this file
+        """
+        now = time.time()
+        self._transaction(lambda connection: connection.execute(
+            "INSERT INTO workers (id, seen_at) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET seen_at = excluded.seen_at",
+            (worker_id, now),
+        ))
+
+    def has_worker(self, within_seconds):
+        """
+        True if some worker sent a heartbeat in the last within_seconds
+        - just a read, so it doesn't wait on the write lock
+        """
+        row = self._connection().execute("SELECT MAX(seen_at) AS seen_at FROM workers").fetchone()
+        return row["seen_at"] is not None and row["seen_at"] >= time.time() - within_seconds
+
+
+clients.register("job_queue", SQLiteJobQueue)
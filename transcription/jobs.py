@@ -0,0 +1,205 @@
+"""
+What the worker does with each job from the queue (see job_queue.py), and the loop that runs them
+- "transcribe" job: same steps as the request-transcribe/ view (mark as received, validate, convert to flac, send to Google), just not inside the web request
+- jobs can run more than once (at least once delivery), so each step checks how far the job already got (job.stage, which follows TRANSCRIPTION_STATUSES) and skips what's done
+- validation failing won't get better by retrying, so that marks the request as errored and the job is done. Anything else gets retried, and if it runs out of attempts the request is marked as errored
+"""
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .helpers import *
+from .transcribe_class import TranscribeRequest
+# registers the "job_queue" client
+from . import job_queue as _job_queue
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+JOB_KINDS = [
+    "transcribe",
+]
+
+
+def _job_counts():
+    # without the queue, there's no sqlite file to count from (and no reason to make one)
+    return clients.get("job_queue").counts() if settings.JOB_QUEUE["ENABLED"] else {}
+
+
+metrics.register_stats("jobs", _job_counts)
+
+
+def should_enqueue():
+    """
+    True if the queue is on and some worker is claiming from it. Otherwise the web process does the work itself
+    - e.g., with the sqlite queue on Heroku, a worker dyno has its own disk and would never see what the web dyno enqueues
+    """
+    config = settings.JOB_QUEUE
+    if not config["ENABLED"]:
+        return False
+
+    # a few missed heartbeats before giving up on it
+    if clients.get("job_queue").has_worker(config["HEARTBEAT_SECONDS"] * 3):
+        return True
+
+    logger.warning(f"job queue is on, but no worker has claimed from {config['PATH']} lately. Running the job in the web process")
+    return False
+
+
+def enqueue_transcribe(file_data):
+    """
+    what the web process does instead of transcribing. Returns the job id
+    """
+    return clients.get("job_queue").enqueue(JOB_KINDS[0], file_data)
+
+
+def run_transcribe(job, job_queue):
+    transcribe_request = TranscribeRequest(job.payload)
+    # nobody's waiting on a response, so can wait longer between tries with Google
+    transcribe_request.retry_wait_seconds = settings.RETRY["BUDGET_SECONDS"]
+    transcribe_request.admission_wait_seconds = settings.ADMISSION["MAX_WAIT_SECONDS"]
+    transcribe_request.transcode_timeout_seconds = settings.TRANSCODING["TIMEOUT_SECONDS"]
+
+    if job.stage is None:
+        transcribe_request.mark_as_received()
+        job_queue.set_stage(job, transcribe_request.status)
+
+    else:
+        # tried before, so see how far it got. We marked it as received, so anything past that is from this job
+        transcribe_request.refresh_from_db()
+        if transcribe_request.status != TRANSCRIPTION_STATUSES[2]: # processing-file
+            logger.info(f"job {job.id} already got {transcribe_request.id} to {transcribe_request.status}")
+            return
+
+    try:
+        transcribe_request.validate_request()
+    except Exception as error:
+        transcribe_request.mark_as_server_error(error)
+        return
+
+    # errors from Google get handled (and marked) in here. What raises is e.g., converting to flac failing, and that's worth another try
+    transcribe_request.send_to_google()
+    job_queue.set_stage(job, transcribe_request.status)
+
+
+def fail_transcribe(job):
+    """
+    out of attempts, so let the user know
+    """
+    transcribe_request = TranscribeRequest(job.payload)
+    transcribe_request.mark_as_server_error(Exception("Server couldn't process this file, please try again"))
+
+
+HANDLERS = {
+    JOB_KINDS[0]: (run_transcribe, fail_transcribe),
+}
+
+
+class JobWorker:
+    """
+    claims jobs and runs them in a pool of threads, at most threads at a time
+    - while a job runs, keeps extending its lease so nobody else picks it up
+    """
+
+    def __init__(self, job_queue=None, threads=None, poll_seconds=None):
+        config = settings.JOB_QUEUE
+        self.job_queue = job_queue or clients.get("job_queue")
+        self.threads = threads or config["WORKER_THREADS"]
+        self.poll_seconds = poll_seconds or config["POLL_SECONDS"]
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="jobs")
+        # job id => (job, future)
+        self.running = {}
+        self.last_extended_at = time.monotonic()
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat_seconds = config["HEARTBEAT_SECONDS"]
+        self.last_heartbeat_at = None
+
+    def run_forever(self):
+        logger.info(f"running jobs with {self.threads} threads")
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # e.g., sqlite locked for too long. Don't let it kill the worker
+                logger.error(traceback.format_exc())
+
+            time.sleep(self.poll_seconds)
+
+    def run_once(self):
+        """
+        one cycle: clean up finished jobs, keep leases of running ones, and claim as many as we have room for
+        - returns the number of jobs claimed
+        """
+        for job_id, (job, future) in list(self.running.items()):
+            if future.done():
+                del self.running[job_id]
+
+        self.heartbeat()
+        self.extend_leases()
+
+        room = self.threads - len(self.running)
+        if room <= 0:
+            return 0
+
+        jobs = self.job_queue.claim(limit=room)
+        for job in jobs:
+            self.running[job.id] = (job, self.executor.submit(self.run_job, job))
+
+        return len(jobs)
+
+    def heartbeat(self):
+        # so the web process knows someone's claiming what it enqueues
+        if self.last_heartbeat_at is not None and time.monotonic() - self.last_heartbeat_at < self.heartbeat_seconds:
+            return
+
+        self.job_queue.heartbeat(self.worker_id)
+        self.last_heartbeat_at = time.monotonic()
+
+    def extend_leases(self):
+        # well before they run out
+        if time.monotonic() - self.last_extended_at < self.job_queue.visibility_timeout / 3:
+            return
+
+        for job, _ in list(self.running.values()):
+            self.job_queue.extend(job)
+
+        self.last_extended_at = time.monotonic()
+
+    def run_job(self, job):
+        """
+        runs one job, and marks it done, or failed
+        - returns True if it finished
+        """
+        run, on_dead = HANDLERS[job.kind]
+        try:
+            run(job, self.job_queue)
+            self.job_queue.complete(job)
+            return True
+
+        except Exception as error:
+            logger.error(f"job {job.id} ({job.kind}) failed on attempt {job.attempts}")
+            logger.error(traceback.format_exc())
+            is_dead = self.job_queue.fail(job, error)
+            if is_dead:
+                try:
+                    on_dead(job)
+                except Exception:
+                    logger.error(traceback.format_exc())
+
+            return False
+
+    def drain(self):
+        """
+        runs every job that's ready, and waits for them. For tests and the --once flag
+        - returns the number of jobs run
+        """
+        count = 0
+        while True:
+            claimed = self.run_once()
+            for job, future in list(self.running.values()):
+                future.result()
+
+            if claimed == 0 and not self.running:
+                return count
+
+            count += claimed
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from transcription.poller import OperationPoller
+
+
+class Command(BaseCommand):
+    help = "Polls Google for the progress of every transcribing request. Runs as the worker process"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="run a single polling cycle and exit")
+        parser.add_argument("--max-workers", type=int, help="max number of operations to check at the same time")
+
+    def handle(self, *args, **options):
+        poller = OperationPoller(max_workers=options["max_workers"])
+
+        if options["once"]:
+            checked = poller.poll_once()
+            self.stdout.write(f"checked {checked} operations")
+        else:
+            poller.run_forever()
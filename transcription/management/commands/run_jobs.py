@@ -0,0 +1,61 @@
+import multiprocessing
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from transcription.jobs import JobWorker
+from transcription.poller import OperationPoller
+from transcription.storage_cleanup import StorageSweeper
+from transcription.stuck_requests import StuckRequestSweeper
+
+
+def _run_worker(threads):
+    JobWorker(threads=threads).run_forever()
+
+
+class Command(BaseCommand):
+    help = "Runs jobs from the job queue (and polls Google for transcribing requests, like poll_operations, retries failed storage deletes, and resumes stuck requests). Runs as the worker process"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="run every job that's ready, then exit")
+        parser.add_argument("--threads", type=int, help="max number of jobs running at the same time, per process")
+        parser.add_argument("--processes", type=int, help="number of processes running jobs, each with --threads threads")
+        parser.add_argument("--no-poller", action="store_true", help="don't poll Google for progress in this process")
+        parser.add_argument("--no-sweeper", action="store_true", help="don't retry failed storage deletes in this process")
+        parser.add_argument("--no-stuck-sweeper", action="store_true", help="don't resume stuck requests in this process")
+        parser.add_argument("--no-jobs", action="store_true", help="don't run jobs from the queue, just the poller and sweepers. E.g., for a worker dyno, which can't see the web dyno's sqlite file")
+
+    def handle(self, *args, **options):
+        threads = options["threads"] or settings.JOB_QUEUE["WORKER_THREADS"]
+
+        if options["once"]:
+            count = JobWorker(threads=threads).drain()
+            self.stdout.write(f"ran {count} jobs")
+            return
+
+        processes = 0 if options["no_jobs"] else options["processes"] or settings.JOB_QUEUE["WORKER_PROCESSES"]
+        # e.g., converting to flac is mostly ffmpeg, which already runs in its own process, so threads are usually enough
+        # NOTE fork these before starting any threads (or making any clients), since a forked child only gets the thread that forked it. A lock some other thread was holding (logging, grpc...) would stay locked in the child forever
+        fork = multiprocessing.get_context("fork")
+        children = [fork.Process(target=_run_worker, args=(threads,), daemon=True) for _ in range(processes - 1)]
+        for child in children:
+            child.start()
+
+        if settings.OPERATION_POLLER["ENABLED"] and not options["no_poller"]:
+            # one poller for the whole worker, not one per process
+            threading.Thread(target=OperationPoller().run_forever, name="poller", daemon=True).start()
+
+        if not options["no_sweeper"]:
+            threading.Thread(target=StorageSweeper().run_forever, name="sweeper", daemon=True).start()
+
+        if settings.STUCK_REQUESTS["ENABLED"] and not options["no_stuck_sweeper"]:
+            threading.Thread(target=StuckRequestSweeper().run_forever, name="stuck-sweeper", daemon=True).start()
+
+        if options["no_jobs"]:
+            # the threads above are daemons, so just keep the process alive for them
+            while True:
+                time.sleep(60)
+
+        _run_worker(threads)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from transcription.stuck_requests import StuckRequestSweeper
+
+
+class Command(BaseCommand):
+    help = "Resumes (or gives up on) requests that have stopped partway, e.g., because the browser went away. Runs in the worker process (run_jobs) too"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="sweep once and exit, e.g., from a scheduler")
+        parser.add_argument("--batch-size", type=int, help="max number of requests to look at per status")
+
+    def handle(self, *args, **options):
+        sweeper = StuckRequestSweeper(batch_size=options["batch_size"])
+
+        if options["once"]:
+            resumed, failed = sweeper.sweep_once()
+            self.stdout.write(f"resumed {resumed}, gave up on {failed}")
+        else:
+            sweeper.run_forever()
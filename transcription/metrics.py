@@ -0,0 +1,270 @@
+"""
+Counters and histograms for where the time goes, served in Prometheus' text format at metrics/ (see views.prometheus_metrics)
+- external_call_seconds: every call to firestore, storage and Google's speech api that a request makes, timed with a monotonic clock
+- status_seconds: how long requests spend in each of TRANSCRIPTION_STATUSES before moving on to the next one (see TranscribeRequest._update_status)
+- plus whatever the other modules already count (admission.stats(), retry_policy.stats(), the user cache...), added with register_stats, and read when scraped
+- per process, like admission and the caches. So if running several gunicorn workers, each one only knows about its own requests
+- NOTE doesn't import helpers, so helpers (and everything else) can import this
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+logger = logging.getLogger('testlogger')
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "transcription_"
+
+# seconds. Firestore and storage calls are usually in the tens of ms, Google's are more
+CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# seconds. Transcribing takes minutes, sometimes hours
+STATUS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = PREFIX + name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        # label values tuple => value
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._render_one(list(zip(self.label_names, key)), self._values[key]))
+
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_one(self, labels, value):
+        return [f"{self.name}{_format_labels(labels)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """
+    buckets are upper bounds, like Prometheus. Counts are stored per bucket, and added up when rendering
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=CALL_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            # last slot is for anything over the biggest bucket
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def snapshot(self, **labels):
+        """
+        {"count", "sum", "buckets": {upper bound: cumulative count}}
+        """
+        with self._lock:
+            counts, total = self._values.get(self._key(labels), ([0] * (len(self.buckets) + 1), 0))
+
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            cumulative[bound] = running
+
+        return {"count": running, "sum": total, "buckets": cumulative}
+
+    def _render_one(self, labels, value):
+        counts, total = value
+        lines = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {running}")
+
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {running}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        # prefix => (stats function, label name for nested dicts)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            # so importing a module twice (or defining the same metric in two places) doesn't make two
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=CALL_BUCKETS):
+        return self._add(Histogram(name, help_text, label_names, buckets))
+
+    def register_stats(self, prefix, stats_fn, label_name="name"):
+        """
+        stats_fn returns a dict like admission.stats(). Each number becomes a gauge named <prefix>_<key>
+        - a dict of numbers (e.g., retry_policy.stats()["errors"]) becomes one gauge, with the dict's keys as label_name
+        - only called when scraped, so keep it cheap
+        """
+        with self._lock:
+            self._stats[prefix] = (stats_fn, label_name)
+
+    def _render_stats(self):
+        lines = []
+        with self._lock:
+            stats = sorted(self._stats.items())
+
+        for prefix, (stats_fn, label_name) in stats:
+            try:
+                values = stats_fn()
+            except Exception as error:
+                # one broken stats function shouldn't take the rest down with it
+                logger.error(f"couldn't get stats for {prefix}")
+                logger.error(error)
+                continue
+
+            for key, value in sorted(values.items()):
+                name = f"{PREFIX}{prefix}_{key}"
+                if isinstance(value, dict):
+                    samples = [(_format_labels([(label_name, label)]), count) for label, count in sorted(value.items())]
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    samples = [("", value)]
+                else:
+                    continue
+
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(f"{name}{labels} {_format_value(count)}" for labels, count in samples)
+
+        return lines
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        lines.extend(self._render_stats())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        zeroes every metric (e.g., between tests). Stats functions stay registered
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        for metric in metrics:
+            metric.reset()
+
+
+registry = Registry()
+
+external_call_seconds = registry.histogram(
+    "external_call_seconds",
+    "Seconds spent in each call to firestore, storage or Google's speech api",
+    ["service", "operation"],
+)
+external_call_errors = registry.counter(
+    "external_call_errors_total",
+    "Calls to firestore, storage or Google's speech api that raised",
+    ["service", "operation"],
+)
+status_seconds = registry.histogram(
+    "status_seconds",
+    "Seconds a request spent in a status before moving to the next one",
+    ["status"],
+    buckets=STATUS_BUCKETS,
+)
+status_changes = registry.counter(
+    "status_changes_total",
+    "Requests moved into each status",
+    ["status"],
+)
+
+
+@contextmanager
+def external_call(service, operation):
+    """
+    with metrics.external_call("firestore", "get"):
+        ref.get()
+    """
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        external_call_errors.inc(service=service, operation=operation)
+        raise
+    finally:
+        external_call_seconds.observe(time.monotonic() - start, service=service, operation=operation)
+
+
+def register_stats(prefix, stats_fn, label_name="name"):
+    registry.register_stats(prefix, stats_fn, label_name)
+
+
+def render():
+    return registry.render()
+
+
+def reset():
+    registry.reset()
@@ -0,0 +1,158 @@
+"""
+Background poller for Google's long running operations
+- runs in the worker process (see Procfile), so it's the only thing that asks Google about progress. check_status then just reads what we have in firestore (unless we haven't checked on it in a while, see TranscribeRequest.should_check_with_google)
+- polls each operation at most once per interval, no matter how many browser tabs are watching it
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .helpers import *
+from .transcribe_class import TranscribeRequest
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+
+class OperationSchedule:
+    """
+    keeps track of when to next check on a single operation
+    - starts at the min interval, and every time we check and nothing changed we wait twice as long (up to the max interval)
+    - as soon as progress moves, go back to the min interval
+    """
+
+    def __init__(self, min_interval, max_interval, now):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.next_check_at = now
+        self.last_progress = None
+
+    def is_due(self, now):
+        return now >= self.next_check_at
+
+    def record_check(self, progress_percent, now):
+        if progress_percent is not None and progress_percent != self.last_progress:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+        self.last_progress = progress_percent
+        self.next_check_at = now + self.interval
+
+
+class OperationPoller:
+    """
+    keeps track of every request that is transcribing, and checks its operation with Google when it's due
+    - asks firestore which requests are transcribing every refresh_interval, not every tick. In between, it checks the ones it already knows about
+    - at most max_workers operations are checked at a time
+    - check_transcription_progress handles persisting progress and processing the transcript once Google is done
+    """
+
+    def __init__(self, min_interval=None, max_interval=None, max_workers=None, tick=None, refresh_interval=None):
+        config = settings.OPERATION_POLLER
+        self.min_interval = min_interval or config["MIN_INTERVAL_SECONDS"]
+        self.max_interval = max_interval or config["MAX_INTERVAL_SECONDS"]
+        self.max_workers = max_workers or config["MAX_WORKERS"]
+        self.tick = tick or config["TICK_SECONDS"]
+        self.refresh_interval = refresh_interval or config["REFRESH_SECONDS"]
+
+        # (user id, request id) => TranscribeRequest. Request ids are only unique per user
+        self.transcribe_requests = {}
+        # (user id, request id) => OperationSchedule
+        self.schedules = {}
+        self.refreshed_at = None
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def run_forever(self):
+        logger.info(f"polling operations every {self.min_interval}-{self.max_interval}s with {self.max_workers} workers")
+        while True:
+            try:
+                self.poll_once()
+            except Exception:
+                # don't let one bad cycle (e.g., firestore hiccup) kill the worker
+                logger.error(traceback.format_exc())
+
+            time.sleep(self.tick)
+
+    def poll_once(self):
+        """
+        one cycle: find transcribing requests (if it's time to), and check the ones that are due
+        - returns the number of operations we checked
+        """
+        now = time.monotonic()
+        if self.refreshed_at is None or now - self.refreshed_at >= self.refresh_interval:
+            self.transcribe_requests = {_key(transcribe_request): transcribe_request for transcribe_request in self.find_transcribing_requests()}
+            self.refreshed_at = now
+            # stop tracking anything that isn't transcribing anymore
+            self._prune()
+
+        due = []
+        for key, transcribe_request in self.transcribe_requests.items():
+            schedule = self.schedules.setdefault(key, OperationSchedule(self.min_interval, self.max_interval, now))
+            if schedule.is_due(now):
+                due.append(transcribe_request)
+
+        # wait for every check to finish before the next cycle, so there's never more than one call in flight per operation
+        progress_by_key = dict(self.executor.map(self.check_one, due))
+
+        finished_at = time.monotonic()
+        for key, progress_percent in progress_by_key.items():
+            self.schedules[key].record_check(progress_percent, finished_at)
+
+        # done (or errored) since we last asked firestore. No need to wait for the next refresh to stop checking on them
+        for transcribe_request in due:
+            if transcribe_request.status != TRANSCRIPTION_STATUSES[3]: # transcribing
+                del self.transcribe_requests[_key(transcribe_request)]
+        self._prune()
+
+        return len(due)
+
+    def _prune(self):
+        for key in list(self.schedules):
+            if key not in self.transcribe_requests:
+                del self.schedules[key]
+
+    def find_transcribing_requests(self):
+        """
+        - NOTE collection group queries need the single field index on transcribeRequests.status enabled for collection group scope
+        """
+        query = db.collection_group("transcribeRequests").where("status", "==", TRANSCRIPTION_STATUSES[3]) # transcribing
+        transcribe_requests = []
+
+        with metrics.external_call("firestore", "query"):
+            docs = list(query.stream())
+
+        for doc in docs:
+            try:
+                transcribe_request = TranscribeRequest.from_document(doc)
+            except Exception:
+                # one bad doc shouldn't stop us from checking on everyone else
+                logger.error(f"couldn't read transcribe request {doc.reference.path}")
+                logger.error(traceback.format_exc())
+                continue
+
+            if not transcribe_request.transaction_id:
+                # nothing to ask Google about yet
+                continue
+
+            transcribe_requests.append(transcribe_request)
+
+        return transcribe_requests
+
+    def check_one(self, transcribe_request):
+        """
+        returns (key, progress percent). Progress is None if we errored
+        """
+        try:
+            transcribe_request.check_transcription_progress()
+            progress_percent = transcribe_request.transcript_metadata.get("progress_percent")
+
+        except Exception as error:
+            logger.error(f"error checking progress for {transcribe_request.id}")
+            logger.error(traceback.format_exc())
+            progress_percent = None
+
+        return _key(transcribe_request), progress_percent
+
+
+def _key(transcribe_request):
+    return (transcribe_request.user_id, transcribe_request.id)
@@ -0,0 +1,351 @@
+"""
+Pushing a request's status and progress to clients as server-sent events (the progress/ endpoint), instead of them polling check-status/
+- one watcher per request, per process. It reads the request (and asks Google, if the poller worker is off, same as check-status does) every PROGRESS_STREAM["POLL_SECONDS"], and sends each change to everyone subscribed. So N browser tabs watching one request cost the same as one
+- each event is the whole current state, not a diff:
+    id: 3f2a...
+    event: progress
+    data: {"status": "transcribing", "progress_percent": 40, "updated_at": "20200425T212207Z", "error": ""}
+- event ids come from the state itself, so a client reconnecting with Last-Event-ID only gets what it hasn't seen, even if it lands on a new watcher (or another dyno)
+- sends a comment every PROGRESS_STREAM["HEARTBEAT_SECONDS"] so proxies (e.g., heroku's router, which drops connections idle for 55s) keep the connection open
+- stream ends once the request is done or errored, or after PROGRESS_STREAM["MAX_STREAM_SECONDS"] (the client's EventSource reconnects on its own)
+"""
+import asyncio
+import hashlib
+import queue
+import time
+from collections import deque
+from django.conf import settings
+from .helpers import *
+from .transcribe_class import TranscribeRequest
+logger = logging.getLogger('testlogger')
+
+# once a request gets to one of these, nothing else is going to change
+TERMINAL_STATUSES = [
+    TRANSCRIPTION_STATUSES[5], # transcription-processed
+    TRANSCRIPTION_STATUSES[6], # server-error
+    TRANSCRIPTION_STATUSES[7], # transcribing-error
+]
+# status we send if there's no such request
+NOT_FOUND_STATUS = "not-found"
+
+HEARTBEAT = ": heartbeat\n\n"
+
+
+#########################
+# events
+#########################
+
+def make_event(state):
+    """
+    state is dict of what the client sees. Same state => same id
+    """
+    serialized = json.dumps(state, sort_keys=True)
+    return {
+        "id": hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:16],
+        "data": state,
+    }
+
+
+def state_of(transcribe_request):
+    return {
+        "status": transcribe_request.status,
+        "progress_percent": transcribe_request.transcript_metadata.get("progress_percent", 0),
+        "updated_at": transcribe_request.updated_at,
+        "error": transcribe_request.error or "",
+    }
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: progress\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def is_last_event(event):
+    return event["data"]["status"] in TERMINAL_STATUSES + [NOT_FOUND_STATUS]
+
+
+#########################
+# subscribers
+#########################
+
+class Subscriber:
+    """
+    one open connection, read from a sync view
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, event):
+        # called from the watcher's thread
+        self._queue.put(event)
+
+    def get(self, timeout):
+        """
+        returns next event, or None if there wasn't one within timeout
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscriber:
+    """
+    one open connection, read from an async view. Waiting doesn't take up a thread
+    """
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+
+    def put(self, event):
+        # called from the watcher's thread, so hand it over to the event loop
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+#########################
+# watching
+#########################
+
+class ProgressWatcher:
+    """
+    watches one request, and sends every change to its subscribers
+    - runs in its own thread until nobody is subscribed anymore, or the request is done
+    """
+
+    def __init__(self, hub, user_id, request_id, poll_seconds, history_size):
+        self.hub = hub
+        self.user_id = user_id
+        self.request_id = request_id
+        self.poll_seconds = poll_seconds
+        # latest events, for clients reconnecting with Last-Event-ID
+        self.history = deque(maxlen=history_size)
+        self.subscribers = set()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self._transcribe_request = None
+        self._thread = threading.Thread(target=self.run, name=f"progress-{request_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def subscribe(self, subscriber, last_event_id=None):
+        with self.lock:
+            self.subscribers.add(subscriber)
+            for event in self._missed_events(last_event_id):
+                subscriber.put(event)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def _missed_events(self, last_event_id):
+        """
+        - if we still have the client's last event, everything after it
+        - otherwise just the latest state, unless that's what they already have
+        """
+        events = list(self.history)
+        ids = [event["id"] for event in events]
+        if last_event_id in ids:
+            return events[ids.index(last_event_id) + 1:]
+
+        if events and events[-1]["id"] != last_event_id:
+            return events[-1:]
+
+        return []
+
+    def publish(self, event):
+        with self.lock:
+            if self.history and self.history[-1]["id"] == event["id"]:
+                # nothing changed
+                return
+
+            self.history.append(event)
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+
+    def read_state(self):
+        """
+        same as what check-status does, returns event for the current state
+        """
+        if self._transcribe_request is None:
+            doc = db.collection("users").document(self.user_id).collection("transcribeRequests").document(self.request_id).get()
+            if not doc.exists:
+                return make_event({"status": NOT_FOUND_STATUS, "progress_percent": 0, "updated_at": None, "error": ""})
+
+            # the doc doesn't have its own id and user_id, only its path does
+            self._transcribe_request = TranscribeRequest.from_document(doc)
+
+        else:
+            self._transcribe_request.refresh_from_db()
+
+        if self._transcribe_request.should_check_with_google():
+            self._transcribe_request.check_transcription_progress()
+
+        return make_event(state_of(self._transcribe_request))
+
+    def run(self):
+        while True:
+            try:
+                event = self.read_state()
+                self.publish(event)
+                if is_last_event(event):
+                    self.hub.remove(self, force=True)
+                    return
+
+            except Exception as error:
+                # keep going, maybe it works next time
+                logger.error(f"error watching progress of {self.request_id}")
+                logger.error(error)
+
+            time.sleep(self.poll_seconds)
+
+            if self.hub.remove(self):
+                return
+
+
+class ProgressHub:
+    """
+    every watcher in this process, by request
+    """
+
+    def __init__(self, poll_seconds=None, history_size=None):
+        self.poll_seconds = poll_seconds or settings.PROGRESS_STREAM["POLL_SECONDS"]
+        self.history_size = history_size or settings.PROGRESS_STREAM["HISTORY_SIZE"]
+        self.watchers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id, request_id, subscriber, last_event_id=None):
+        """
+        starts a watcher for this request if there isn't one running already
+        """
+        key = (user_id, request_id)
+        with self.lock:
+            watcher = self.watchers.get(key)
+            is_new = watcher is None
+            if is_new:
+                watcher = ProgressWatcher(self, user_id, request_id, self.poll_seconds, self.history_size)
+                self.watchers[key] = watcher
+
+            watcher.subscribe(subscriber, last_event_id)
+
+        if is_new:
+            watcher.start()
+
+        return watcher
+
+    def unsubscribe(self, watcher, subscriber):
+        watcher.unsubscribe(subscriber)
+
+    def remove(self, watcher, force=False):
+        """
+        called by the watcher. Unless force, only removes it if nobody is subscribed
+        - returns True if removed, and then the watcher should stop
+        """
+        with self.lock:
+            with watcher.lock:
+                if watcher.subscribers and not force:
+                    return False
+
+                watcher.stopped = True
+
+            key = (watcher.user_id, watcher.request_id)
+            if self.watchers.get(key) is watcher:
+                del self.watchers[key]
+
+            return True
+
+
+# one per process, so a forked worker gets its own (the parent's watcher threads don't come along)
+clients.register("progress_hub", ProgressHub)
+
+
+#########################
+# streams, for the views
+#########################
+
+def _stream_settings():
+    return settings.PROGRESS_STREAM["HEARTBEAT_SECONDS"], time.monotonic() + settings.PROGRESS_STREAM["MAX_STREAM_SECONDS"]
+
+
+def _reconnect_message():
+    # how long the browser waits before reconnecting
+    return f"retry: {settings.PROGRESS_STREAM['RECONNECT_MS']}\n\n"
+
+
+def stream(user_id, request_id, last_event_id=None):
+    """
+    generator of server-sent event text, for a StreamingHttpResponse
+    """
+    hub = clients.get("progress_hub")
+    subscriber = Subscriber()
+    watcher = hub.subscribe(user_id, request_id, subscriber, last_event_id)
+    heartbeat_seconds, stop_at = _stream_settings()
+
+    try:
+        yield _reconnect_message()
+        while time.monotonic() < stop_at:
+            event = subscriber.get(timeout=heartbeat_seconds)
+            if event is None:
+                yield HEARTBEAT
+                continue
+
+            # a new watcher doesn't know what the client has, so it might send it again
+            if event["id"] != last_event_id:
+                yield format_event(event)
+                last_event_id = event["id"]
+
+            if is_last_event(event):
+                return
+
+    finally:
+        # also runs when the client disconnects, since the server closes the generator
+        hub.unsubscribe(watcher, subscriber)
+
+
+def snapshot(user_id, request_id, last_event_id=None):
+    """
+    like stream, but stops after the first event (or heartbeat), and returns the text all at once
+    - for async views before django 4.2, which can't stream without holding up the event loop. EventSource reconnects on its own after RECONNECT_MS, sending Last-Event-ID, so it ends up long polling
+    """
+    chunks = []
+    for chunk in stream(user_id, request_id, last_event_id):
+        chunks.append(chunk)
+        # the first one is just the reconnect message
+        if len(chunks) > 1:
+            break
+
+    return "".join(chunks)
+
+
+async def async_stream(user_id, request_id, last_event_id=None):
+    """
+    same as stream, but for async views
+    """
+    hub = clients.get("progress_hub")
+    subscriber = AsyncSubscriber()
+    watcher = hub.subscribe(user_id, request_id, subscriber, last_event_id)
+    heartbeat_seconds, stop_at = _stream_settings()
+
+    try:
+        yield _reconnect_message()
+        while time.monotonic() < stop_at:
+            event = await subscriber.get(timeout=heartbeat_seconds)
+            if event is None:
+                yield HEARTBEAT
+                continue
+
+            # a new watcher doesn't know what the client has, so it might send it again
+            if event["id"] != last_event_id:
+                yield format_event(event)
+                last_event_id = event["id"]
+
+            if is_last_event(event):
+                return
+
+    finally:
+        hub.unsubscribe(watcher, subscriber)
@@ -0,0 +1,136 @@
+"""
+Requests that are done (transcription-processed) or errored, kept in memory, so polling them again doesn't need firestore
+- once a request is done, check-status and resume-request keep getting called for it (other tabs, a client that doesn't stop polling). Nothing's going to change, so there's nothing to read
+- in-process LRU (TTLCache), and optionally django's cache too (REQUEST_CACHE["SHARED"]), so another process that just finished the request can answer for it
+- keyed by user and request id. Filled in when we read a done/errored request from firestore, and dropped whenever we write to the request doc (once that's committed)
+    * not filled in when writing, since version gets written with Increment, so we only know the real version once we read it back. A version we guessed could match an ETag the client got for something else, and then they'd get a 304 for the wrong thing
+- done requests can still get sent again, and errored ones resumed, from another process (another gunicorn worker or dyno). That can only drop them from the shared cache, not ours. So the in-process copy only stays for REQUEST_CACHE["LOCAL_TTL_SECONDS"], and only the shared cache keeps them for TTL_SECONDS
+"""
+from django.conf import settings
+from django.core.cache import caches
+from .helpers import *
+from .cache import TTLCache
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+FINISHED_STATUSES = [
+    TRANSCRIPTION_STATUSES[5], # transcription-processed
+]
+ERROR_STATUSES = [
+    TRANSCRIPTION_STATUSES[6], # server-error
+    TRANSCRIPTION_STATUSES[7], # transcribing-error
+]
+CACHED_STATUSES = FINISHED_STATUSES + ERROR_STATUSES
+
+KEY_PREFIX = "transcribe-request:"
+
+request_cache = TTLCache(
+    max_size=settings.REQUEST_CACHE["MAX_SIZE"],
+    ttl=settings.REQUEST_CACHE["LOCAL_TTL_SECONDS"],
+)
+metrics.register_stats("request_cache", request_cache.stats)
+
+
+def cache_key(user_id, request_id):
+    return f"{KEY_PREFIX}{user_id}/{request_id}"
+
+
+def _shared_cache():
+    return caches[settings.REQUEST_CACHE["CACHE_ALIAS"]] if settings.REQUEST_CACHE["SHARED"] else None
+
+
+def get(user_id, request_id):
+    """
+    returns the request's fields (like the doc in firestore, plus version), or None
+    """
+    if not settings.REQUEST_CACHE["ENABLED"]:
+        return None
+
+    key = cache_key(user_id, request_id)
+    file_data = request_cache.get(key)
+    if file_data is not None:
+        return file_data
+
+    shared = _shared_cache()
+    if shared is None:
+        return None
+
+    try:
+        file_data = shared.get(key)
+    except Exception as error:
+        # only a nice-to-have, firestore still has it
+        logger.error(f"couldn't read {key} from the shared cache")
+        logger.error(error)
+        return None
+
+    if file_data is not None:
+        request_cache.set(key, file_data, ttl=settings.REQUEST_CACHE["LOCAL_TTL_SECONDS"])
+
+    return file_data
+
+
+def invalidate(transcribe_request):
+    """
+    call once something's been written to the request doc
+    """
+    if not settings.REQUEST_CACHE["ENABLED"]:
+        return
+
+    key = cache_key(transcribe_request.user_id, transcribe_request.id)
+    request_cache.invalidate(key)
+    shared = _shared_cache()
+    if shared is not None:
+        _shared_call(shared.delete, key)
+
+
+def store(transcribe_request):
+    """
+    call right after reading the request from firestore. Only keeps it if it's done or errored
+    """
+    if not settings.REQUEST_CACHE["ENABLED"] or transcribe_request.status not in CACHED_STATUSES:
+        return
+
+    key = cache_key(transcribe_request.user_id, transcribe_request.id)
+    shared = _shared_cache()
+    # payload fields include version, so the ETag stays the same whether or not it came from here
+    file_data = transcribe_request.to_dict(type(transcribe_request).PAYLOAD_FIELDS)
+    request_cache.set(key, file_data, ttl=settings.REQUEST_CACHE["LOCAL_TTL_SECONDS"])
+    if shared is not None:
+        # every process drops it from here when the request gets written (see invalidate), so it can stay longer
+        _shared_call(shared.set, key, file_data, settings.REQUEST_CACHE["TTL_SECONDS"])
+
+
+def _shared_call(fn, *args):
+    try:
+        fn(*args)
+    except Exception as error:
+        logger.error("couldn't update the shared request cache")
+        logger.error(error)
+
+
+def load(transcribe_request, statuses=CACHED_STATUSES):
+    """
+    sets the request's fields from the cache, if we have it in one of statuses. Returns True if we did
+    """
+    file_data = get(transcribe_request.user_id, transcribe_request.id)
+    if file_data is None or file_data["status"] not in statuses:
+        return False
+
+    # a copy, so changing the request (e.g., transcript_metadata) doesn't change what's cached
+    transcribe_request._set_attributes_from_dictionary(deepcopy(file_data))
+    return True
+
+
+def refresh(transcribe_request, statuses=CACHED_STATUSES):
+    """
+    like transcribe_request.refresh_from_db(), but if we have it cached (in one of statuses), no firestore read at all
+    - returns True if it came from the cache
+    """
+    if load(transcribe_request, statuses):
+        return True
+
+    # if it's not in firestore, all we have is what the client sent, so nothing worth keeping
+    if transcribe_request.refresh_from_db():
+        store(transcribe_request)
+
+    return False
@@ -0,0 +1,178 @@
+"""
+What to do when Google errors on a long running request
+- every error gets classified by its google.api_core exception type (and for a few, what the message says), and each class has an action:
+    - reconfigure channels: send again, with multiple channels
+    - reconfigure sample rate: send again, with a different sample rate hertz
+    - backoff: wait a bit (exponential backoff, with jitter) and send the same thing again
+    - fail: give up right away
+- each request gets a budget: max number of attempts, and max total seconds spent waiting between them. Once it's used up, we give up, so a gunicorn worker never gets stuck here for long
+- counts how many errors of each class we've seen (see stats()), so we can tell which ones actually happen
+- https://cloud.google.com/speech-to-text/docs/error-messages
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from urllib3.exceptions import ProtocolError
+from google.api_core import exceptions
+from .admission import AdmissionTimeout
+from . import metrics
+import logging
+logger = logging.getLogger('testlogger')
+
+RECONFIGURE_CHANNELS = "reconfigure-channels"
+RECONFIGURE_SAMPLE_RATE = "reconfigure-sample-rate"
+BACKOFF = "backoff"
+FAIL = "fail"
+
+
+class ErrorClass:
+    """
+    - exception_types: error has to be one of these
+    - message_pattern: if set, error message also has to match this (case insensitive)
+    """
+    def __init__(self, name, exception_types, action, message_pattern=None):
+        self.name = name
+        self.exception_types = exception_types
+        self.action = action
+        self.message_pattern = re.compile(message_pattern, re.IGNORECASE) if message_pattern else None
+
+    def matches(self, error):
+        if not isinstance(error, self.exception_types):
+            return False
+
+        return self.message_pattern is None or bool(self.message_pattern.search(str(error)))
+
+
+# first one that matches wins, so more specific ones go first
+CLASSIFICATIONS = [
+    # our own quota (see admission.py), so it never got to Google. Trying again right away wouldn't have room either
+    ErrorClass("admission-timeout", (AdmissionTimeout,), FAIL),
+    # e.g., "Must use single channel (mono) audio, but WAV header indicates 2 channels." or "Invalid audio channel count" or "audio_channel_count `1` in RecognitionConfig must either be unspecified or match the value in the FLAC header `2`."
+    ErrorClass("channels", (exceptions.InvalidArgument,), RECONFIGURE_CHANNELS, r"channel"),
+    # e.g., "Invalid recognition 'config': bad sample rate hertz."
+    ErrorClass("sample-rate", (exceptions.InvalidArgument,), RECONFIGURE_SAMPLE_RATE, r"sample[ _]rate"),
+    # e.g., "WAV header indicates an unsupported format." Nothing we can change will fix this
+    ErrorClass("unsupported-format", (exceptions.InvalidArgument,), FAIL, r"unsupported format"),
+    ErrorClass("invalid-argument", (exceptions.BadRequest, exceptions.FailedPrecondition, exceptions.OutOfRange), FAIL),
+    ErrorClass("permission", (exceptions.Unauthenticated, exceptions.PermissionDenied, exceptions.Forbidden, exceptions.Unauthorized), FAIL),
+    # e.g., file got deleted
+    ErrorClass("not-found", (exceptions.NotFound,), FAIL),
+    # quota. Waiting a little might be enough
+    ErrorClass("resource-exhausted", (exceptions.TooManyRequests,), BACKOFF),
+    # e.g., "13 INTERNAL"
+    ErrorClass("internal", (exceptions.InternalServerError,), BACKOFF),
+    ErrorClass("unavailable", (exceptions.ServiceUnavailable, exceptions.GatewayTimeout, exceptions.Aborted), BACKOFF),
+    # e.g., ('Connection aborted.', ConnectionResetError(104, 'Connection reset by peer'))
+    # NOTE reset_retry already retries these in the speech client, so we only see them once that gives up
+    ErrorClass("connection", (ConnectionError, ProtocolError), BACKOFF),
+]
+
+UNKNOWN = ErrorClass("unknown", (Exception,), FAIL)
+
+# error class name => how many times we've seen it in this process
+_error_counts = Counter()
+# action => how many times we've taken it
+_action_counts = Counter()
+_counts_lock = threading.Lock()
+
+
+def classify(error, classifications=None):
+    for error_class in classifications or CLASSIFICATIONS:
+        if error_class.matches(error):
+            return error_class
+
+    return UNKNOWN
+
+
+def record(error_class, action):
+    with _counts_lock:
+        _error_counts[error_class.name] += 1
+        _action_counts[action] += 1
+
+
+def stats():
+    with _counts_lock:
+        return {
+            "errors": dict(_error_counts),
+            "actions": dict(_action_counts),
+        }
+
+
+# e.g., transcription_retry_errors{kind="sample-rate"} and transcription_retry_actions{kind="backoff"}
+metrics.register_stats("retry", stats, label_name="kind")
+
+
+def reset_stats():
+    with _counts_lock:
+        _error_counts.clear()
+        _action_counts.clear()
+
+
+class RetryBudget:
+    """
+    how many more tries one request gets, and how long it can spend waiting for them
+    """
+
+    def __init__(self, max_attempts=None, max_wait_seconds=None):
+        self.max_attempts = max_attempts or settings.RETRY["MAX_ATTEMPTS"]
+        self.max_wait_seconds = settings.RETRY["BUDGET_SECONDS"] if max_wait_seconds is None else max_wait_seconds
+        self.attempts = 0
+        self.waited_seconds = 0
+
+    def can_retry(self, delay=0):
+        return self.attempts < self.max_attempts and self.waited_seconds + delay <= self.max_wait_seconds
+
+
+def backoff_delay(retry_number, base_seconds=None, max_seconds=None, random_fn=random.random):
+    """
+    "full jitter": anywhere from 0 up to the exponential delay, so requests that failed at the same time don't all retry at the same time
+    https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+    base_seconds = settings.RETRY["BASE_DELAY_SECONDS"] if base_seconds is None else base_seconds
+    max_seconds = settings.RETRY["MAX_DELAY_SECONDS"] if max_seconds is None else max_seconds
+    return random_fn() * min(max_seconds, base_seconds * 2 ** retry_number)
+
+
+def call_with_retries(call, reconfigure=None, budget=None, on_error=None, classifications=None, sleep=time.sleep, random_fn=random.random):
+    """
+    calls call() until it works, or until the error's action is to fail, or until the budget runs out. Then raises the last error
+    - reconfigure(action) should change whatever call() sends and return True, or return False if there's nothing left to change (then we give up)
+    - on_error(error, error_class) gets called for every error, e.g., to count attempts
+    """
+    budget = budget or RetryBudget()
+    backoffs = 0
+
+    while True:
+        budget.attempts += 1
+        try:
+            return call()
+
+        except Exception as error:
+            error_class = classify(error, classifications)
+            action = error_class.action
+            logger.error(f"long running request failed (attempt {budget.attempts}), classified as {error_class.name}: {error}")
+            if on_error:
+                on_error(error, error_class)
+
+            delay = 0
+            if action == BACKOFF:
+                delay = backoff_delay(backoffs, random_fn=random_fn)
+                backoffs += 1
+
+            if action == FAIL or not budget.can_retry(delay):
+                record(error_class, FAIL)
+                raise
+
+            if action in [RECONFIGURE_CHANNELS, RECONFIGURE_SAMPLE_RATE] and not (reconfigure and reconfigure(action)):
+                # already tried everything we could change
+                record(error_class, FAIL)
+                raise
+
+            record(error_class, action)
+            if delay:
+                logger.info(f"waiting {delay:.2f} seconds before trying again")
+                sleep(delay)
+                budget.waited_seconds += delay
@@ -0,0 +1,137 @@
+"""
+Deleting uploaded files from storage once we're done with them, without making anyone wait for it
+- every path gets a doc in the storageCleanup collection (the ledger), written in the same batch as whatever finished with the file (e.g., marking the transcript as processed). So if the process dies before deleting, we still know about it
+- once that batch is committed, the deletes run in a background pool, at the same time. No exists() check first: a 404 on delete means it's already gone, which is what we wanted
+- deleted => ledger doc gets removed. Failed => ledger doc says when to try again, and the sweeper (runs in the worker, see run_jobs) tries again later, with backoff
+"""
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from google.api_core.exceptions import NotFound
+from .helpers import *
+from . import retry_policy
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+LEDGER_COLLECTION = "storageCleanup"
+
+clients.register("cleanup_pool", lambda: ThreadPoolExecutor(
+    max_workers=settings.STORAGE_CLEANUP["MAX_WORKERS"],
+    thread_name_prefix="cleanup",
+))
+
+
+def ledger_ref(path):
+    # paths have slashes, which can't go in a doc id
+    return db.collection(LEDGER_COLLECTION).document(hashlib.sha1(path.encode("utf-8")).hexdigest())
+
+
+def delete_blob(path):
+    """
+    returns True if the file is gone (including if it already was)
+    """
+    try:
+        with metrics.external_call("storage", "delete"):
+            reset_retry(bucket.blob(path).delete)()
+        logger.info("deleted file from " + path)
+        return True
+
+    except NotFound:
+        return True
+
+    except Exception as error:
+        # typically something like: "ConnectionResetError: [Errno 104] Connection reset by peer", even after reset_retry
+        # tracked here: https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348
+        logger.error("error deleting file " + path)
+        logger.error(error)
+        return False
+
+
+def _delete_and_settle(path, attempts):
+    """
+    deletes the file, then updates the ledger to match
+    """
+    if delete_blob(path):
+        ledger_ref(path).delete()
+        return True
+
+    attempts += 1
+    if attempts >= settings.STORAGE_CLEANUP["MAX_ATTEMPTS"]:
+        # leave it in the ledger to look at, but stop trying
+        retry_at = None
+        logger.error(f"giving up on deleting {path} after {attempts} attempts")
+    else:
+        delay = retry_policy.backoff_delay(attempts, settings.STORAGE_CLEANUP["RETRY_BASE_SECONDS"], settings.STORAGE_CLEANUP["RETRY_MAX_SECONDS"], random_fn=lambda: 1)
+        retry_at = time.time() + delay
+
+    ledger_ref(path).set({"attempts": attempts, "retry_at": retry_at, "failed_at": timestamp()}, merge=True)
+    return False
+
+
+def _delete_in_background(paths):
+    pool = clients.get("cleanup_pool")
+    return [pool.submit(_delete_and_settle, path, 0) for path in paths]
+
+
+def schedule(paths, unit_of_work):
+    """
+    queues a ledger doc for each path in unit_of_work, and deletes the files in the background once it's committed
+    - e.g., with transcribe_request.batched_writes() as unit_of_work: ...
+    """
+    paths = [path for path in paths if path]
+    if not paths:
+        return
+
+    # if nothing else deletes it first, the sweeper will once this is reached
+    retry_at = time.time() + settings.STORAGE_CLEANUP["GRACE_SECONDS"]
+    for path in paths:
+        unit_of_work.set(ledger_ref(path), {
+            "path": path,
+            "attempts": 0,
+            "retry_at": retry_at,
+            "created_at": timestamp(),
+        })
+
+    if settings.STORAGE_CLEANUP["BACKGROUND"]:
+        unit_of_work.after_commit(lambda: _delete_in_background(paths))
+    else:
+        # e.g., for tests, or if something goes wrong with the pool
+        unit_of_work.after_commit(lambda: [_delete_and_settle(path, 0) for path in paths])
+
+
+class StorageSweeper:
+    """
+    retries the deletes that failed (or never ran), from the ledger
+    """
+
+    def __init__(self, interval=None, batch_size=None):
+        config = settings.STORAGE_CLEANUP
+        self.interval = interval or config["SWEEP_INTERVAL_SECONDS"]
+        self.batch_size = batch_size or config["SWEEP_BATCH_SIZE"]
+
+    def run_forever(self):
+        logger.info(f"sweeping storage every {self.interval}s")
+        while True:
+            try:
+                self.sweep_once()
+            except Exception:
+                logger.error(traceback.format_exc())
+
+            time.sleep(self.interval)
+
+    def sweep_once(self):
+        """
+        returns (number deleted, number still failing)
+        """
+        query = db.collection(LEDGER_COLLECTION).where("retry_at", "<=", time.time()).order_by("retry_at").limit(self.batch_size)
+        entries = [doc.to_dict() for doc in query.stream()]
+
+        pool = clients.get("cleanup_pool")
+        futures = [pool.submit(_delete_and_settle, entry["path"], entry.get("attempts", 0)) for entry in entries]
+        deleted = sum(1 for future in futures if future.result())
+
+        if entries:
+            logger.info(f"swept storage: deleted {deleted}, {len(entries) - deleted} still failing")
+
+        return deleted, len(entries) - deleted
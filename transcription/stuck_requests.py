@@ -0,0 +1,138 @@
+"""
+Finding requests that stopped partway (e.g., the browser went away, or the dyno restarted in the middle of one) and getting them going again, or giving up on them
+- before this, only resume-request/ would notice, and only if the browser was still around to call it. Otherwise requests sat in processing-file or transcribing forever, and their uploads never got deleted
+- runs in the worker (see run_jobs), or on its own: python manage.py sweep_stuck_requests
+- for each status, asks firestore (every user's transcribeRequests, as a collection group) for the oldest requests that haven't changed in at least that status' STALLED_AFTER_SECONDS. Then last_request_has_stopped decides, since bigger files get longer
+- stuck ones get resumed, up to STUCK_REQUESTS["MAX_RESUMES"] times. After that they get marked as errored. Either way, every write from one sweep goes out in one batch, and then the resuming (sending to Google, or checking with Google) runs a few at a time
+- while transcribing, progress from Google counts as something changing (see TranscribeRequest._heartbeat), so long operations that are still going don't get resumed or given up on
+- NOTE only statuses that we set (processing-file onward). uploading/uploaded get set by the frontend, without updated_at_time, so those still only get resumed through resume-request/
+- NOTE needs the composite index in firestore.indexes.json (status and updated_at_time, collection group scope)
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from .helpers import *
+from .transcribe_class import TranscribeRequest
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+SWEPT_STATUSES = [
+    TRANSCRIPTION_STATUSES[2], # processing-file
+    TRANSCRIPTION_STATUSES[3], # transcribing
+    TRANSCRIPTION_STATUSES[4], # processing-transcription
+]
+
+
+class StuckRequestSweeper:
+    def __init__(self, interval=None, batch_size=None, max_resumes=None, max_workers=None):
+        config = settings.STUCK_REQUESTS
+        self.interval = interval or config["SWEEP_INTERVAL_SECONDS"]
+        self.batch_size = batch_size or config["SWEEP_BATCH_SIZE"]
+        self.max_resumes = config["MAX_RESUMES"] if max_resumes is None else max_resumes
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or config["MAX_WORKERS"], thread_name_prefix="stuck")
+
+    def run_forever(self):
+        logger.info(f"sweeping stuck requests every {self.interval}s")
+        while True:
+            try:
+                self.sweep_once()
+            except Exception:
+                logger.error(traceback.format_exc())
+
+            time.sleep(self.interval)
+
+    def sweep_once(self):
+        """
+        returns (number resumed, number given up on)
+        """
+        stuck = self.find_stuck_requests()
+        to_fail = [transcribe_request for transcribe_request in stuck if transcribe_request.resume_count >= self.max_resumes]
+        to_resume = [transcribe_request for transcribe_request in stuck if transcribe_request.resume_count < self.max_resumes]
+
+        with TranscribeRequest.batched_writes_for(stuck):
+            for transcribe_request in to_fail:
+                give_up(transcribe_request)
+            for transcribe_request in to_resume:
+                record_resume(transcribe_request)
+
+        # only once the writes are in, so if resuming gets stuck too, the next sweep knows we already tried
+        resumed = sum(1 for ok in self.executor.map(resume, to_resume) if ok)
+
+        if stuck:
+            logger.info(f"swept stuck requests: resumed {resumed}, gave up on {len(to_fail)}")
+
+        return resumed, len(to_fail)
+
+    def find_stuck_requests(self):
+        now = utc_now()
+        stuck = []
+        for status in SWEPT_STATUSES:
+            cutoff = now - timedelta(seconds=TranscribeRequest.STALLED_AFTER_SECONDS[status])
+            query = (
+                db.collection_group("transcribeRequests")
+                .where("status", "==", status)
+                .where("updated_at_time", "<=", cutoff)
+                .order_by("updated_at_time")
+                .limit(self.batch_size)
+            )
+            with metrics.external_call("firestore", "query"):
+                docs = list(query.stream())
+
+            for doc in docs:
+                transcribe_request = TranscribeRequest.from_document(doc)
+                if transcribe_request.last_request_has_stopped():
+                    stuck.append(transcribe_request)
+
+        return stuck
+
+
+def give_up(transcribe_request):
+    error = Exception(f"Stopped while {transcribe_request.status}, and didn't start again after {transcribe_request.resume_count} tries")
+    if transcribe_request.status == TRANSCRIPTION_STATUSES[3]: # transcribing
+        # Google never finished
+        transcribe_request.mark_as_transcribing_error(error)
+    else:
+        transcribe_request.mark_as_server_error(error)
+
+
+def record_resume(transcribe_request):
+    """
+    counts the try, and starts the clock over, so the next sweep gives it a full STALLED_AFTER_SECONDS before looking at it again
+    """
+    transcribe_request.resume_count += 1
+    transcribe_request.updated_at = timestamp()
+    transcribe_request.updated_at_time = utc_now()
+    transcribe_request._set_document(transcribe_request.transcribe_request_ref(), {
+        "resume_count": transcribe_request.resume_count,
+        "updated_at": transcribe_request.updated_at,
+        "updated_at_time": transcribe_request.updated_at_time,
+        **transcribe_request._version_updates(),
+    }, merge=True)
+
+
+def resume(transcribe_request):
+    """
+    picks up where it stopped. Returns False if that errored
+    - Google already has it: check on the operation (if Google is done, this is what writes the transcript)
+    - otherwise: send to Google again, like resume-request/ does
+    """
+    # in the worker, so can wait longer between tries with Google
+    transcribe_request.retry_wait_seconds = settings.RETRY["BUDGET_SECONDS"]
+    transcribe_request.admission_wait_seconds = settings.ADMISSION["MAX_WAIT_SECONDS"]
+    transcribe_request.transcode_timeout_seconds = settings.TRANSCODING["TIMEOUT_SECONDS"]
+    try:
+        if transcribe_request.transaction_id and transcribe_request.status in [TRANSCRIPTION_STATUSES[3], TRANSCRIPTION_STATUSES[4]]:
+            transcribe_request.check_transcription_progress()
+        else:
+            transcribe_request.send_to_google()
+
+        return True
+
+    except Exception as error:
+        logger.error(f"error resuming {transcribe_request.id}")
+        logger.error(traceback.format_exc())
+        if "error" not in (transcribe_request.status or ""):
+            transcribe_request.mark_as_server_error(error)
+
+        return False
@@ -1,7 +1,130 @@
+import asyncio
+import io
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
+
+import django
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
-from django.test import TestCase, RequestFactory
+from django.core.cache import caches
+from asgiref.sync import async_to_sync
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.urls import resolve
+from google.api_core import exceptions
+
+from .cache import TTLCache
+from .fakes import FakeFirestore, FakeBucket, FakeSpeech, FilesystemBucket, FakeDocumentReference
+from .helpers import clients, timestamp, utc_now, TRANSCRIPTION_STATUSES
+from .transcribe_class import TranscribeRequest
+from .users import user_cache, invalidate_user, get_user_profile
+from . import users
+from . import transcript_storage
+from . import audio_probe
+from . import transcoding
+from . import chunking
+from . import retry_policy
+from . import transcript_cache
+from . import async_views
+from . import progress_stream
+from . import views
+from . import batch_submission
+from . import jobs
+from .job_queue import SQLiteJobQueue
+from . import storage_cleanup
+from .admission import AdmissionController, AdmissionTimeout
+from . import admission
+from . import metrics
+from .stuck_requests import StuckRequestSweeper
+from .poller import OperationPoller, OperationSchedule
+from . import request_cache
+from . import coalescing
+
+
+def make_file_data(**overrides):
+    return {
+        "filename": "sermon.flac",
+        "file_last_modified": 1588000000000,
+        "id": "request-1",
+        "user_id": "user-1",
+        "file_type": "audio/flac",
+        "file_size": 1048576,
+        **overrides,
+    }
+
+
+def make_operation(done=False, progress_percent=50, results=None):
+    operation = {
+        "name": "1234567890",
+        "metadata": {
+            "progressPercent": progress_percent,
+            "startTime": "2020-04-25T21:22:07.436054Z",
+            "lastUpdateTime": "2020-04-25T21:22:14.434078Z",
+        },
+    }
+    if done:
+        operation["done"] = True
+        operation["response"] = {"results": results or [
+            {"alternatives": [{"transcript": "សួស្តី", "confidence": 0.9}]},
+        ]}
+
+    return operation
+
+
+def make_wav(channels=1, sample_rate=16000, seconds=1):
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(b"\x00\x00" * channels * sample_rate * seconds)
+
+    return output.getvalue()
+
+
+def make_flac_header(channels=2, sample_rate=44100, bits_per_sample=16, total_samples=441000):
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36) | total_samples
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 + packed.to_bytes(8, "big") + b"\x00" * 16
+    # last metadata block, type 0 (STREAMINFO), 34 bytes long
+    return b"fLaC" + bytes([0x80, 0, 0, 34]) + streaminfo
+
+
+def make_mp3(channels=2, frames=100):
+    # MPEG 1 layer 3, 128 kbps, 44100 Hz
+    channel_mode = 0b11 if channels == 1 else 0b00
+    header = bytes([0xFF, 0xFB, 0x90, channel_mode << 6])
+    frame_length = 144 * 128000 // 44100
+    id3 = b"ID3\x03\x00\x00\x00\x00\x00\x0a" + b"\x00" * 10
+    return id3 + (header + b"\x00" * (frame_length - 4)) * frames
+
 
-from .views import index
+class FirestoreTestCase(SimpleTestCase):
+    """
+    swaps an in-memory firestore and storage bucket in for the real ones
+    """
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.bucket = FakeBucket()
+        clients.override("db", self.db)
+        clients.override("bucket", self.bucket)
+        # fresh quota for every test
+        clients.override("admission", AdmissionController())
+        user_cache.clear()
+        request_cache.request_cache.clear()
+
+    def tearDown(self):
+        clients.override("db", None)
+        clients.override("bucket", None)
+        clients.override("admission", None)
 
 
 class SimpleTest(TestCase):
@@ -14,6 +137,1920 @@ class SimpleTest(TestCase):
         request = self.factory.get("/")
         request.user = AnonymousUser()
 
-        # Test my_view() as if it were deployed at /customer/details
-        response = index(request)
+        # there's no index view, so hit the wake-up route instead
+        response = resolve("/wake-up/").func(request)
         self.assertEqual(response.status_code, 200)
+
+
+class BatchedWritesTest(FirestoreTestCase):
+    def test_status_change_is_one_commit(self):
+        transcribe_request = TranscribeRequest(make_file_data())
+        self.db.rpc_counts.clear()
+
+        transcribe_request.mark_as_received()
+
+        self.assertEqual(self.db.rpc_counts["commit"], 1)
+        doc = self.db.read("users/user-1/transcribeRequests/request-1")
+        self.assertEqual(doc["status"], TRANSCRIPTION_STATUSES[2])
+        event_logs = list(self.db.collection("users/user-1/transcribeRequests/request-1/eventLogs").stream())
+        self.assertEqual(len(event_logs), 1)
+
+    def test_progress_check_is_one_commit(self):
+        transcribe_request = TranscribeRequest(make_file_data(transaction_id="1234567890"))
+        self.db.rpc_counts.clear()
+
+        with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation()):
+            transcribe_request.check_transcription_progress()
+
+        self.assertEqual(self.db.rpc_counts["commit"], 1)
+        doc = self.db.read("users/user-1/transcribeRequests/request-1")
+        self.assertEqual(doc["transcript_metadata"]["progress_percent"], 50)
+
+    def test_finished_transcript_is_one_commit(self):
+        # marks as transcribed, then processed, then persists the request and the transcript. All in one batch
+        transcribe_request = TranscribeRequest(make_file_data(transaction_id="1234567890"))
+        self.db.rpc_counts.clear()
+
+        with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation(done=True, progress_percent=100)):
+            transcribe_request.check_transcription_progress()
+
+        self.assertEqual(self.db.rpc_counts["commit"], 1)
+        doc = self.db.read("users/user-1/transcribeRequests/request-1")
+        self.assertEqual(doc["status"], TRANSCRIPTION_STATUSES[5])
+        manifest, utterances = transcript_storage.read_transcript(transcribe_request.transcript_document_ref())
+        self.assertEqual(utterances[0]["alternatives"][0]["transcript"], "សួស្តី")
+
+    def test_nothing_written_if_step_fails(self):
+        transcribe_request = TranscribeRequest(make_file_data())
+        self.db.rpc_counts.clear()
+
+        with self.assertRaises(ValueError):
+            with transcribe_request.batched_writes():
+                transcribe_request.mark_as_received()
+                raise ValueError("something broke halfway through")
+
+        self.assertEqual(self.db.rpc_counts["commit"], 0)
+        self.assertIsNone(self.db.read("users/user-1/transcribeRequests/request-1"))
+
+
+class OperationScheduleTest(SimpleTestCase):
+    def test_backs_off_until_progress_moves(self):
+        schedule = OperationSchedule(5, 60, now=0)
+        self.assertTrue(schedule.is_due(0))
+
+        # first check always counts as moving
+        schedule.record_check(10, now=0)
+        self.assertEqual(schedule.interval, 5)
+
+        intervals = []
+        now = 0
+        for _ in range(5):
+            now = schedule.next_check_at
+            self.assertFalse(schedule.is_due(now - 1))
+            self.assertTrue(schedule.is_due(now))
+            schedule.record_check(10, now=now)
+            intervals.append(schedule.interval)
+
+        # doubles, up to the max
+        self.assertEqual(intervals, [10, 20, 40, 60, 60])
+
+        schedule.record_check(20, now=now)
+        self.assertEqual(schedule.interval, 5)
+        self.assertEqual(schedule.next_check_at, now + 5)
+
+    def test_errors_back_off_too(self):
+        schedule = OperationSchedule(5, 60, now=0)
+        schedule.record_check(10, now=0)
+        schedule.record_check(None, now=5)
+        self.assertEqual(schedule.interval, 10)
+
+
+class OperationPollerTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.results = make_operation(done=True)["response"]["results"]
+        self.speech = FakeSpeech(results_fn=lambda name: self.results, progress_step=10)
+        clients.override("operations_api", self.speech)
+        self.addCleanup(clients.override, "operations_api", None)
+
+        self.clock = 0
+        patcher = mock.patch("transcription.poller.time.monotonic", side_effect=lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def seed(self, count):
+        for i in range(count):
+            request_id = f"request-{i}"
+            self.speech.operations[f"operation-{i}"] = 0
+            self.db.write(f"users/user-1/transcribeRequests/{request_id}", make_file_data(
+                id=request_id, status=TRANSCRIPTION_STATUSES[3], transaction_id=f"operation-{i}",
+            ))
+
+        # not sent to Google yet, so nothing to poll
+        self.db.write("users/user-1/transcribeRequests/not-sent", make_file_data(id="not-sent", status=TRANSCRIPTION_STATUSES[3]))
+
+    def test_one_call_per_operation_per_cycle(self):
+        self.seed(5)
+        poller = OperationPoller(min_interval=5, max_interval=60, max_workers=3)
+
+        self.assertEqual(poller.poll_once(), 5)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 5)
+        self.assertEqual(set(self.speech.operations.values()), {10})
+
+        # none of them are due again yet
+        self.assertEqual(poller.poll_once(), 0)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 5)
+
+        self.clock = 5
+        self.assertEqual(poller.poll_once(), 5)
+        self.assertEqual(set(self.speech.operations.values()), {20})
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-0")["transcript_metadata"]["progress_percent"], 20)
+
+    def test_waits_longer_while_nothing_moves(self):
+        self.seed(1)
+        self.speech.progress_step = 0
+        poller = OperationPoller(min_interval=5, max_interval=60, max_workers=3)
+
+        checked_at = []
+        for now in range(0, 40):
+            self.clock = now
+            if poller.poll_once():
+                checked_at.append(now)
+
+        self.assertEqual(checked_at, [0, 5, 15, 35])
+
+        # moving again, so back to checking often
+        self.speech.progress_step = 10
+        self.clock = 75
+        self.assertEqual(poller.poll_once(), 1)
+        self.assertEqual(poller.schedules[("user-1", "request-0")].next_check_at, 80)
+
+    def test_checks_at_most_max_workers_at_a_time(self):
+        self.seed(6)
+        self.speech.latency_seconds = 0.1
+        lock = threading.Lock()
+        in_flight = []
+        most_in_flight = []
+        get_operation = self.speech.get_operation
+
+        def counting_get_operation(name):
+            with lock:
+                in_flight.append(name)
+                most_in_flight.append(len(in_flight))
+            try:
+                return get_operation(name)
+            finally:
+                with lock:
+                    in_flight.remove(name)
+
+        self.speech.get_operation = counting_get_operation
+        poller = OperationPoller(min_interval=5, max_interval=60, max_workers=2)
+
+        self.assertEqual(poller.poll_once(), 6)
+        self.assertEqual(max(most_in_flight), 2)
+
+    def test_stops_tracking_finished_requests(self):
+        self.seed(2)
+        self.speech.operations["operation-0"] = 90
+        poller = OperationPoller(min_interval=5, max_interval=60, max_workers=3)
+
+        poller.poll_once()
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-0")["status"], TRANSCRIPTION_STATUSES[5])
+        # no need to wait for the next refresh to know it's done
+        self.assertEqual(set(poller.schedules), {("user-1", "request-1")})
+
+        self.clock = 5
+        self.assertEqual(poller.poll_once(), 1)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 3)
+
+        # finished by someone else (e.g., check-status/), and we find out on the next refresh
+        self.db.write("users/user-1/transcribeRequests/request-1", {**self.db.read("users/user-1/transcribeRequests/request-1"), "status": TRANSCRIPTION_STATUSES[5]})
+        self.clock = 30
+        self.assertEqual(poller.poll_once(), 0)
+        self.assertEqual(poller.schedules, {})
+
+    def test_only_asks_firestore_every_refresh(self):
+        self.seed(2)
+        poller = OperationPoller(min_interval=5, max_interval=60, max_workers=3, refresh_interval=30)
+
+        for now in range(0, 60, 2):
+            self.clock = now
+            poller.poll_once()
+
+        # at 0 and 30, not every tick
+        self.assertEqual(self.db.rpc_counts["query"], 2)
+        self.assertGreater(self.speech.rpc_counts["get_operation"], 4)
+
+    def test_skips_docs_it_cant_read(self):
+        self.seed(2)
+        with mock.patch.object(TranscribeRequest, "from_document", side_effect=[ValueError("no file_type"), TranscribeRequest.from_document(
+            self.db.collection("users").document("user-1").collection("transcribeRequests").document("request-1").get()
+        ), ValueError("no file_type")]):
+            poller = OperationPoller(min_interval=5, max_interval=60, max_workers=3)
+            self.assertEqual(poller.poll_once(), 1)
+
+    def test_check_status_asks_google_if_the_poller_hasnt(self):
+        # e.g., no worker running
+        self.speech.operations["operation-0"] = 0
+        self.db.write("users/user-1/transcribeRequests/request-0", {
+            **make_file_data(id="request-0", status=TRANSCRIPTION_STATUSES[3], transaction_id="operation-0"),
+            "updated_at_time": utc_now() - timedelta(minutes=10),
+        })
+        request = RequestFactory().post("/", data=json.dumps(make_file_data(id="request-0")), content_type="application/json")
+
+        views.check_status(request)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 1)
+
+        # now it's been checked, so it's back to just reading firestore
+        views.check_status(request)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 1)
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-0")["transcript_metadata"]["progress_percent"], 10)
+
+    def test_same_request_id_for_two_users(self):
+        self.seed(1)
+        self.speech.operations["operation-other"] = 0
+        self.db.write("users/user-2/transcribeRequests/request-0", make_file_data(id="request-0", user_id="user-2", status=TRANSCRIPTION_STATUSES[3], transaction_id="operation-other"))
+        poller = OperationPoller(min_interval=5, max_interval=60, max_workers=3)
+
+        self.assertEqual(poller.poll_once(), 2)
+        self.assertEqual(self.speech.operations["operation-other"], 10)
+
+
+class EventLogsTest(FirestoreTestCase):
+    def event_logs_path(self):
+        return "users/user-1/transcribeRequests/request-1/eventLogs"
+
+    def test_not_read_until_asked_for(self):
+        self.db.write(f"{self.event_logs_path()}/a", {"event": TRANSCRIPTION_STATUSES[1], "time": "20200425T212200Z"})
+
+        transcribe_request = TranscribeRequest(make_file_data())
+        self.assertEqual(self.db.rpc_counts["query"], 0)
+
+        self.assertFalse(transcribe_request.server_has_received())
+        self.assertEqual(self.db.rpc_counts["query"], 1)
+
+    def test_only_reads_new_event_logs(self):
+        self.db.write(f"{self.event_logs_path()}/a", {"event": TRANSCRIPTION_STATUSES[1], "time": "20200425T212200Z"})
+        transcribe_request = TranscribeRequest(make_file_data())
+        self.assertEqual(len(transcribe_request.get_event_logs()), 1)
+
+        # e.g., another worker marked it as received
+        self.db.write(f"{self.event_logs_path()}/b", {"event": TRANSCRIPTION_STATUSES[2], "time": "20200425T212300Z"})
+
+        with mock.patch("transcription.fakes.FakeDocumentSnapshot.to_dict", autospec=True, side_effect=lambda snapshot: dict(snapshot._data)) as to_dict:
+            event_logs = transcribe_request.get_event_logs()
+
+        # the first log is older than our cursor, so only the new one gets read
+        self.assertEqual(to_dict.call_count, 1)
+        self.assertEqual([event_log["event"] for event_log in event_logs], TRANSCRIPTION_STATUSES[1:3])
+        self.assertTrue(transcribe_request.server_has_received())
+
+    def test_own_status_changes_are_included(self):
+        transcribe_request = TranscribeRequest(make_file_data())
+        transcribe_request.mark_as_received()
+
+        self.assertTrue(transcribe_request.server_has_received())
+        # written and read from the same collection
+        self.assertEqual(len(transcribe_request.get_event_logs()), 1)
+
+
+class TTLCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_expires(self):
+        self.cache.set("a", 1)
+        self.now = 9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertIn("c", self.cache)
+
+    def test_expire_without_reading(self):
+        evicted = []
+        self.cache.on_evict = lambda key, value: evicted.append(key)
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=20)
+        self.now = 10
+
+        self.assertEqual(self.cache.expire(), 1)
+        self.assertEqual(evicted, ["a"])
+        self.assertIn("b", self.cache)
+
+
+class UserCacheTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        self.db.write("customQuotas/someone@example.com", {"audioFileSizeMB": 100})
+
+    def test_many_files_read_user_once(self):
+        for i in range(5):
+            transcribe_request = TranscribeRequest(make_file_data(id=f"request-{i}"))
+            self.assertEqual(transcribe_request.get_max_size_mb(), 100)
+
+        # users/{id} and customQuotas/{email}, once each
+        self.assertEqual(self.db.rpc_counts["get"], 2)
+
+    def test_invalidate(self):
+        TranscribeRequest(make_file_data()).get_max_size_mb()
+        self.db.write("customQuotas/someone@example.com", {"audioFileSizeMB": 200})
+        invalidate_user("user-1")
+
+        self.assertEqual(TranscribeRequest(make_file_data()).get_max_size_mb(), 200)
+
+    @override_settings(USER_CACHE={**settings.USER_CACHE, "WATCH": True})
+    def test_one_watch_per_user(self):
+        unsubscribed = threading.Semaphore(0)
+        watch = mock.Mock(**{"unsubscribe.side_effect": unsubscribed.release})
+        with mock.patch.object(FakeDocumentReference, "on_snapshot", create=True, return_value=watch) as on_snapshot:
+            get_user_profile("user-1")
+            # another request that missed at the same time
+            users._watch("user-1", "someone@example.com")
+
+        # users/{id} and customQuotas/{email}, once each
+        self.assertEqual(on_snapshot.call_count, 2)
+
+        invalidate_user("user-1")
+        # unsubscribes in other threads
+        self.assertTrue(unsubscribed.acquire(timeout=1) and unsubscribed.acquire(timeout=1))
+        self.assertNotIn("user-1", users._watches)
+
+
+class SerializationTest(FirestoreTestCase):
+    def test_request_document_leaves_out_transcript(self):
+        transcribe_request = TranscribeRequest(make_file_data(transaction_id="1234567890"))
+
+        with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation(done=True, progress_percent=100)):
+            transcribe_request.check_transcription_progress()
+
+        doc = self.db.read("users/user-1/transcribeRequests/request-1")
+        for field in ["utterances", "request_options", "request_params", "custom_quotas"]:
+            self.assertNotIn(field, doc)
+
+        self.assertNotIn("utterances", transcribe_request.response_data())
+        self.assertEqual(transcribe_request.response_data()["status"], TRANSCRIPTION_STATUSES[5])
+
+    def test_transcript_only_written_when_done(self):
+        transcribe_request = TranscribeRequest(make_file_data(transaction_id="1234567890"))
+
+        with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation()):
+            transcribe_request.check_transcription_progress()
+
+        self.assertFalse(any("/transcripts/" in path for path in self.db.documents))
+
+    def test_only_schema_fields_can_be_set(self):
+        transcribe_request = TranscribeRequest(make_file_data())
+        with self.assertRaises(AttributeError):
+            transcribe_request.not_a_field = True
+
+
+class TranscriptStorageTest(FirestoreTestCase):
+    def make_utterances(self, count, words_per_utterance):
+        utterances = []
+        for i in range(count):
+            words = [{
+                "startTime": transcript_storage.ms_to_duration((i * words_per_utterance + j) * 500),
+                "endTime": transcript_storage.ms_to_duration((i * words_per_utterance + j + 1) * 500),
+                "word": f"ពាក្យ{j % 7}",
+                "confidence": 0.875,
+            } for j in range(words_per_utterance)]
+            utterances.append({
+                "alternatives": [
+                    {"transcript": " ".join(word["word"] for word in words), "confidence": 0.9, "words": words},
+                    {"transcript": "other", "confidence": 0.5},
+                ],
+                "languageCode": "km-kh",
+            })
+
+        return utterances
+
+    def test_durations(self):
+        for duration, ms in [("1s", 1000), ("1.500s", 1500), ("0.100s", 100), ("12.300000s", 12300)]:
+            self.assertEqual(transcript_storage.duration_to_ms(duration), ms)
+        self.assertEqual(transcript_storage.ms_to_duration(1500), "1.500s")
+        self.assertEqual(transcript_storage.ms_to_duration(2000), "2s")
+
+    def test_round_trip(self):
+        utterances = self.make_utterances(30, 10)
+        transcript_ref = self.db.collection("users").document("user-1").collection("transcripts").document("t")
+
+        manifest = transcript_storage.write_transcript(transcript_ref, {"filename": "sermon.flac"}, utterances, lambda ref, data: ref.set(data), page_words=100)
+
+        self.assertEqual(manifest["page_count"], 3)
+        self.assertEqual(manifest["word_count"], 300)
+        self.assertEqual(manifest["pages"][1]["first_utterance"], 10)
+        self.assertEqual(manifest["pages"][1]["start_ms"], 50000)
+        self.assertEqual(transcript_storage.read_transcript(transcript_ref), (self.db.read("users/user-1/transcripts/t"), utterances))
+
+    def test_read_one_page(self):
+        utterances = self.make_utterances(30, 10)
+        transcript_ref = self.db.collection("users").document("user-1").collection("transcripts").document("t")
+        transcript_storage.write_transcript(transcript_ref, {}, utterances, lambda ref, data: ref.set(data), page_words=100)
+        self.db.rpc_counts.clear()
+
+        self.assertEqual(transcript_storage.read_page(transcript_ref, 2), utterances[20:])
+        self.assertEqual(self.db.rpc_counts["get"], 1)
+
+    def test_utterances_stay_on_the_doc_if_they_fit(self):
+        utterances = self.make_utterances(30, 10)
+        size = len(json.dumps(utterances, ensure_ascii=False).encode("utf-8"))
+
+        manifest, _ = transcript_storage.build_documents({}, utterances, page_words=100, inline_max_bytes=size)
+        self.assertEqual(manifest["utterances"], utterances)
+
+        manifest, _ = transcript_storage.build_documents({}, utterances, page_words=100, inline_max_bytes=size - 1)
+        self.assertNotIn("utterances", manifest)
+
+    @override_settings(TRANSCRIPT_INLINE_UTTERANCES_MAX_BYTES=0)
+    def test_view_returns_old_shape(self):
+        utterances = self.make_utterances(30, 10)
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[5], transaction_id="1234567890"))
+        transcript_ref = self.db.collection("users").document("user-1").collection("transcripts").document("sermon.flac-at-1234567890")
+        transcript_storage.write_transcript(transcript_ref, {"filename": "sermon.flac"}, utterances, lambda ref, data: ref.set(data), page_words=100)
+
+        for view in [views.transcript, lambda request: async_to_sync(async_views.transcript)(request)]:
+            response = view(RequestFactory().get("/", {"id": "request-1", "user_id": "user-1"}))
+            self.assertEqual(json.loads(response.content), {"filename": "sermon.flac", "utterances": utterances})
+
+        response = views.transcript(RequestFactory().get("/", {"id": "request-2", "user_id": "user-1"}))
+        self.assertEqual(response.status_code, 404)
+
+
+class AudioProbeTest(FirestoreTestCase):
+    def test_wav(self):
+        info = audio_probe.probe_bytes(make_wav(channels=2, sample_rate=48000, seconds=2))
+        self.assertEqual(info["encoding"], "LINEAR16")
+        self.assertEqual(info["channels"], 2)
+        self.assertEqual(info["sample_rate_hertz"], 48000)
+        self.assertEqual(info["duration_seconds"], 2)
+
+    def test_flac(self):
+        info = audio_probe.probe_bytes(make_flac_header())
+        self.assertEqual((info["encoding"], info["channels"], info["sample_rate_hertz"]), ("FLAC", 2, 44100))
+        self.assertEqual(info["duration_seconds"], 10)
+
+    def test_mp3_after_id3_tag(self):
+        data = make_mp3(channels=1)
+        self.bucket.blobs["uploads/a.mp3"] = data
+
+        info = audio_probe.probe_blob(self.bucket.blob("uploads/a.mp3"), len(data))
+        self.assertEqual((info["encoding"], info["channels"], info["sample_rate_hertz"]), ("MP3", 1, 44100))
+        self.assertAlmostEqual(info["duration_seconds"], 100 * 1152 / 44100, places=1)
+
+    def test_file_size_as_string(self):
+        # mp3 duration comes from the file size, which the client might send as a string
+        data = make_mp3(channels=1)
+        self.bucket.blobs["uploads/a.mp3"] = data
+        transcribe_request = TranscribeRequest(make_file_data(file_type="audio/mpeg", file_path="uploads/a.mp3", file_size=str(len(data))))
+
+        info = transcribe_request.get_audio_info()
+        self.assertAlmostEqual(info["duration_seconds"], 100 * 1152 / 44100, places=1)
+
+    def test_stereo_configured_on_first_try(self):
+        self.bucket.blobs["uploads/sermon.wav"] = make_wav(channels=2, sample_rate=44100)
+        transcribe_request = TranscribeRequest(make_file_data(file_type="audio/wav", file_path="uploads/sermon.wav"))
+
+        transcribe_request.setup_request()
+
+        config = transcribe_request.request_params["config"]
+        self.assertEqual(config["audio_channel_count"], 2)
+        self.assertEqual(config["sample_rate_hertz"], 44100)
+        # and didn't change the config for everybody else
+        self.assertNotIn("audio_channel_count", TranscribeRequest._wav_config)
+
+    def test_duration_quota(self):
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        self.db.write("customQuotas/someone@example.com", {"audioDurationMinutes": 1})
+        self.bucket.blobs["uploads/sermon.wav"] = make_wav(seconds=61, sample_rate=8000)
+        transcribe_request = TranscribeRequest(make_file_data(file_type="audio/wav", file_path="uploads/sermon.wav"))
+
+        with self.assertRaisesMessage(Exception, "longer than maximum"):
+            transcribe_request.validate_request()
+
+
+class TranscodingTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        # fixture files get written here, and the bucket reads/writes here too
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bucket = FilesystemBucket(self.tmp_dir)
+        clients.override("bucket", self.bucket)
+
+        os.makedirs(os.path.join(self.tmp_dir, "uploads"))
+        with open(os.path.join(self.tmp_dir, "uploads", "sermon.wav"), "wb") as f:
+            f.write(make_wav(channels=2, sample_rate=16000, seconds=2))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def python_args(self, code):
+        return [sys.executable, "-c", code]
+
+    def test_streams_through_subprocess(self):
+        # stand-in for ffmpeg that just reverses the bytes
+        args = self.python_args("import sys; sys.stdout.buffer.write(sys.stdin.buffer.read()[::-1])")
+
+        transcoding.stream_transcode(self.bucket.blob("uploads/sermon.wav"), self.bucket.blob("uploads/out.raw"), args=args, timeout=10)
+
+        original = self.bucket.blob("uploads/sermon.wav").download_as_bytes()
+        self.assertEqual(self.bucket.blob("uploads/out.raw").download_as_bytes(), original[::-1])
+
+    def test_failure_leaves_no_target(self):
+        args = self.python_args("import sys; sys.stderr.write('bad input'); sys.exit(1)")
+
+        with self.assertRaisesMessage(transcoding.TranscodingError, "bad input"):
+            transcoding.stream_transcode(self.bucket.blob("uploads/sermon.wav"), self.bucket.blob("uploads/out.flac"), args=args, timeout=10)
+
+        self.assertFalse(self.bucket.blob("uploads/out.flac").exists())
+
+    def test_timeout(self):
+        args = self.python_args("import time; time.sleep(30)")
+
+        with self.assertRaises(transcoding.TranscodingTimeout):
+            transcoding.stream_transcode(self.bucket.blob("uploads/sermon.wav"), self.bucket.blob("uploads/out.flac"), args=args, timeout=0.5)
+
+    def test_flac_path(self):
+        # not uploads/sermon.flac, in case they uploaded one of those too
+        self.assertEqual(transcoding.flac_path_for("uploads/sermon.mp3"), "uploads/sermon.mp3.converted.flac")
+        self.assertEqual(transcoding.flac_path_for("uploads/v1.2/sermon"), "uploads/v1.2/sermon.converted.flac")
+
+    @mock.patch("transcription.transcribe_class.shutil.which", return_value="/usr/bin/ffmpeg")
+    @mock.patch("transcription.transcoding.transcode_to_flac")
+    def test_only_converts_in_the_worker(self, transcode_to_flac, which):
+        transcribe_request = TranscribeRequest(make_file_data(file_type="audio/wav", file_path="uploads/sermon.wav"))
+        transcribe_request.makeItFlac()
+        transcode_to_flac.assert_not_called()
+        self.assertEqual(transcribe_request.file_path, "uploads/sermon.wav")
+
+        with self.settings(TRANSCODING={**settings.TRANSCODING, "WEB_TIMEOUT_SECONDS": 20}):
+            transcribe_request.makeItFlac()
+        transcode_to_flac.assert_called_once_with("uploads/sermon.wav", "uploads/sermon.wav.converted.flac", timeout=20)
+
+    @skipUnless(shutil.which("ffmpeg"), "ffmpeg isn't installed")
+    def test_make_it_flac(self):
+        transcribe_request = TranscribeRequest(make_file_data(file_type="audio/wav", file_path="uploads/sermon.wav"))
+        transcribe_request.transcode_timeout_seconds = settings.TRANSCODING["TIMEOUT_SECONDS"]
+
+        transcribe_request.makeItFlac()
+
+        self.assertEqual(transcribe_request.file_path, "uploads/sermon.wav.converted.flac")
+        self.assertEqual(transcribe_request.original_file_path, "uploads/sermon.wav")
+        info = transcribe_request.get_audio_info()
+        self.assertEqual((info["encoding"], info["channels"]), ("FLAC", 1))
+
+
+class ChunkingTest(FirestoreTestCase):
+    def make_chunk_results(self, words):
+        return [{"alternatives": [{"transcript": " ".join(words), "words": [{
+            "startTime": transcript_storage.ms_to_duration(i * 1000),
+            "endTime": transcript_storage.ms_to_duration(i * 1000 + 500),
+            "word": word,
+        } for i, word in enumerate(words)]}], "resultEndTime": f"{len(words)}s"}]
+
+    def test_plan_cuts_at_silences(self):
+        silences = [(280, 282), (590, 592), (700, 701), (1250, 1252)]
+
+        plan = chunking.plan_chunks(1500, silences, target_seconds=600, max_seconds=900)
+
+        self.assertEqual(plan, [(0, 591), (591, 1251), (1251, 1500)])
+
+    def test_plan_without_silences(self):
+        self.assertEqual(chunking.plan_chunks(2000, [], target_seconds=600, max_seconds=900), [(0, 900), (900, 1800), (1800, 2000)])
+        self.assertEqual(chunking.plan_chunks(300, [], target_seconds=600, max_seconds=900), [(0, 300)])
+
+    def test_stitch_rebases_times(self):
+        chunks = [{
+            "index": index,
+            "start_ms": start_ms,
+            "results": transcript_storage.compress_page(transcript_storage.pack_page(self.make_chunk_results(words))),
+        } for index, start_ms, words in [(1, 600500, ["ពីរ", "បី"]), (0, 0, ["មួយ"])]]
+
+        utterances = chunking.stitch(chunks)
+
+        self.assertEqual([utterance["alternatives"][0]["transcript"] for utterance in utterances], ["មួយ", "ពីរ បី"])
+        self.assertEqual(utterances[1]["alternatives"][0]["words"][1], {"startTime": "601.500s", "endTime": "602s", "word": "បី"})
+        self.assertEqual(utterances[1]["resultEndTime"], "602.500s")
+
+    @mock.patch("transcription.chunking.cut_chunks")
+    @mock.patch("transcription.chunking.detect_silences")
+    def test_chunked_request(self, detect_silences, cut_chunks):
+        detect_silences.return_value = [(599, 601), (1199, 1201)]
+        cut_chunks.side_effect = lambda source_blob, plan, file_path: [chunking.chunk_path_for(file_path, i) for i in range(len(plan))]
+        operation_futures = [mock.Mock() for i in range(3)]
+        for i, operation_future in enumerate(operation_futures):
+            operation_future.operation.name = f"op-{i}"
+        speech = mock.Mock()
+        speech.long_running_recognize.side_effect = operation_futures
+        clients.override("speech_client", speech)
+        self.addCleanup(clients.override, "speech_client", None)
+
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", chunked=True, audio_info={"duration_seconds": 1800}))
+        with self.settings(CHUNKING={**chunking.settings.CHUNKING, "MAX_CONCURRENT_OPERATIONS": 2, "MIN_DURATION_SECONDS": 60}):
+            transcribe_request.request_long_running_recognize()
+            # only two with Google at a time
+            self.assertEqual(speech.long_running_recognize.call_count, 2)
+            self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[3])
+
+            operations = {
+                "op-0": make_operation(done=True, results=self.make_chunk_results(["មួយ"])),
+                "op-1": make_operation(progress_percent=50),
+            }
+            with mock.patch("transcription.chunking.get_operation", side_effect=operations.get):
+                transcribe_request.check_transcription_progress()
+            # first one finished, so the third got sent
+            self.assertEqual(speech.long_running_recognize.call_count, 3)
+            self.assertEqual(transcribe_request.transcript_metadata["progress_percent"], 50)
+
+            operations = {
+                "op-1": make_operation(done=True, results=self.make_chunk_results(["ពីរ"])),
+                "op-2": make_operation(done=True, results=self.make_chunk_results(["បី"])),
+            }
+            with mock.patch("transcription.chunking.get_operation", side_effect=operations.get):
+                transcribe_request.check_transcription_progress()
+
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[5])
+        starts = [utterance["alternatives"][0]["words"][0]["startTime"] for utterance in transcribe_request.utterances]
+        self.assertEqual(starts, ["0s", "600s", "1200s"])
+
+    def start_chunked(self, speech_side_effect, cut_chunks):
+        """
+        three 10 minute chunks, all three with Google at once
+        """
+        cut_chunks.side_effect = lambda source_blob, plan, file_path: [chunking.chunk_path_for(file_path, i) for i in range(len(plan))]
+        self.speech = mock.Mock()
+        self.speech.long_running_recognize.side_effect = speech_side_effect
+        clients.override("speech_client", self.speech)
+        self.addCleanup(clients.override, "speech_client", None)
+        chunk_settings = self.settings(CHUNKING={**chunking.settings.CHUNKING, "MAX_CONCURRENT_OPERATIONS": 3, "MIN_DURATION_SECONDS": 60, "MAX_CHUNK_ATTEMPTS": 2})
+        chunk_settings.enable()
+        self.addCleanup(chunk_settings.disable)
+
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", chunked=True, audio_info={"duration_seconds": 1800}))
+        transcribe_request.request_long_running_recognize()
+        return transcribe_request
+
+    def operation_future(self, name):
+        operation_future = mock.Mock()
+        operation_future.operation.name = name
+        return operation_future
+
+    def chunk_statuses(self, transcribe_request):
+        return [chunk["status"] for chunk in chunking.ChunkedRecognition(transcribe_request).load_chunks()]
+
+    def errored_operation(self):
+        return {**make_operation(), "error": {"code": 13, "message": "internal"}}
+
+    @mock.patch("transcription.chunking.cut_chunks")
+    @mock.patch("transcription.chunking.detect_silences", return_value=[(599, 601), (1199, 1201)])
+    def test_times_come_from_the_chunks(self, detect_silences, cut_chunks):
+        transcribe_request = self.start_chunked([self.operation_future(f"op-{i}") for i in range(3)], cut_chunks)
+        operations = {
+            "op-0": make_operation(progress_percent=50),
+            "op-1": {**make_operation(progress_percent=50), "metadata": {"progressPercent": 50, "startTime": "2020-04-25T21:20:00Z", "lastUpdateTime": "2020-04-25T21:30:00.5Z"}},
+            "op-2": make_operation(progress_percent=50),
+        }
+
+        for _ in range(2):
+            with mock.patch("transcription.chunking.get_operation", side_effect=operations.get):
+                operation_dict = chunking.ChunkedRecognition(transcribe_request).get_operation(transcribe_request.chunk_config())
+
+            # earliest start, latest update, the same every time nothing moves
+            self.assertEqual(operation_dict["metadata"]["startTime"], "2020-04-25T21:20:00Z")
+            self.assertEqual(operation_dict["metadata"]["lastUpdateTime"], "2020-04-25T21:30:00.5Z")
+
+        # nothing moved since the last check, so no heartbeat for the stuck request sweeper
+        transcribe_request.transcript_metadata = {"progress_percent": 50, "start_time": "20200425T212000Z", "last_updated_at": "20200425T213000Z"}
+        updated_at_time = transcribe_request.updated_at_time
+        with mock.patch("transcription.chunking.get_operation", side_effect=operations.get):
+            transcribe_request.check_transcription_progress()
+
+        self.assertEqual(transcribe_request.updated_at_time, updated_at_time)
+        self.assertEqual(transcribe_request.transcript_metadata["last_updated_at"], "20200425T213000Z")
+
+    @mock.patch("transcription.chunking.cut_chunks")
+    @mock.patch("transcription.chunking.detect_silences", return_value=[(599, 601), (1199, 1201)])
+    def test_errored_chunk_gets_sent_again(self, detect_silences, cut_chunks):
+        futures = [self.operation_future(name) for name in ["op-0", "op-1", "op-2", "op-1-again", "op-1-third"]]
+        transcribe_request = self.start_chunked(futures, cut_chunks)
+
+        operations = {"op-0": make_operation(done=True, results=self.make_chunk_results(["មួយ"])), "op-1": self.errored_operation(), "op-2": make_operation()}
+        with mock.patch("transcription.chunking.get_operation", side_effect=operations.get):
+            transcribe_request.check_transcription_progress()
+
+        # just that chunk went again, and the request keeps going
+        self.assertEqual(self.speech.long_running_recognize.call_count, 4)
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[3])
+        self.assertEqual(self.chunk_statuses(transcribe_request), ["done", "transcribing", "transcribing"])
+
+        # errors again, and that's as many tries as it gets
+        operations = {"op-1-again": self.errored_operation(), "op-2": make_operation()}
+        with mock.patch("transcription.chunking.get_operation", side_effect=operations.get):
+            transcribe_request.check_transcription_progress()
+
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[7])
+        self.assertEqual(self.chunk_statuses(transcribe_request), ["done", "error", "transcribing"])
+
+        # resuming only sends the errored one. The rest don't get cut, uploaded or sent again
+        transcribe_request.request_long_running_recognize()
+        self.assertEqual(cut_chunks.call_count, 1)
+        self.assertEqual(self.speech.long_running_recognize.call_count, 5)
+        self.assertEqual(self.chunk_statuses(transcribe_request), ["done", "transcribing", "transcribing"])
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[3])
+
+    @mock.patch("transcription.chunking.cut_chunks")
+    @mock.patch("transcription.chunking.detect_silences", return_value=[(599, 601), (1199, 1201)])
+    def test_chunks_sent_before_an_error_are_kept(self, detect_silences, cut_chunks):
+        futures = [self.operation_future("op-0"), exceptions.PermissionDenied("nope"), self.operation_future("op-1"), self.operation_future("op-2")]
+        transcribe_request = self.start_chunked(futures, cut_chunks)
+
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[7])
+        chunks = chunking.ChunkedRecognition(transcribe_request).load_chunks()
+        self.assertEqual([chunk["status"] for chunk in chunks], ["transcribing", "pending", "pending"])
+        self.assertEqual(chunks[0]["transaction_id"], "op-0")
+
+        transcribe_request.request_long_running_recognize()
+        self.assertEqual(cut_chunks.call_count, 1)
+        self.assertEqual([chunk["transaction_id"] for chunk in chunking.ChunkedRecognition(transcribe_request).load_chunks()], ["op-0", "op-1", "op-2"])
+
+
+class RetryPolicyTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        retry_policy.reset_stats()
+        self.sleep = mock.Mock()
+
+    def call(self, errors, **kwargs):
+        """
+        call that raises each of errors in turn, then works
+        """
+        results = list(errors) + ["operation"]
+        def call():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return retry_policy.call_with_retries(call, sleep=self.sleep, random_fn=lambda: 1, **kwargs)
+
+    def test_classify(self):
+        for error, name in [
+            (exceptions.InvalidArgument("Must use single channel (mono) audio, but WAV header indicates 2 channels."), "channels"),
+            (exceptions.InvalidArgument("Invalid recognition 'config': bad sample rate hertz."), "sample-rate"),
+            (exceptions.InvalidArgument("WAV header indicates an unsupported format."), "unsupported-format"),
+            (exceptions.InternalServerError("13 INTERNAL"), "internal"),
+            (ConnectionResetError(104, "Connection reset by peer"), "connection"),
+            (ValueError("who knows"), "unknown"),
+        ]:
+            self.assertEqual(retry_policy.classify(error).name, name)
+
+    def test_backs_off_on_transient_errors(self):
+        result = self.call([exceptions.InternalServerError("13 INTERNAL"), exceptions.ServiceUnavailable("unavailable")])
+
+        self.assertEqual(result, "operation")
+        # exponential, from BASE_DELAY_SECONDS
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [1, 2])
+        self.assertEqual(retry_policy.stats()["errors"], {"internal": 1, "unavailable": 1})
+
+    def test_budget(self):
+        errors = [exceptions.InternalServerError("13 INTERNAL")] * 10
+
+        with self.assertRaises(exceptions.InternalServerError):
+            self.call(errors, budget=retry_policy.RetryBudget(max_attempts=10, max_wait_seconds=5))
+
+        # 1 + 2, then the next 4 would go over
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_fails_fast(self):
+        with self.assertRaises(exceptions.PermissionDenied):
+            self.call([exceptions.PermissionDenied("no")])
+
+        self.sleep.assert_not_called()
+        self.assertEqual(retry_policy.stats()["actions"], {retry_policy.FAIL: 1})
+
+    def test_request_reconfigures(self):
+        speech = mock.Mock()
+        speech.long_running_recognize.side_effect = [
+            exceptions.InvalidArgument("Invalid audio channel count"),
+            exceptions.InvalidArgument("bad sample rate hertz."),
+            exceptions.InvalidArgument("bad sample rate hertz."),
+            mock.Mock(**{"operation.name": "1234567890"}),
+        ]
+        clients.override("speech_client", speech)
+        self.addCleanup(clients.override, "speech_client", None)
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", audio_info={"sample_rate_hertz": 44100}))
+        transcribe_request.setup_request()
+
+        transcribe_request.request_long_running_recognize()
+
+        configs = [c.args[0] for c in speech.long_running_recognize.call_args_list]
+        self.assertEqual([config.get("enable_separate_recognition_per_channel") for config in configs], [None, True, True, True])
+        self.assertEqual([config["sample_rate_hertz"] for config in configs], [44100, 44100, None, 16000])
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[3])
+
+    def test_request_gives_up_on_sample_rate(self):
+        speech = mock.Mock()
+        speech.long_running_recognize.side_effect = exceptions.InvalidArgument("bad sample rate hertz.")
+        clients.override("speech_client", speech)
+        self.addCleanup(clients.override, "speech_client", None)
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", audio_info={}))
+        transcribe_request.setup_request()
+
+        transcribe_request.request_long_running_recognize()
+
+        # None (what we sent first), then 16000, then nothing left to try
+        self.assertEqual(speech.long_running_recognize.call_count, 2)
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[7])
+
+    def test_reconfigure_failing_marks_once(self):
+        speech = mock.Mock()
+        speech.long_running_recognize.side_effect = exceptions.InvalidArgument("Invalid audio channel count")
+        clients.override("speech_client", speech)
+        self.addCleanup(clients.override, "speech_client", None)
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", audio_info={}))
+        transcribe_request.setup_request()
+
+        with mock.patch.object(TranscribeRequest, "_build_request_params", side_effect=Exception("couldn't set up")):
+            transcribe_request.request_long_running_recognize()
+
+        # just the transcribing error, not a server error first
+        event_logs = [data for path, data in self.db.documents.items() if "/eventLogs/" in path]
+        self.assertEqual([event_log["event"] for event_log in event_logs], [TRANSCRIPTION_STATUSES[7]])
+
+    def test_web_requests_wait_less(self):
+        transcribe_request = TranscribeRequest(make_file_data())
+        self.assertEqual(transcribe_request.retry_budget().max_wait_seconds, settings.RETRY["WEB_BUDGET_SECONDS"])
+
+        # e.g., in the worker
+        transcribe_request.retry_wait_seconds = settings.RETRY["BUDGET_SECONDS"]
+        self.assertEqual(transcribe_request.retry_budget().max_wait_seconds, settings.RETRY["BUDGET_SECONDS"])
+
+
+class TranscriptCacheTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.speech = mock.Mock()
+        self.speech.long_running_recognize.return_value = mock.Mock(**{"operation.name": "1234567890"})
+        clients.override("speech_client", self.speech)
+        self.addCleanup(clients.override, "speech_client", None)
+
+        audio = make_flac_header(channels=1, sample_rate=16000) + b"\x01" * 5000
+        self.bucket.blobs["uploads/user-1/sermon.flac"] = audio
+        self.bucket.blobs["uploads/user-2/renamed.flac"] = audio
+
+    def send(self, **overrides):
+        transcribe_request = TranscribeRequest(make_file_data(**overrides))
+        transcribe_request.setup_request()
+        transcribe_request.request_long_running_recognize()
+        return transcribe_request
+
+    def test_key_depends_on_config(self):
+        config = dict(TranscribeRequest._flac_config)
+
+        self.assertEqual(transcript_cache.cache_key("abc", config), transcript_cache.cache_key("abc", {**config, "audio": "ignored"}))
+        self.assertNotEqual(transcript_cache.cache_key("abc", config), transcript_cache.cache_key("abc", {**config, "audio_channel_count": 2}))
+        self.assertNotEqual(transcript_cache.cache_key("abc", config), transcript_cache.cache_key("abd", config))
+
+    def test_second_upload_skips_google(self):
+        first = self.send(file_path="uploads/user-1/sermon.flac")
+        with first.batched_writes():
+            first._handle_operation(make_operation(done=True))
+        self.assertEqual(self.speech.long_running_recognize.call_count, 1)
+
+        second = self.send(id="request-2", user_id="user-2", filename="renamed.flac", file_path="uploads/user-2/renamed.flac")
+
+        self.assertEqual(self.speech.long_running_recognize.call_count, 1)
+        self.assertEqual(second.status, TRANSCRIPTION_STATUSES[5])
+        # its own id, but still says where it came from
+        self.assertEqual(second.transaction_id, "cache-request-2")
+        self.assertEqual(second.transcript_document_name(), "renamed.flac-at-cache-request-2")
+        self.assertEqual(second.transcript_metadata["cached_transaction_id"], first.transaction_id)
+        self.assertEqual(first.transaction_id, "1234567890")
+        manifest, utterances = transcript_storage.read_transcript(second.transcript_document_ref())
+        self.assertEqual(manifest["filename"], "renamed.flac")
+        self.assertEqual(utterances, make_operation(done=True)["response"]["results"])
+        self.assertFalse(self.bucket.blob("uploads/user-2/renamed.flac").exists())
+
+    def test_different_config_misses(self):
+        first = self.send(file_path="uploads/user-1/sermon.flac")
+        with first.batched_writes():
+            first._handle_operation(make_operation(done=True))
+
+        self.send(id="request-2", user_id="user-2", file_path="uploads/user-2/renamed.flac", audio_info={"channels": 2})
+
+        self.assertEqual(self.speech.long_running_recognize.call_count, 2)
+
+
+@override_settings(
+    OPERATION_POLLER={**settings.OPERATION_POLLER, "ENABLED": False},
+    STORAGE_CLEANUP={**settings.STORAGE_CLEANUP, "BACKGROUND": False},
+)
+class LifecycleTest(FirestoreTestCase):
+    """
+    the whole thing, with Google faked too (same setup as benchmarks/lifecycle.py)
+    """
+    def setUp(self):
+        super().setUp()
+        self.results = make_operation(done=True)["response"]["results"]
+        self.speech = FakeSpeech(results_fn=lambda name: self.results)
+        for name in ["speech_client", "operations_api"]:
+            clients.override(name, self.speech)
+            self.addCleanup(clients.override, name, None)
+
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        self.bucket.blobs["uploads/sermon.flac"] = make_flac_header(channels=1, sample_rate=16000) + b"\x01" * 5000
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(file_path="uploads/sermon.flac", status=TRANSCRIPTION_STATUSES[1]))
+
+    def post(self, view):
+        request = RequestFactory().post("/", data=json.dumps(make_file_data(file_path="uploads/sermon.flac")), content_type="application/json")
+        return json.loads(view(request).content)
+
+    def test_transcribe_until_processed(self):
+        data = self.post(views.transcribe)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[3])
+
+        data = self.post(views.check_status)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[3])
+        self.assertEqual(data["progress_percent"], 50)
+
+        data = self.post(views.check_status)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[5])
+
+        self.assertEqual(self.speech.rpc_counts, {"long_running_recognize": 1, "get_operation": 2})
+        transcribe_request = TranscribeRequest(make_file_data(transaction_id=data["current_request_data"]["transaction_id"]))
+        manifest, utterances = transcript_storage.read_transcript(transcribe_request.transcript_document_ref())
+        self.assertEqual([utterance["alternatives"][0]["transcript"] for utterance in utterances], ["សួស្តី"])
+        self.assertFalse(self.bucket.blob("uploads/sermon.flac").exists())
+
+
+class AsyncViewsTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+
+    def post(self, view, payload):
+        request = self.factory.post("/", data=json.dumps(payload), content_type="application/json")
+        return async_to_sync(view)(request)
+
+    def test_check_status(self):
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(
+            status=TRANSCRIPTION_STATUSES[3],
+            transaction_id="1234567890",
+            transcript_metadata={"progress_percent": 42},
+        ))
+
+        response = self.post(async_views.check_status, make_file_data())
+
+        data = json.loads(response.content)
+        self.assertEqual(data["progress_percent"], 42)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[3])
+
+    def test_reads_run_at_the_same_time(self):
+        self.db.latency_seconds = 0.2
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[3], updated_at=timestamp()))
+
+        start = time.monotonic()
+        response = self.post(async_views.resume_request, make_file_data())
+
+        self.assertEqual(response.status_code, 200)
+        # request doc at the same time as the user doc then customQuotas doc. One after the other would be at least 0.6s
+        self.assertLess(time.monotonic() - start, 0.55)
+        # still waiting on Google, so no need for the event logs
+        self.assertEqual(self.db.rpc_counts["query"], 0)
+
+    def test_resume_reads_event_logs_when_needed(self):
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[2], updated_at="20200425T212207Z"))
+
+        with mock.patch.object(TranscribeRequest, "send_to_google") as send_to_google:
+            response = self.post(async_views.resume_request, make_file_data())
+
+        self.assertEqual(send_to_google.call_count, 1)
+        # to see whether the server already marked it as received
+        self.assertEqual(self.db.rpc_counts["query"], 1)
+
+    def test_transcribe(self):
+        self.db.write("customQuotas/someone@example.com", {"audioFileSizeMB": 500})
+
+        with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True) as send_to_google:
+            response = self.post(async_views.transcribe, make_file_data())
+
+        self.assertEqual(response.status_code, 200)
+        transcribe_request = send_to_google.call_args[0][0]
+        self.assertEqual(transcribe_request.custom_quotas, {"audioFileSizeMB": 500})
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[2])
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-1")["status"], TRANSCRIPTION_STATUSES[2])
+
+    def test_csrf_exempt(self):
+        for view in [async_views.transcribe, async_views.transcribe_batch, async_views.resume_request, async_views.check_status]:
+            self.assertTrue(asyncio.iscoroutinefunction(view))
+            self.assertTrue(view.csrf_exempt)
+
+
+@override_settings(PROGRESS_STREAM={"POLL_SECONDS": 0.02, "HEARTBEAT_SECONDS": 0.05, "HISTORY_SIZE": 5, "MAX_STREAM_SECONDS": 1, "RECONNECT_MS": 3000})
+class ProgressStreamTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hub = progress_stream.ProgressHub()
+        clients.override("progress_hub", self.hub)
+        self.addCleanup(clients.override, "progress_hub", None)
+        self.path = "users/user-1/transcribeRequests/request-1"
+        self.db.write(self.path, make_file_data(status=TRANSCRIPTION_STATUSES[3], transcript_metadata={"progress_percent": 10}))
+
+    def update(self, fields):
+        self.db.document(self.path).set(fields, merge=True)
+
+    def stream(self, **params):
+        request = RequestFactory().get("/progress/", {"id": "request-1", "user_id": "user-1", **params})
+        response = views.progress(request)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    def events(self, text):
+        return [json.loads(line[len("data: "):]) for line in text.splitlines() if line.startswith("data: ")]
+
+    def event_ids(self, text):
+        return [line[len("id: "):] for line in text.splitlines() if line.startswith("id: ")]
+
+    def test_one_watcher_for_every_subscriber(self):
+        first = progress_stream.Subscriber()
+        second = progress_stream.Subscriber()
+        watcher = self.hub.subscribe("user-1", "request-1", first)
+        self.assertIs(self.hub.subscribe("user-1", "request-1", second), watcher)
+
+        self.assertEqual(first.get(timeout=1)["data"]["progress_percent"], 10)
+        self.assertEqual(second.get(timeout=1)["data"]["progress_percent"], 10)
+
+        self.update({"transcript_metadata": {"progress_percent": 60}})
+        self.assertEqual(first.get(timeout=1)["data"]["progress_percent"], 60)
+        self.assertEqual(second.get(timeout=1)["data"]["progress_percent"], 60)
+
+        # one read per tick, however many are watching. Then stops once the request is done
+        reads_before = self.db.rpc_counts["get"]
+        time.sleep(0.1)
+        self.assertLess(self.db.rpc_counts["get"] - reads_before, 8)
+
+        self.update({"status": TRANSCRIPTION_STATUSES[5]})
+        self.assertEqual(first.get(timeout=1)["data"]["status"], TRANSCRIPTION_STATUSES[5])
+        watcher._thread.join(timeout=1)
+        self.assertEqual(self.hub.watchers, {})
+
+    def test_stream_ends_when_done(self):
+        self.update({"status": TRANSCRIPTION_STATUSES[5], "transcript_metadata": {"progress_percent": 100}})
+
+        text = self.stream()
+
+        self.assertTrue(text.startswith("retry: 3000"))
+        self.assertEqual(self.events(text), [{"status": TRANSCRIPTION_STATUSES[5], "progress_percent": 100, "updated_at": None, "error": ""}])
+
+    def test_reconnect_with_last_event_id(self):
+        self.update({"status": TRANSCRIPTION_STATUSES[5]})
+        event_id = self.event_ids(self.stream())[0]
+
+        # already has the last event, so nothing new to send
+        self.assertEqual(self.events(self.stream(last_event_id=event_id)), [])
+
+    def test_replays_missed_events(self):
+        watcher = progress_stream.ProgressWatcher(self.hub, "user-1", "request-1", 1, 5)
+        events = [progress_stream.make_event({"status": TRANSCRIPTION_STATUSES[3], "progress_percent": percent, "updated_at": None, "error": ""}) for percent in [10, 20, 30]]
+        for event in events:
+            watcher.publish(event)
+
+        subscriber = progress_stream.Subscriber()
+        watcher.subscribe(subscriber, last_event_id=events[0]["id"])
+        self.assertEqual([subscriber.get(timeout=0), subscriber.get(timeout=0), subscriber.get(timeout=0)], events[1:] + [None])
+
+    def test_heartbeat(self):
+        text = self.stream()
+
+        # still transcribing the whole time, so one event then heartbeats until MAX_STREAM_SECONDS
+        self.assertEqual(len(self.events(text)), 1)
+        self.assertIn(progress_stream.HEARTBEAT, text)
+
+    def test_needs_ids(self):
+        response = views.progress(RequestFactory().get("/progress/", {"id": "request-1"}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_doc_without_ids(self):
+        # like the client writes it, the ids are only in the path
+        file_data = make_file_data(status=TRANSCRIPTION_STATUSES[3], transcript_metadata={"progress_percent": 10})
+        del file_data["id"], file_data["user_id"]
+        self.db.write(self.path, file_data)
+        watcher = progress_stream.ProgressWatcher(self.hub, "user-1", "request-1", 1, 5)
+        self.assertEqual(watcher.read_state()["data"]["progress_percent"], 10)
+
+        self.update({"transcript_metadata": {"progress_percent": 60}})
+        self.assertEqual(watcher.read_state()["data"]["progress_percent"], 60)
+
+    @skipUnless(django.VERSION < (4, 2), "streams from an async generator on django 4.2+")
+    def test_async_view_sends_one_event_at_a_time(self):
+        request = AsyncRequestFactory().get("/progress/?id=request-1&user_id=user-1")
+
+        start = time.monotonic()
+        response = async_to_sync(async_views.progress)(request)
+        text = b"".join(response.streaming_content).decode("utf-8")
+
+        self.assertEqual(self.events(text), [{"status": TRANSCRIPTION_STATUSES[3], "progress_percent": 10, "updated_at": None, "error": ""}])
+        # instead of until MAX_STREAM_SECONDS
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class BatchSubmissionTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        self.sent = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def send(self, transcribe_request):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.sent.append(transcribe_request.id)
+
+        if transcribe_request.id == "request-broken":
+            raise Exception("something went wrong")
+
+    def files(self, count):
+        return [make_file_data(id=f"request-{index}", filename=f"sermon-{index}.flac") for index in range(count)]
+
+    def test_one_quota_lookup_and_one_write(self):
+        results = batch_submission.submit_batch(self.files(5), self.send)
+
+        self.assertTrue(all(result["ok"] for result in results))
+        self.assertEqual(sorted(self.sent), [f"request-{index}" for index in range(5)])
+        # user doc and customQuotas doc, once for all five
+        self.assertEqual(self.db.rpc_counts["get"], 2)
+        # every status and event log, in one batch
+        self.assertEqual(self.db.rpc_counts["commit"], 1)
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-3")["status"], TRANSCRIPTION_STATUSES[2])
+
+    @override_settings(BATCH_SUBMISSION={"MAX_ITEMS": 100, "MAX_CONCURRENT": 2})
+    def test_caps_concurrent_submissions(self):
+        batch_submission.submit_batch(self.files(6), self.send)
+
+        self.assertEqual(len(self.sent), 6)
+        self.assertEqual(self.max_running, 2)
+
+    def test_partial_failures(self):
+        file_datas = [
+            make_file_data(id="request-ok"),
+            make_file_data(id="request-too-big", file_size=1024 * 1048576),
+            make_file_data(id="request-broken"),
+            {"id": "request-no-filename"},
+        ]
+
+        results = batch_submission.submit_batch(file_datas, self.send)
+
+        self.assertEqual([result["ok"] for result in results], [True, False, False, False])
+        self.assertIn("File size is larger than maximum", results[1]["error"])
+        self.assertEqual(results[2]["current_request_data"]["status"], TRANSCRIPTION_STATUSES[6])
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-too-big")["status"], TRANSCRIPTION_STATUSES[6])
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-broken")["status"], TRANSCRIPTION_STATUSES[6])
+        # too big never got sent
+        self.assertEqual(sorted(self.sent), ["request-broken", "request-ok"])
+
+    def test_view(self):
+        request = RequestFactory().post("/", data=json.dumps({"files": self.files(2)}), content_type="application/json")
+
+        with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True, side_effect=self.send):
+            response = views.transcribe_batch(request)
+
+        self.assertEqual([result["index"] for result in json.loads(response.content)["results"]], [0, 1])
+
+
+class JobQueueTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "jobs.sqlite3")
+        self.queue = SQLiteJobQueue(path=self.path, visibility_timeout=60, max_attempts=2)
+
+    def test_claimed_job_is_hidden(self):
+        job_id = self.queue.enqueue("transcribe", {"id": "request-1"})
+
+        jobs_claimed = self.queue.claim(limit=5)
+        self.assertEqual([(job.id, job.payload, job.attempts) for job in jobs_claimed], [(job_id, {"id": "request-1"}, 1)])
+        self.assertEqual(self.queue.claim(), [])
+
+        self.assertTrue(self.queue.complete(jobs_claimed[0]))
+        self.assertEqual(self.queue.counts()["done"], 1)
+
+    def test_comes_back_after_visibility_timeout(self):
+        self.queue.visibility_timeout = 0.05
+        self.queue.enqueue("transcribe", {})
+        first = self.queue.claim()[0]
+
+        time.sleep(0.1)
+        # e.g., first worker died
+        second = self.queue.claim()[0]
+        self.assertEqual(second.attempts, 2)
+        # first worker can't finish it anymore
+        self.assertFalse(self.queue.complete(first))
+        self.assertTrue(self.queue.complete(second))
+
+    def test_no_two_workers_get_the_same_job(self):
+        for index in range(50):
+            self.queue.enqueue("transcribe", {"index": index})
+
+        claimed = []
+        def claim():
+            # its own connection, like another worker would have
+            queue = SQLiteJobQueue(path=self.path)
+            while True:
+                jobs_claimed = queue.claim(limit=3)
+                if not jobs_claimed:
+                    return
+                claimed.extend(job.id for job in jobs_claimed)
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claimed), list(range(1, 51)))
+
+    @override_settings(RETRY={"MAX_ATTEMPTS": 5, "BUDGET_SECONDS": 0, "BASE_DELAY_SECONDS": 0, "MAX_DELAY_SECONDS": 0})
+    def test_retries_then_dead(self):
+        self.queue.enqueue("transcribe", {})
+
+        self.assertFalse(self.queue.fail(self.queue.claim()[0], Exception("try again")))
+        self.assertTrue(self.queue.fail(self.queue.claim()[0], Exception("still broken")))
+        self.assertEqual(self.queue.claim(), [])
+        self.assertEqual(self.queue.counts()["dead"], 1)
+
+
+@override_settings(RETRY={"MAX_ATTEMPTS": 5, "BUDGET_SECONDS": 0, "BASE_DELAY_SECONDS": 0, "MAX_DELAY_SECONDS": 0})
+class JobWorkerTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.queue = SQLiteJobQueue(path=os.path.join(directory, "jobs.sqlite3"), max_attempts=3)
+        clients.override("job_queue", self.queue)
+        self.addCleanup(clients.override, "job_queue", None)
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        # client makes the doc when it uploads
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[1]))
+        self.sends = 0
+
+    def send(self, transcribe_request):
+        self.sends += 1
+        if self.sends == 1:
+            raise Exception("ffmpeg died")
+
+        transcribe_request._update_status(TRANSCRIPTION_STATUSES[3], other={"transaction_id": "1234567890"})
+
+    def test_retries_from_where_it_left_off(self):
+        jobs.enqueue_transcribe(make_file_data())
+
+        with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True, side_effect=self.send):
+            jobs.JobWorker(threads=2).drain()
+
+        self.assertEqual(self.sends, 2)
+        self.assertEqual(self.queue.counts()["done"], 1)
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-1")["status"], TRANSCRIPTION_STATUSES[3])
+        # marked as received once, not once per try
+        event_logs = [data["event"] for path, data in self.db.documents.items() if "/transcribeRequests/request-1/" in path]
+        self.assertEqual(sorted(event_logs), sorted([TRANSCRIPTION_STATUSES[2], TRANSCRIPTION_STATUSES[3]]))
+
+    def test_invalid_file_isnt_retried(self):
+        jobs.enqueue_transcribe(make_file_data(file_size=1024 * 1048576))
+
+        with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True) as send:
+            jobs.JobWorker().drain()
+
+        send.assert_not_called()
+        self.assertEqual(self.queue.counts()["done"], 1)
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-1")["status"], TRANSCRIPTION_STATUSES[6])
+
+    def test_marks_as_error_when_out_of_attempts(self):
+        jobs.enqueue_transcribe(make_file_data())
+
+        with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True, side_effect=Exception("ffmpeg died")):
+            jobs.JobWorker().drain()
+
+        self.assertEqual(self.queue.counts()["dead"], 1)
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-1")["status"], TRANSCRIPTION_STATUSES[6])
+
+    def test_view_just_enqueues(self):
+        self.queue.heartbeat("worker-1")
+        request = RequestFactory().post("/", data=json.dumps(make_file_data()), content_type="application/json")
+
+        with override_settings(JOB_QUEUE={**settings.JOB_QUEUE, "ENABLED": True}):
+            response = views.transcribe(request)
+
+        self.assertEqual(json.loads(response.content)["job_id"], 1)
+        self.assertEqual(sum(self.db.rpc_counts.values()), 0)
+        self.assertEqual(self.queue.counts()["queued"], 1)
+
+    def test_view_transcribes_itself_without_a_worker(self):
+        # e.g., worker on another dyno, with its own sqlite file
+        request = RequestFactory().post("/", data=json.dumps(make_file_data()), content_type="application/json")
+
+        with override_settings(JOB_QUEUE={**settings.JOB_QUEUE, "ENABLED": True}):
+            with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True) as send:
+                views.transcribe(request)
+
+        send.assert_called_once()
+        self.assertEqual(self.queue.counts()["queued"], 0)
+
+    def test_worker_sends_heartbeat(self):
+        self.assertFalse(self.queue.has_worker(30))
+        jobs.JobWorker().drain()
+        self.assertTrue(self.queue.has_worker(30))
+
+    def test_batch_just_enqueues(self):
+        self.queue.heartbeat("worker-1")
+        file_datas = [make_file_data(id="request-1"), make_file_data(id="request-2"), {"id": "request-no-filename"}]
+        request = RequestFactory().post("/", data=json.dumps({"files": file_datas}), content_type="application/json")
+
+        with override_settings(JOB_QUEUE={**settings.JOB_QUEUE, "ENABLED": True}):
+            with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True) as send:
+                response = views.transcribe_batch(request)
+
+        results = json.loads(response.content)["results"]
+        self.assertEqual([result.get("job_id") for result in results], [1, 2, None])
+        self.assertEqual([result["ok"] for result in results], [True, True, False])
+        send.assert_not_called()
+        self.assertEqual(sum(self.db.rpc_counts.values()), 0)
+        self.assertEqual(self.queue.counts()["queued"], 2)
+
+
+class StorageCleanupTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        clients.override("cleanup_pool", self.pool)
+        self.addCleanup(clients.override, "cleanup_pool", None)
+        self.bucket.blobs = {"uploads/sermon.flac": b"flac", "uploads/sermon.mp3": b"mp3"}
+
+    def finish_transcript(self):
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", original_file_path="uploads/sermon.mp3"))
+        transcribe_request.handle_transcript_results([{"alternatives": [{"transcript": "សួស្តី", "confidence": 0.9}]}])
+        # wait for the background deletes
+        self.pool.shutdown(wait=True)
+        return transcribe_request
+
+    def ledger(self):
+        return {path: data for path, data in self.db.documents.items() if path.startswith(storage_cleanup.LEDGER_COLLECTION + "/")}
+
+    def test_deletes_in_background(self):
+        transcribe_request = self.finish_transcript()
+
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[5])
+        self.assertEqual(self.bucket.blobs, {})
+        # no exists() first, just deletes
+        self.assertEqual(dict(self.bucket.rpc_counts), {"delete": 2})
+        self.assertEqual(self.ledger(), {})
+
+    def test_already_deleted_counts_as_deleted(self):
+        del self.bucket.blobs["uploads/sermon.mp3"]
+
+        self.finish_transcript()
+
+        self.assertEqual(self.ledger(), {})
+
+    def test_sweeper_retries_failed_deletes(self):
+        with mock.patch("transcription.fakes.FakeBlob.delete", side_effect=exceptions.ServiceUnavailable("try again")):
+            transcribe_request = self.finish_transcript()
+
+        # didn't hold up finishing the transcript
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[5])
+        ledger = self.ledger()
+        self.assertEqual(sorted(entry["path"] for entry in ledger.values()), ["uploads/sermon.flac", "uploads/sermon.mp3"])
+        self.assertTrue(all(entry["attempts"] == 1 and entry["retry_at"] > time.time() for entry in ledger.values()))
+
+        # not due yet
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        clients.override("cleanup_pool", self.pool)
+        self.assertEqual(storage_cleanup.StorageSweeper().sweep_once(), (0, 0))
+
+        with mock.patch("time.time", return_value=time.time() + 24 * 60 * 60):
+            self.assertEqual(storage_cleanup.StorageSweeper().sweep_once(), (2, 0))
+
+        self.assertEqual(self.bucket.blobs, {})
+        self.assertEqual(self.ledger(), {})
+
+
+class AdmissionTest(FirestoreTestCase):
+    def hold(self, controller, seconds):
+        with controller.admit():
+            time.sleep(seconds)
+
+    def test_requests_per_minute(self):
+        # 10 a second, and 2 can go right away
+        controller = AdmissionController(requests_per_minute=600, burst=2, max_concurrent=10)
+
+        start = time.monotonic()
+        for _ in range(4):
+            with controller.admit():
+                pass
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        stats = controller.stats()
+        self.assertEqual((stats["admitted"], stats["delayed"], stats["in_flight"]), (4, 2, 0))
+
+    def test_max_concurrent(self):
+        controller = AdmissionController(requests_per_minute=6000, burst=100, max_concurrent=2)
+        in_flight = []
+        original = controller._wait_for_room
+        def wait_for_room(max_wait_seconds):
+            original(max_wait_seconds)
+            in_flight.append(controller.in_flight)
+        controller._wait_for_room = wait_for_room
+
+        threads = [threading.Thread(target=self.hold, args=(controller, 0.05)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(max(in_flight), 2)
+        self.assertGreaterEqual(controller.stats()["max_queue_depth"], 3)
+        self.assertEqual(controller.stats()["admitted"], 5)
+
+    def test_gives_up_after_max_wait(self):
+        controller = AdmissionController(max_concurrent=1, max_wait_seconds=0.05)
+        holder = threading.Thread(target=self.hold, args=(controller, 0.3))
+        holder.start()
+        time.sleep(0.05)
+
+        with self.assertRaises(AdmissionTimeout):
+            with controller.admit():
+                pass
+
+        holder.join()
+        self.assertEqual(controller.stats()["timed_out"], 1)
+
+    def test_waiting_too_long_isnt_a_transcribing_error(self):
+        controller = AdmissionController(max_concurrent=1, max_wait_seconds=0)
+        controller.in_flight = 1
+        clients.override("admission", controller)
+        speech = mock.Mock()
+        clients.override("speech_client", speech)
+        self.addCleanup(clients.override, "speech_client", None)
+        transcribe_request = TranscribeRequest(make_file_data(file_path="uploads/sermon.flac", status=TRANSCRIPTION_STATUSES[2]))
+        transcribe_request.setup_request()
+
+        with self.assertRaises(AdmissionTimeout):
+            transcribe_request.request_long_running_recognize()
+
+        speech.long_running_recognize.assert_not_called()
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[2])
+        self.assertEqual(transcribe_request.failed_attempts, 0)
+
+    def test_counted_as_its_own_kind_of_error(self):
+        retry_policy.reset_stats()
+        self.assertEqual(retry_policy.classify(AdmissionTimeout("waited 60s")).name, "admission-timeout")
+
+        with self.assertRaises(AdmissionTimeout):
+            retry_policy.call_with_retries(mock.Mock(side_effect=AdmissionTimeout("waited 60s")), sleep=lambda seconds: None)
+
+        self.assertEqual(retry_policy.stats()["errors"], {"admission-timeout": 1})
+
+    @override_settings(ADMISSION={**settings.ADMISSION, "OPERATIONS_REFRESH_SECONDS": 0.1})
+    def test_max_operations_at_google(self):
+        # the calls themselves are quick, it's the operations they start that take a while
+        at_google = [2]
+        controller = AdmissionController(max_concurrent=10, max_operations=2, max_wait_seconds=0.05, count_operations=lambda: at_google[0])
+
+        with self.assertRaises(AdmissionTimeout):
+            with controller.admit():
+                pass
+
+        # one finished, and we see it once we count again
+        at_google[0] = 1
+        time.sleep(0.1)
+        with controller.admit():
+            pass
+
+        # and the one we just started counts, even before firestore knows about it
+        with self.assertRaises(AdmissionTimeout):
+            with controller.admit():
+                pass
+
+        # waits for the next count instead of giving up
+        def finish_one():
+            time.sleep(0.05)
+            at_google[0] = 0
+        threading.Thread(target=finish_one).start()
+        controller.max_wait_seconds = 1
+        with controller.admit():
+            pass
+
+        stats = controller.stats()
+        self.assertEqual((stats["admitted"], stats["timed_out"], stats["waited_for_operations"]), (2, 2, 1))
+
+    def test_counts_operations_from_firestore(self):
+        transcribing = TRANSCRIPTION_STATUSES[3]
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=transcribing, transaction_id="1234567890"))
+        self.db.write("users/user-1/transcribeRequests/request-2", make_file_data(id="request-2", status=TRANSCRIPTION_STATUSES[5]))
+        self.db.write("users/user-2/transcribeRequests/request-1", make_file_data(user_id="user-2", status=transcribing, chunked=True, transaction_id="chunked-request-1"))
+        for index, status in enumerate(["done", "transcribing", "transcribing", "pending"]):
+            self.db.write(f"users/user-2/transcribeRequests/request-1/chunks/{index:05d}", {"index": index, "status": status})
+
+        # the plain one, and the chunked one's two chunks
+        self.assertEqual(admission.count_operations_at_google(), 3)
+
+    @override_settings(ADMISSION={**settings.ADMISSION, "WEB_MAX_WAIT_SECONDS": 0.05})
+    def test_web_request_gets_told_to_come_back(self):
+        # the worker would wait a minute, but someone's waiting on this one
+        controller = AdmissionController(max_concurrent=1, max_wait_seconds=60)
+        controller.in_flight = 1
+        clients.override("admission", controller)
+        speech = mock.Mock()
+        clients.override("speech_client", speech)
+        self.addCleanup(clients.override, "speech_client", None)
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        self.bucket.blobs["uploads/sermon.flac"] = make_flac_header(channels=1, sample_rate=16000) + b"\x01" * 5000
+
+        start = time.monotonic()
+        request = RequestFactory().post("/", data=json.dumps(make_file_data(file_path="uploads/sermon.flac")), content_type="application/json")
+        response = views.transcribe(request)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        speech.long_running_recognize.assert_not_called()
+        # not a server error, so the client (or the stuck request sweeper) can just try again
+        self.assertEqual(self.db.read("users/user-1/transcribeRequests/request-1")["status"], TRANSCRIPTION_STATUSES[2])
+
+
+class MetricsTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("test_seconds", "test", ["service"], buckets=(0.1, 1))
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value, service="firestore")
+
+        lines = histogram.render()
+
+        self.assertIn('transcription_test_seconds_bucket{service="firestore",le="0.1"} 1', lines)
+        self.assertIn('transcription_test_seconds_bucket{service="firestore",le="1"} 3', lines)
+        self.assertIn('transcription_test_seconds_bucket{service="firestore",le="+Inf"} 4', lines)
+        self.assertIn('transcription_test_seconds_count{service="firestore"} 4', lines)
+        self.assertEqual(histogram.snapshot(service="firestore")["sum"], 6.05)
+
+    def test_external_calls_are_timed(self):
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[2]))
+
+        TranscribeRequest(make_file_data()).refresh_from_db()
+        with self.assertRaises(exceptions.NotFound):
+            with metrics.external_call("storage", "delete"):
+                raise exceptions.NotFound("gone")
+
+        self.assertEqual(metrics.external_call_seconds.snapshot(service="firestore", operation="get")["count"], 1)
+        self.assertEqual(metrics.external_call_seconds.snapshot(service="storage", operation="delete")["count"], 1)
+        self.assertEqual(metrics.external_call_errors.value(service="storage", operation="delete"), 1)
+
+    def test_time_in_each_status(self):
+        ninety_seconds_ago = (datetime.utcnow() - timedelta(seconds=90)).strftime("%Y%m%dT%H%M%SZ")
+        transcribe_request = TranscribeRequest(make_file_data(status=TRANSCRIPTION_STATUSES[3], updated_at=ninety_seconds_ago))
+
+        transcribe_request.mark_as_transcribed()
+        # same status again doesn't count as leaving it
+        transcribe_request.mark_as_transcribed()
+
+        transcribing = metrics.status_seconds.snapshot(status=TRANSCRIPTION_STATUSES[3])
+        self.assertEqual(transcribing["count"], 1)
+        self.assertAlmostEqual(transcribing["sum"], 90, delta=2)
+        self.assertEqual(metrics.status_seconds.snapshot(status=TRANSCRIPTION_STATUSES[4])["count"], 0)
+        self.assertEqual(metrics.status_changes.value(status=TRANSCRIPTION_STATUSES[4]), 2)
+
+    def test_endpoint(self):
+        with metrics.external_call("speech", "get_operation"):
+            pass
+
+        response = self.client.get("/metrics/")
+
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('transcription_external_call_seconds_count{service="speech",operation="get_operation"} 1', body)
+        self.assertIn("transcription_admission_in_flight 0", body)
+        self.assertIn("# TYPE transcription_user_cache_hits gauge", body)
+
+
+class StuckRequestsTest(FirestoreTestCase):
+    def seed(self, request_id, status, seconds_ago, **overrides):
+        self.db.write(f"users/user-1/transcribeRequests/{request_id}", {
+            **make_file_data(id=request_id, status=status),
+            "updated_at_time": utc_now() - timedelta(seconds=seconds_ago),
+            **overrides,
+        })
+
+    def status_of(self, request_id):
+        return self.db.read(f"users/user-1/transcribeRequests/{request_id}")
+
+    def test_elapsed_is_real_seconds(self):
+        two_minutes_ago = (datetime.utcnow() - timedelta(seconds=120)).strftime("%Y%m%dT%H%M%SZ")
+        transcribe_request = TranscribeRequest(make_file_data(status=TRANSCRIPTION_STATUSES[2], updated_at=two_minutes_ago))
+
+        # used to be 200 (2 "minutes" of 100 each)
+        self.assertAlmostEqual(transcribe_request.elapsed_since_last_event(), 120, delta=2)
+        self.assertTrue(transcribe_request.last_request_has_stopped())
+
+        transcribe_request.mark_as_received()
+        self.assertAlmostEqual(transcribe_request.elapsed_since_last_event(), 0, delta=2)
+        self.assertFalse(transcribe_request.last_request_has_stopped())
+        self.assertIsInstance(self.status_of("request-1")["updated_at_time"], datetime)
+
+    def test_sweep_resumes_and_gives_up(self):
+        # 1 MB flac, so processing-file is stuck after 100s and transcribing after 150s
+        self.seed("stuck-file", TRANSCRIPTION_STATUSES[2], 10 * 60)
+        self.seed("stuck-again", TRANSCRIPTION_STATUSES[3], 5 * 60 * 60, transaction_id="1234567890", resume_count=1)
+        self.seed("still-going", TRANSCRIPTION_STATUSES[3], 120, transaction_id="1234567891")
+        self.seed("done", TRANSCRIPTION_STATUSES[5], 5 * 60 * 60)
+        self.db.rpc_counts.clear()
+
+        sweeper = StuckRequestSweeper(max_resumes=1)
+        with mock.patch.object(TranscribeRequest, "send_to_google", autospec=True) as send_to_google:
+            self.assertEqual(sweeper.sweep_once(), (1, 1))
+
+        self.assertEqual([call.args[0].id for call in send_to_google.call_args_list], ["stuck-file"])
+        self.assertEqual(self.status_of("stuck-file")["resume_count"], 1)
+        self.assertEqual(self.status_of("stuck-again")["status"], TRANSCRIPTION_STATUSES[7])
+        self.assertEqual(self.status_of("still-going")["status"], TRANSCRIPTION_STATUSES[3])
+        self.assertEqual(self.status_of("done")["status"], TRANSCRIPTION_STATUSES[5])
+        # one query per status, and every write in one batch
+        self.assertEqual(self.db.rpc_counts["query"], 3)
+        self.assertEqual(self.db.rpc_counts["commit"], 1)
+
+        # just resumed, so it gets a full wait before the next sweep looks at it
+        self.assertEqual(sweeper.sweep_once(), (0, 0))
+
+    def test_checks_with_google_if_it_already_has_it(self):
+        self.seed("request-1", TRANSCRIPTION_STATUSES[4], 60 * 60, transaction_id="1234567890")
+
+        with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation(done=True)):
+            self.assertEqual(StuckRequestSweeper().sweep_once(), (1, 0))
+
+        self.assertEqual(self.status_of("request-1")["status"], TRANSCRIPTION_STATUSES[5])
+
+    def test_long_operation_that_keeps_going(self):
+        # been transcribing for a long time, but Google is still on it
+        self.seed("request-1", TRANSCRIPTION_STATUSES[3], 60 * 60, transaction_id="1234567890", transcript_metadata={"progress_percent": 10})
+        sweeper = StuckRequestSweeper(max_resumes=1)
+
+        for progress_percent in [30, 60]:
+            # nobody checked on it in a while (e.g., the poller was off), so it looks stalled
+            self.db.write("users/user-1/transcribeRequests/request-1", {
+                **self.status_of("request-1"),
+                "updated_at_time": utc_now() - timedelta(seconds=60 * 60),
+            })
+
+            with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation(progress_percent=progress_percent)):
+                self.assertEqual(sweeper.sweep_once(), (1, 0))
+
+            stored = self.status_of("request-1")
+            self.assertEqual(stored["status"], TRANSCRIPTION_STATUSES[3])
+            # it moved, so that try doesn't count
+            self.assertEqual(stored["resume_count"], 0)
+
+        # and checking on it is enough to keep it from looking stalled
+        with mock.patch("transcription.transcribe_class.get_operation", return_value=make_operation(progress_percent=90)):
+            TranscribeRequest.from_document(self.db.collection("users").document("user-1").collection("transcribeRequests").document("request-1").get()).check_transcription_progress()
+
+        self.assertEqual(sweeper.sweep_once(), (0, 0))
+        self.assertEqual(self.status_of("request-1")["transcript_metadata"]["progress_percent"], 90)
+
+
+@override_settings(OPERATION_POLLER={**settings.OPERATION_POLLER, "ENABLED": True})
+class ConditionalCheckStatusTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        # like the client makes it on upload
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[1]))
+        self.transcribe_request = TranscribeRequest(make_file_data(status=TRANSCRIPTION_STATUSES[1]))
+        self.transcribe_request.mark_as_received()
+
+    def check(self, headers=None, **payload):
+        request = RequestFactory().post("/", data=json.dumps(make_file_data(**payload)), content_type="application/json", **(headers or {}))
+        return views.check_status(request)
+
+    def stored_version(self):
+        return self.db.read("users/user-1/transcribeRequests/request-1")["version"]
+
+    def test_version_only_moves_when_something_visible_changes(self):
+        self.assertEqual(self.stored_version(), 1)
+
+        # nothing a client would see changed
+        self.transcribe_request.persist()
+        self.assertEqual(self.stored_version(), 1)
+
+        self.transcribe_request.transcript_metadata = {"progress_percent": 40}
+        self.transcribe_request.persist()
+        self.assertEqual(self.stored_version(), 2)
+
+        # someone else wrote in between, so we add to theirs instead of overwriting it
+        self.db.document("users/user-1/transcribeRequests/request-1").set({"version": 10}, merge=True)
+        self.transcribe_request.mark_as_transcribed()
+        self.assertEqual(self.stored_version(), 11)
+
+    def test_not_modified(self):
+        response = self.check()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["current_request_data"]["version"], 1)
+        etag = response["ETag"]
+
+        self.db.rpc_counts.clear()
+        response = self.check(headers={"HTTP_IF_NONE_MATCH": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(self.db.rpc_counts, {"get": 1})
+
+        response = self.check(version=1)
+        self.assertEqual(json.loads(response.content), {"unchanged": True, "version": 1})
+
+        self.transcribe_request.mark_as_transcribed()
+        response = self.check(headers={"HTTP_IF_NONE_MATCH": etag}, version=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_no_etag_without_version(self):
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[3]))
+
+        # the client's version isn't ours
+        response = self.check(version=1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+        self.assertIn("current_request_data", json.loads(response.content))
+
+
+class RequestCacheTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.write("users/user-1", {"email": "someone@example.com"})
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[5], version=3))
+
+    def post(self, view, **payload):
+        request = RequestFactory().post("/", data=json.dumps(make_file_data(**payload)), content_type="application/json")
+        return view(request)
+
+    def test_done_requests_need_no_reads(self):
+        first = self.post(views.check_status)
+        self.assertEqual(self.db.rpc_counts, {"get": 1})
+
+        self.db.rpc_counts.clear()
+        second = self.post(views.check_status)
+        self.assertEqual(self.db.rpc_counts, {})
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["ETag"], first["ETag"])
+
+        response = self.post(views.resume_request)
+        self.assertEqual(json.loads(response.content), {"message": views.ALREADY_DONE_MESSAGE})
+        self.assertEqual(self.db.rpc_counts, {})
+
+        response = async_to_sync(async_views.check_status)(AsyncRequestFactory().post("/", data=json.dumps(make_file_data()), content_type="application/json"))
+        self.assertEqual(response["ETag"], first["ETag"])
+        self.assertEqual(self.db.rpc_counts, {})
+
+    def test_writing_drops_it(self):
+        self.post(views.check_status)
+
+        # sent again, e.g., a new upload of the same request
+        TranscribeRequest(make_file_data(status=TRANSCRIPTION_STATUSES[5], version=3)).mark_as_received()
+
+        self.db.rpc_counts.clear()
+        data = json.loads(self.post(views.check_status).content)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[2])
+        self.assertEqual(data["current_request_data"]["version"], 4)
+        self.assertEqual(self.db.rpc_counts, {"get": 1})
+
+    def test_only_what_firestore_says(self):
+        self.db.document("users/user-1/transcribeRequests/request-1").delete()
+
+        # whatever the client claims, it's not in firestore, so nothing to keep
+        self.post(views.check_status, status=TRANSCRIPTION_STATUSES[5])
+        self.assertEqual(request_cache.get("user-1", "request-1"), None)
+
+    @override_settings(REQUEST_CACHE={**settings.REQUEST_CACHE, "LOCAL_TTL_SECONDS": 0.05})
+    def test_local_copy_expires(self):
+        self.post(views.check_status)
+
+        self.db.rpc_counts.clear()
+        self.post(views.check_status)
+        self.assertEqual(self.db.rpc_counts, {})
+
+        # sent again through another process, which can't drop it from ours
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[2], version=4))
+
+        time.sleep(0.1)
+        data = json.loads(self.post(views.check_status).content)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[2])
+        self.assertEqual(self.db.rpc_counts, {"get": 1})
+
+    @override_settings(REQUEST_CACHE={**settings.REQUEST_CACHE, "SHARED": True})
+    def test_shared_between_processes(self):
+        # LocMemCache, since CACHES isn't set. Sticks around between tests, so start empty
+        caches["default"].clear()
+        self.post(views.check_status)
+
+        # like another process, which only has the shared one
+        request_cache.request_cache.clear()
+        self.db.rpc_counts.clear()
+        data = json.loads(self.post(views.check_status).content)
+        self.assertEqual(data["current_request_data"]["status"], TRANSCRIPTION_STATUSES[5])
+        self.assertEqual(self.db.rpc_counts, {})
+
+        TranscribeRequest(make_file_data(status=TRANSCRIPTION_STATUSES[5], version=3)).mark_as_received()
+        request_cache.request_cache.clear()
+        self.assertEqual(request_cache.get("user-1", "request-1"), None)
+
+
+@override_settings(COALESCING={**settings.COALESCING, "LEASE_SECONDS": 3600})
+class CoalescingTest(FirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.speech = FakeSpeech(progress_step=10, latency_seconds=0.2)
+        self.speech.operations["1234567890"] = 0
+        clients.override("operations_api", self.speech)
+        self.db.write("users/user-1/transcribeRequests/request-1", make_file_data(status=TRANSCRIPTION_STATUSES[3], transaction_id="1234567890"))
+
+    def tearDown(self):
+        clients.override("operations_api", None)
+        super().tearDown()
+
+    def check_at_once(self, count):
+        # like several tabs polling the same request
+        transcribe_requests = [TranscribeRequest(make_file_data(status=TRANSCRIPTION_STATUSES[3], transaction_id="1234567890")) for _ in range(count)]
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            list(pool.map(lambda transcribe_request: transcribe_request.check_transcription_progress(), transcribe_requests))
+
+        return transcribe_requests
+
+    def test_one_call_for_everyone(self):
+        transcribe_requests = self.check_at_once(5)
+
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 1)
+        # and only one of them wrote the progress
+        self.assertEqual(self.db.rpc_counts["commit"], 1)
+        self.assertEqual({transcribe_request.transcript_metadata["progress_percent"] for transcribe_request in transcribe_requests}, {10})
+        self.assertEqual(coalescing.coalesced_calls.value(how="local"), 4)
+
+        # done, so the next one asks again
+        self.check_at_once(1)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 2)
+
+    def test_not_shared_between_users(self):
+        # e.g., chunked-{id}, which only has the request id in it
+        self.db.write("users/user-2/transcribeRequests/request-1", make_file_data(user_id="user-2", status=TRANSCRIPTION_STATUSES[3], transaction_id="1234567890"))
+        transcribe_requests = [TranscribeRequest(make_file_data(user_id=user_id, status=TRANSCRIPTION_STATUSES[3], transaction_id="1234567890")) for user_id in ["user-1", "user-2"]]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(lambda transcribe_request: transcribe_request.check_transcription_progress(), transcribe_requests))
+
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 2)
+        self.assertEqual([transcribe_request.user_id for transcribe_request in transcribe_requests], ["user-1", "user-2"])
+        self.assertEqual(coalescing.coalesced_calls.value(how="local"), 0)
+
+    @override_settings(COALESCING={**settings.COALESCING, "ENABLED": False})
+    def test_counts_duplicates_when_off(self):
+        self.check_at_once(3)
+
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 3)
+        self.assertEqual(coalescing.duplicate_calls.value(), 2)
+
+    @override_settings(COALESCING={**settings.COALESCING, "LEASE": True, "LEASE_SECONDS": 3600})
+    def test_lease(self):
+        # another process is checking on it
+        lease = coalescing.lease_ref("user-1", "1234567890")
+        lease.set({"transaction_id": "1234567890"})
+        self.db.rpc_counts.clear()
+
+        transcribe_request = self.check_at_once(1)[0]
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 0)
+        self.assertEqual(coalescing.coalesced_calls.value(how="lease"), 1)
+        self.assertEqual(transcribe_request.status, TRANSCRIPTION_STATUSES[3])
+        # tried the lease, then read the request
+        self.assertEqual(self.db.rpc_counts, {"commit": 1, "get": 1})
+
+        lease.delete()
+        self.check_at_once(1)
+        self.assertEqual(self.speech.rpc_counts["get_operation"], 1)
+        # let go of it once done
+        self.assertEqual(self.db.read(lease.path), None)
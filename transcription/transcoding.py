@@ -0,0 +1,176 @@
+"""
+Converting uploaded audio to mono FLAC before sending it to Google
+- even mp3 and wav files seem to come out better when converted to flac first
+- streams from the bucket, through an ffmpeg subprocess, and back to the bucket. Nothing gets written to disk, so it works on heroku's small ephemeral filesystem no matter how big the file is
+- at most TRANSCODING["MAX_PROCESSES"] ffmpeg processes run at the same time in a process, and each gets killed after TRANSCODING["TIMEOUT_SECONDS"]
+- only in the worker by default. A big file can take minutes, way past gunicorn's 30s timeout, so web requests send the original as is unless TRANSCODING["WEB_TIMEOUT_SECONDS"] is set (see TranscribeRequest.transcode_timeout)
+- NOTE ffmpeg can't go back and fill in the total samples in the FLAC header when writing to a pipe, so the header won't have the duration. Google doesn't need it though
+"""
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .helpers import *
+logger = logging.getLogger('testlogger')
+
+# how much to read/write at a time
+CHUNK_SIZE = 1024 * 1024
+# only keep the end of ffmpeg's error output, for the error message
+STDERR_LIMIT = 4096
+
+
+class TranscodingError(Exception):
+    pass
+
+
+class TranscodingTimeout(TranscodingError):
+    pass
+
+
+def ffmpeg_flac_args():
+    """
+    read whatever format from stdin, write mono FLAC to stdout
+    """
+    return [
+        settings.TRANSCODING["FFMPEG"], "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-i", "pipe:0",
+        # -ac 1 for mono channel
+        "-ac", "1",
+        "-c:a", "flac", "-f", "flac",
+        "pipe:1",
+    ]
+
+
+# bounded pool of threads, each of which drives one ffmpeg process. Goes in the client registry so a forked worker gets its own
+clients.register("transcoding_pool", lambda: ThreadPoolExecutor(
+    max_workers=settings.TRANSCODING["MAX_PROCESSES"],
+    thread_name_prefix="transcoding",
+))
+
+
+def _pump(read, write, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        write(chunk)
+
+
+def stream_transcode(source_blob, target_blob, args=None, timeout=None, content_type="audio/flac", on_stderr_line=None):
+    """
+    streams source_blob through ffmpeg (or whatever args says to run) into target_blob
+    - blobs need open("rb") / open("wb"), like google.cloud.storage Blobs
+    - source_blob can be None if args already tell ffmpeg where to read from, and target_blob can be None if we don't care about the output (e.g., only want what ffmpeg logs)
+    - on_stderr_line gets called with each line ffmpeg logs
+    - target only gets finished (and so only shows up in the bucket) if the conversion worked
+    - returns number of bytes written
+    """
+    args = args or ffmpeg_flac_args()
+    # for logging. If there's no source blob, whatever comes after -i
+    source_name = source_blob.name if source_blob else args[args.index("-i") + 1] if "-i" in args else "input"
+    timeout = timeout or settings.TRANSCODING["TIMEOUT_SECONDS"]
+
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    watchdog = threading.Timer(timeout, kill)
+    watchdog.daemon = True
+
+    # feed the source in from another thread, so that we can read stdout at the same time. Otherwise both pipes fill up and everything hangs
+    feed_errors = []
+    def feed():
+        try:
+            if source_blob is None:
+                return
+            with source_blob.open("rb") as reader:
+                _pump(reader.read, process.stdin.write)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg stopped reading, e.g., it errored or got killed. We'll find out why below
+            pass
+        except Exception as error:
+            feed_errors.append(error)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    stderr_tail = bytearray()
+    def drain_stderr():
+        for line in process.stderr:
+            if on_stderr_line:
+                on_stderr_line(line.decode("utf-8", "replace"))
+            stderr_tail.extend(line)
+            del stderr_tail[:-STDERR_LIMIT]
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    stderr_reader = threading.Thread(target=drain_stderr, daemon=True)
+
+    bytes_written = 0
+    watchdog.start()
+    feeder.start()
+    stderr_reader.start()
+    try:
+        writer = target_blob.open("wb", content_type=content_type) if target_blob else None
+        while True:
+            chunk = process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if writer:
+                writer.write(chunk)
+            bytes_written += len(chunk)
+
+        return_code = process.wait()
+        feeder.join()
+        stderr_reader.join()
+
+    finally:
+        watchdog.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    if timed_out.is_set():
+        raise TranscodingTimeout(f"Transcoding {source_name} took longer than {timeout} seconds")
+    if feed_errors:
+        raise TranscodingError(f"Error reading {source_name}: {feed_errors[0]}")
+    if return_code != 0:
+        raise TranscodingError(f"ffmpeg exited with {return_code}: {stderr_tail.decode('utf-8', 'replace').strip()}")
+
+    # only now does the upload get finished
+    if writer:
+        writer.close()
+        logger.info(f"transcoded {source_name} to {target_blob.name} ({bytes_written} bytes)")
+
+    return bytes_written
+
+
+def transcode_to_flac(source_path, target_path, bucket_to_use=None, timeout=None):
+    """
+    converts file in the bucket to mono flac, running in the transcoding pool
+    - blocks until done (or until it times out)
+    """
+    bucket_to_use = bucket_to_use or bucket
+    timeout = timeout or settings.TRANSCODING["TIMEOUT_SECONDS"]
+
+    future = clients.get("transcoding_pool").submit(
+        stream_transcode,
+        bucket_to_use.blob(source_path),
+        bucket_to_use.blob(target_path),
+        timeout=timeout,
+    )
+    # stream_transcode enforces the timeout itself, but might have to wait for a free process first
+    return future.result()
+
+
+def flac_path_for(path):
+    """
+    e.g., "uploads/sermon.mp3" => "uploads/sermon.mp3.converted.flac"
+    - keeps the whole original name, so it can't land on another file the user uploaded (e.g., their own sermon.flac, which would get overwritten, and then deleted along with ours once the transcript is done)
+    """
+    return f"{path}.converted.flac"
@@ -1,4 +1,19 @@
+import shutil
+from contextlib import contextmanager
 from .helpers import * 
+from .unit_of_work import UnitOfWork
+from .users import get_user_profile
+from . import transcript_storage
+from . import audio_probe
+from . import transcoding
+from .chunking import ChunkedRecognition
+from . import retry_policy
+from . import transcript_cache
+from . import storage_cleanup
+from . import admission
+from . import metrics
+from . import request_cache
+from . import coalescing
 logger = logging.getLogger('testlogger')
 
 class TranscribeRequest:
@@ -10,16 +25,124 @@ class TranscribeRequest:
     # 3) use data from Firestone or to set the other attributes
     """
 
-    # a dict of custom quotas for this user, if defaults have been overridden
-    custom_quotas = None
-    user_email = None
+    ########################
+    # schema
+    ########################
+    # every attribute a TranscribeRequest has, and its default
+    # NOTE these are the only attributes that can be set (see __slots__), so add new ones here
+    FIELDS = {
+        # necessary parts, or else can't retrieve from db
+        "id": None,
+        "filename": None,
+        "file_last_modified": None,
+
+        # optional data from payload (or from firestore when refreshing)
+        "request_type": REQUEST_TYPES[0],
+        "user_id": None,
+        "file_path": None,
+        "file_type": None,
+        "file_size": None,
+        "original_file_path": None,
+        "transaction_id": None,
+        "status": None,
+        "updated_at": None,
+        # same time as updated_at, but as a datetime so firestore can query on it (see stuck_requests.py). Only set when we change the status, the frontend doesn't set it
+        "updated_at_time": None,
+        "error": None,
+        # how many times the stuck request sweeper has tried to get this going again
+        "resume_count": 0,
+        # goes up by one whenever status, progress_percent or updated_at change, so check-status can tell a client nothing changed (ETag) from just the one read
+        # NOTE only ever written with Increment, so writers in different processes don't overwrite each other's. Ours is what we read, plus what we added since
+        "version": None,
+        # progress from Google, as of the last time we (or the worker) checked
+        "transcript_metadata": {},
+        # channels, sample rate, encoding and duration from the file's header (see get_audio_info)
+        "audio_info": None,
+        # opt in to splitting long files into chunks that get transcribed at the same time (see chunking.py)
+        "chunked": False,
+        # sha256 of the uploaded file, and that combined with the config we send (see transcript_cache.py)
+        "content_hash": None,
+        "cache_key": None,
+
+        # only for this instance
+        # NOTE some filetypes, such as some mp3s, are different from the file extension, e.g., mpeg instead of mp3
+        "file_extension": None,
+        # only counting attempts in this current http request, so always starts at 0
+        "failed_attempts": 0,
+        # most seconds to spend waiting between tries when Google errors (see retry_budget). None means we're probably in a web request, so RETRY["WEB_BUDGET_SECONDS"]
+        "retry_wait_seconds": None,
+        # same, but for how long to wait for our turn to send to Google (see admission_wait). None means ADMISSION["WEB_MAX_WAIT_SECONDS"]
+        "admission_wait_seconds": None,
+        # and how long converting to flac can take (see transcode_timeout). None means TRANSCODING["WEB_TIMEOUT_SECONDS"]
+        "transcode_timeout_seconds": None,
+        "request_options": None,
+        # config and audio we send to Google
+        "request_params": None,
+        # not really testing or using right now
+        "base64": None,
+        # a dict of custom quotas for this user, if defaults have been overridden
+        "custom_quotas": None,
+        "user_email": None,
+        # transcript results from Google, once it's done
+        "utterances": None,
+    }
+
+    # fields that get set from the payload, or from firestore when refreshing
+    PAYLOAD_FIELDS = [
+        "id", "filename", "file_last_modified", "request_type", "user_id", "file_path", "file_type", "file_size",
+        "original_file_path", "transaction_id", "status", "updated_at", "updated_at_time", "error", "transcript_metadata", "audio_info",
+        "chunked", "content_hash", "cache_key", "resume_count", "version",
+    ]
+
+    # projections: which fields go where
+    # the transcribeRequests doc. Just the status and whatever we need to pick the request back up, so it stays small
+    # version gets added with Increment instead (see _version_updates)
+    REQUEST_DOCUMENT_FIELDS = [name for name in PAYLOAD_FIELDS if name != "version"]
+    # the transcripts doc. Only written once the transcript is done
+    # NOTE utterances themselves go in the transcript's pages (see transcript_storage.py)
+    TRANSCRIPT_DOCUMENT_FIELDS = [
+        "id", "filename", "file_last_modified", "user_id", "file_type", "file_size", "transaction_id",
+        "transcript_metadata", "request_options", "request_params",
+    ]
+    # what we send back to the client. Doesn't include the transcript, client gets that from firestore
+    RESPONSE_FIELDS = [
+        "id", "filename", "file_last_modified", "status", "updated_at", "error", "transaction_id", "transcript_metadata", "version",
+    ]
+
+    __slots__ = tuple(FIELDS) + (
+        # set while inside batched_writes(), so that firestore writes get queued up instead of sent right away
+        "_unit_of_work",
+        # event logs only get read from firestore when something asks for them (see get_event_logs)
+        # event log doc id => event log
+        "_event_logs",
+        # snapshot of the latest event log we've read from firestore, so next time we only read the ones after it
+        "_event_logs_cursor",
+        # (status, progress_percent, updated_at) as of the last time we read or wrote version, so we know when to add to it
+        "_versioned_state",
+    )
 
     # TODO NOTE no longer file_data, so change var name
     def __init__(self, file_data):
-        # necessary parts, or else can't retrieve from db
+        for name, default in TranscribeRequest.FIELDS.items():
+            setattr(self, name, deepcopy(default))
+
+        self._unit_of_work = None
+        self._event_logs = {}
+        self._event_logs_cursor = None
         # TODO if don't receive, throw error so that client knows
         self._set_attributes_from_dictionary(file_data)
 
+    @staticmethod
+    def from_document(doc):
+        """
+        from a transcribeRequests doc snapshot, e.g., from a collection group query. Payloads have the id and user_id, docs only have them in their path
+        """
+        file_data = doc.to_dict()
+        # users/{user_id}/transcribeRequests/{id}
+        file_data["id"] = doc.id
+        file_data["user_id"] = doc.reference.parent.parent.id
+        return TranscribeRequest(file_data)
+
     ########################
     # init helpers
     ########################
@@ -27,30 +150,26 @@ class TranscribeRequest:
         """
         file_data should be dictionary with file data
         called initially, but also when refreshing data based on the database
+        - anything not in file_data keeps its current value
 
         If there is an error, need to account for the errored_while when running stats. So if errored while transcribing, count from 
         If there are multiple errors, throw out from stats altogether
         """
 
+        # necessary parts, or else can't retrieve from db
         self.filename = file_data["filename"]
         self.file_last_modified = file_data["file_last_modified"]
         self.id = file_data["id"]
 
         # optional data from payload 
         # TODO test how optional all of this is
-        # TODO DRY up using setattr and some sort of schema dict
-        self.request_type = file_data.get("request_type", REQUEST_TYPES[0])
-        self.user_id = file_data.get("user_id")
-        self.file_path = file_data.get("file_path")
-        self.file_type = file_data.get("file_type")
-        # NOTE some filetypes, such as some mp3s, are different from the file extension, e.g., mpeg instead of mp3
+        for name in TranscribeRequest.PAYLOAD_FIELDS:
+            if name in file_data:
+                setattr(self, name, file_data[name])
+
+        self.transcript_metadata = self.transcript_metadata or {}
         self.file_extension = self.file_type.replace("audio/", "")
-        self.file_size = file_data.get("file_size")
-        self.original_file_path = file_data.get("original_file_path") 
-        self.transaction_id = file_data.get("transaction_id")
-        self.event_logs = self.get_event_logs()
-        self.status = file_data.get("status")
-        self.updated_at = file_data.get("updated_at")
+        self._versioned_state = self._version_state()
 
         # only counting attempts in this current http request, so always set to 0
         self.failed_attempts = 0
@@ -89,11 +208,11 @@ class TranscribeRequest:
 
     def get_user_email(self):
         """
-        get from db or from cache
+        get from db or from cache (shared with other requests in this process, see users.py)
         - all users should have an email, so there should be no concern about retriving email from this record in firestore
         """
         if self.user_email == None:
-            self.user_email = self.user_ref().get().to_dict()["email"]
+            self.user_email = get_user_profile(self.user_id)["email"]
 
         return self.user_email
 
@@ -111,17 +230,54 @@ class TranscribeRequest:
 
         return file_size_limit
 
+    def get_max_duration_minutes(self):
+        """
+        returns float of max audio length in minutes for user
+        """
+        # Google won't do more than 480 minutes in a single long running request
+        default_duration_limit = 480
+
+        return float(self.get_custom_quotas().get("audioDurationMinutes", default_duration_limit))
+
+    def get_audio_info(self):
+        """
+        channels, sample rate, encoding and duration, from the file's header (see audio_probe.py)
+        - only downloads the start of the file, and only once per request
+        - returns None if we can't tell (e.g., no file in storage, or a header we don't understand). Then we just let Google figure it out like before
+        """
+        if self.audio_info is None:
+            self.audio_info = self.probe_audio_file()
+
+        return self.audio_info
+
+    def probe_audio_file(self):
+        """
+        reads the file's header, but doesn't set anything on the request. So it can run in another thread while the request gets changed (see async_views.transcribe)
+        - returns None if we can't tell
+        """
+        if not self.file_path:
+            return None
+
+        try:
+            # file_size comes from the client, and sometimes as a string
+            file_size = float(self.file_size) if self.file_size else None
+            with metrics.external_call("storage", "download"):
+                audio_info = audio_probe.probe_blob(bucket.blob(self.file_path), file_size)
+            logger.info(f"audio info: {audio_info}")
+            return audio_info
+
+        except Exception as error:
+            logger.error(f"couldn't probe audio file {self.file_path}")
+            logger.error(error)
+            return None
+
     def get_custom_quotas(self):
         """
-        get from db or from cache
+        get from db or from cache (shared with other requests in this process, see users.py)
         - returns empty dict if there are no custom quotas set for this user
         """
         if self.custom_quotas == None:
-            email = self.get_user_email()
-            logger.info(f"checking firestore at customQuotas/{email}")
-            custom_quotas_result = db.collection('customQuotas').document(email).get()
-            self.custom_quotas = custom_quotas_result.to_dict() if custom_quotas_result.exists else {}
-
+            self.custom_quotas = get_user_profile(self.user_id)["custom_quotas"]
 
         logger.info(f"custom quotas dict: {self.custom_quotas}")
         return self.custom_quotas
@@ -137,17 +293,43 @@ class TranscribeRequest:
         return float(self.file_size) / 1048576
 
     def elapsed_since_last_event(self):
+        """
+        seconds since the status last changed, or since Google last made progress on it (see _heartbeat)
+        - used to subtract the digits of the timestamp strings, so e.g., 100 could mean a minute. These are real seconds
+        """
+        if self.updated_at_time is not None:
+            return (utc_now() - self.updated_at_time).total_seconds()
+
+        # set by the frontend (e.g., uploaded), or from before we had updated_at_time
+        return seconds_since(self.updated_at)
+
+    def stalled_after_seconds(self):
+        """
+        how long to wait with nothing happening before we assume this request stopped, for its current status. None if it's done
+        - err on the side of waiting, so we don't confuse an operation that's still going
+        - bigger files get longer
+        """
+        base = TranscribeRequest.STALLED_AFTER_SECONDS.get(self.status)
+        if base is None:
+            return None
+
         status = self.status
+        if status == TRANSCRIPTION_STATUSES[0]: # uploading
+            # assumes at least 1/5 MB / sec internet connection
+            return base + self.size_in_MB() * 5
+
+        elif status == TRANSCRIPTION_STATUSES[2] and self.file_extension != "flac": # processing-file
+            # converting to flac takes longer for bigger files
+            return base + self.size_in_MB() * 10
 
-        # remove letters so can compare just the numbers
-        remove_letters = str.maketrans({"T": "", "Z": ""})
+        elif status == TRANSCRIPTION_STATUSES[3]: # transcribing
+            # could take awhile. But a 25 MB sized file should not take 7 min, so this should be plenty
+            return base + self.size_in_MB() * 50
 
-        now = int(timestamp().translate(remove_letters))
-        last_updated_at = int(self.updated_at.translate(remove_letters))
-        # is kind of difference in seconds, unless we go above 60. Then it gets confusing (e.g., 300 would be 3 minutes, 3000 would be 30 minutes, 30000 would be 3 hours etc)
-        elapsed_time = now - last_updated_at
+        elif status == TRANSCRIPTION_STATUSES[4]: # processing-transcription
+            return base + self.size_in_MB() * 1
 
-        return elapsed_time
+        return base
 
     ##################
     # Validation
@@ -157,6 +339,7 @@ class TranscribeRequest:
         """
         check to see if audio file is valid before sending anything to Google
         - check file size to make sure that it is under 100 MB or custom limit
+        - check length of the audio (from the file header), if we can tell
         - maybe add other requirements later
         """
         max_size = self.get_max_size_mb()
@@ -166,28 +349,42 @@ class TranscribeRequest:
         else:
             logger.debug(f"file size ({self.size_in_MB()}MB) is less than max size ({max_size}MB)")
 
+        duration_seconds = (self.get_audio_info() or {}).get("duration_seconds")
+        if duration_seconds:
+            max_duration = self.get_max_duration_minutes()
+            if duration_seconds / 60 > max_duration:
+                raise Exception(f"Audio is longer than maximum ({max_duration} minutes)")
+
     ##################
     # status checkers
     ##################
 
     def server_has_received(self):
-        if any(log.get("event") == TRANSCRIPTION_STATUSES[2] for log in self.event_logs): 
+        if any(log.get("event") == TRANSCRIPTION_STATUSES[2] for log in self.get_event_logs()): 
             return True
         else:
             return False
 
-    # TODO might do a getter/setter function to extract the db logic out
     def get_event_logs(self): 
-        if hasattr(self, "event_logs") == False:
-            self.event_logs = []
-            ref = self.transcribe_request_ref()
-            event_log_ref = ref.collection("event_logs")
-            docs = event_log_ref.stream()
-            for doc in docs:
-                self.event_logs.append(doc.to_dict())
+        """
+        returns list of event logs, oldest first
+        - first call reads all of them from firestore. After that, only reads the ones logged after the last one we read
+        - starts after the last snapshot rather than after its time, since times are only to the second and two logs can share one
+        """
+        event_log_ref = self.transcribe_request_ref().collection(EVENT_LOGS_COLLECTION)
+        query = event_log_ref.order_by("time")
+        if self._event_logs_cursor is not None:
+            query = query.start_after(self._event_logs_cursor)
+
+        with metrics.external_call("firestore", "query"):
+            docs = list(query.stream())
 
+        for doc in docs:
+            # might already have it, if we wrote it ourselves
+            self._event_logs[doc.id] = doc.to_dict()
+            self._event_logs_cursor = doc
 
-        return self.event_logs
+        return sorted(self._event_logs.values(), key=lambda event_log: event_log.get("time", ""))
 
     def last_request_has_stopped(self):
         """
@@ -199,53 +396,68 @@ class TranscribeRequest:
         Err on side of waiting. Don't want them hitting this too much and confusing our operation in the middle
         Ideally, this helper is never necessary, since we handle all of the errors and mark the record accordingly, so can be extra cautious to not allow them to retry too quickly
         """
-        status = self.status
-        elapsed_time = self.elapsed_since_last_event()
-        logger.info(f"elapsed time is {elapsed_time}")
-
-        if status == TRANSCRIPTION_STATUSES[0]: # uploading
-            # hopefully if they error here, we'll just make them upload again...should never have to ask the server. 
-            # but setting reasonable time anyways, since this is just a helper
-            # assumes at least 1/5 MB / sec internet connection (except for that 100 = 1 min...)
-            return elapsed_time > self.size_in_MB() * 5
-
-        elif status == TRANSCRIPTION_STATUSES[1]: # uploaded
-            # we mark as received almost instantaneously, this should be quick
-            # but on the other hand, sometimes the server might have been sleeping, et cetera
-            return elapsed_time > 200
-
-        elif status == TRANSCRIPTION_STATUSES[2]: # processing-file (aka server has received)
-            # takes longer if have to transcode from whatever > flac. Otherwise, only have some quick variable setting (much less than 1 sec), some firestore calls, and a quick roundtrip request to Google's API that confirms they started the transcript, and we should be marking as transcribing
-            return elapsed_time > (100 + self.size_in_MB() * 10 if self.file_extension != "flac" else 100)
+        stalled_after = self.stalled_after_seconds()
+        if stalled_after is None:
+            # stopped because done (or errored)
+            return True
 
-        elif status == TRANSCRIPTION_STATUSES[3]: # transcribing
-            # could take awhile. But a 25 MB sized file should not take 7 min (which would be 100 + size * 25) so doubling that should be plenty
-            return elapsed_time > (100 + self.size_in_MB() * 50)
+        elapsed_time = self.elapsed_since_last_event()
+        logger.info(f"elapsed time is {elapsed_time:.0f}s, stalled after {stalled_after:.0f}s")
+        return elapsed_time > stalled_after
 
-        elif status == TRANSCRIPTION_STATUSES[4]: # "processing-transcription" (means that transcription is complete)
-            # should be pretty fast, just iterate over transcript, some var setting, set to firestore a few times, and ret
-            return elapsed_time > (100 + self.size_in_MB() * 1)
+    def should_check_with_google(self):
+        """
+        normally the worker asks Google (see poller.py), so the web server only does it if that's turned off, or if the worker hasn't in a while (e.g., no worker dyno running)
+        """
+        if self.status != TRANSCRIPTION_STATUSES[3]: # transcribing
+            return False
 
-        elif status == TRANSCRIPTION_STATUSES[5]: # "transcription-processed"
-            # stopped because done
+        if not settings.OPERATION_POLLER["ENABLED"]:
             return True
 
-        elif status == TRANSCRIPTION_STATUSES[6]: # server-error
-            return True
+        checked_at = self.transcript_metadata.get("checked_at")
+        if checked_at:
+            elapsed = seconds_since(checked_at)
+        elif self.updated_at_time is not None or self.updated_at:
+            # never checked, so since it started transcribing
+            elapsed = self.elapsed_since_last_event()
+        else:
+            # can't tell, so leave it to the poller
+            return False
 
-        elif status == TRANSCRIPTION_STATUSES[7]: # transcribing-error
-            return True
+        return elapsed > settings.OPERATION_POLLER["STALE_AFTER_SECONDS"]
 
     def check_transcription_progress(self):
+        """
+        asks Google how it's going, and writes what it says
+        - if another call is already checking on the same operation, waits for it and uses what it got instead (see coalescing.py)
+        """
+        coalescing.check_progress(self, self._check_transcription_progress)
+
+    def _check_transcription_progress(self):
         """
         https://google-cloud-python.readthedocs.io/en/0.32.0/_modules/google/api_core/operation.html
         https://googleapis.dev/python/google-api-core/latest/operation.html
         """
-        operation_dict = get_operation(self.transaction_id)
+        if self.is_chunked_transaction():
+            # checks on each chunk, but we get it back shaped like a single operation
+            operation_dict = ChunkedRecognition(self).get_operation(self.chunk_config())
+        else:
+            operation_dict = get_operation(self.transaction_id)
+
+        # everything we write for this cycle (status changes, progress, transcript) goes out in one batch
+        with self.batched_writes():
+            self._handle_operation(operation_dict)
+
+    def _handle_operation(self, operation_dict):
+        """
+        takes operation dict from Google and updates status, progress and transcript accordingly
+        """
         metadata = operation_dict["metadata"]
         logger.info("metadata from check progress call: ")
         logger.info(metadata)
         # 100 (int) if done
+        previous_metadata = self.transcript_metadata or {}
         self.transcript_metadata = {}
         # it seems that sometimes it doesn't return the progressPercent...maybe when it's still initializing or something? Seems strange, but I've only seen 100% return so far haha
         self.transcript_metadata["progress_percent"] = metadata.get("progressPercent", 0)
@@ -253,6 +465,11 @@ class TranscribeRequest:
         self.transcript_metadata["start_time"] = to_timestamp(metadata["startTime"])
         # format: : '2020-04-25T21:22:14.434078Z'
         self.transcript_metadata["last_updated_at"] = to_timestamp(metadata['lastUpdateTime'])
+        # when we last asked, whether or not anything moved (see should_check_with_google)
+        self.transcript_metadata["checked_at"] = timestamp()
+
+        if self._made_progress(previous_metadata):
+            self._heartbeat()
 
         if operation_dict.get("error"):
             # TODO have to test, not sure if this is working as I would expect
@@ -272,14 +489,33 @@ class TranscribeRequest:
 
             self.mark_as_transcribed()
             self.handle_transcript_results(results)
+            # only need to write the transcript once, when it's done
+            self.persist_transcript_data()
+            # so the next time someone uploads this same audio, they get this transcript
+            if self.cache_key:
+                transcript_cache.store(self.cache_key, self.content_hash, self.transcript_document_ref(), self.transaction_id, self._set_document)
 
 
         # persist progress whether or not we're done
         self.persist()
-        self.persist_transcript_data()
         return
         
 
+    def _made_progress(self, previous_metadata):
+        """
+        whether Google's operation moved since we last looked at it
+        """
+        return any(previous_metadata.get(key) != self.transcript_metadata.get(key) for key in ["progress_percent", "last_updated_at"])
+
+    def _heartbeat(self):
+        """
+        Google's still working on it, so we're not stuck. Goes out with the next persist()
+        - updated_at_time is what the stuck request sweeper looks at (see stuck_requests.py), and otherwise only moves when the status does. A long operation would look stalled the whole time it's transcribing
+        - and whatever resumes it took to get here, it's going again now, so those don't count toward MAX_RESUMES anymore
+        """
+        self.updated_at_time = utc_now()
+        self.resume_count = 0
+
     ##################################################
     # helpers for interacting with Google Speech API 
     ################################################
@@ -295,64 +531,87 @@ class TranscribeRequest:
         logger.info("----------------------------------------------------------------")
 
         try:
-            if (self.file_extension not in FILE_TYPES):
-                raise Exception( f'File type {self.file_extension} is not allowed, only {file_types_sentence}')
-            
-            # The audio file's encoding, sample rate in hertz, and BCP-47 language code
-            if (self.file_path):
-                # is in google cloud storage
-                
-                audio = {
-                    "uri": f"gs://khmer-speech-to-text.appspot.com/{self.file_path}"
-                }
-                
-                # if no data["file_path"], then there should just be base64
-            else:
-                # not really testing or using right now
-                audio = {
-                    "content": self.base64
-                }
+            self._build_request_params()
 
-            
-            if (self.file_extension == "flac"):
-                config_dict = TranscribeRequest._flac_config
-            
-            elif (self.file_extension in ["wav", "x-wav"]):
-                config_dict = TranscribeRequest._wav_config
-                logger.info("Setting as wav with config" + json.dumps(config_dict))
-            
-            elif (self.file_extension in ["mp3", "mpeg"]):
-                # strangely enough, if send base64 of mp3 file, but use flac_config, returns results like the flac file, but smaller file size. In part, possibly due ot the fact that there is multiple speakers set for flacConfig currently
-                config_dict = TranscribeRequest._mp3_config
-            
-            else:
-                # This is for other audio files...but not sure if we should support anything else
-                config_dict = TranscribeRequest._base_config
-                logger.info("Setting as default with config" + json.dumps(config_dict))
+        except Exception as error:
+            # mark request status in firestore 
+            self.mark_as_server_error(error)
+            # bubble up error
+            raise error
 
+    def _build_request_params(self):
+        """
+        setup_request, without marking the request when it fails
+        """
+        if (self.file_extension not in FILE_TYPES):
+            raise Exception( f'File type {self.file_extension} is not allowed, only {file_types_sentence}')
+        
+        # The audio file's encoding, sample rate in hertz, and BCP-47 language code
+        if (self.file_path):
+            # is in google cloud storage
             
-            # TODO dynamically test audio for channels
-            if (self.request_options.get("multiple_channels")):
-                logger.info("Sending with multiple channels")
-                config_dict["audio_channel_count"] = 2 # might try more later, but I think there's normally just two
-                config_dict["enable_separate_recognition_per_channel"] = True
-            
-            logger.info("setting up with file: " + self.filename)
-            # TODO consider sending their config object...though maybe has same results. But either way, check out the options in beta https://googleapis.dev/python/speech/latest/gapic/v1p1beta1/types.html#google.cloud.speech_v1p1beta1.types.RecognitionConfig
-            logger.debug("setting up with config" + json.dumps(config_dict))
+            audio = {
+                "uri": f"gs://khmer-speech-to-text.appspot.com/{self.file_path}"
+            }
             
-            request_params = {
-                "audio": audio,
-                "config": config_dict,
+            # if no data["file_path"], then there should just be base64
+        else:
+            # not really testing or using right now
+            audio = {
+                "content": self.base64
             }
 
-            self.request_params = request_params
+        
+        if (self.file_extension == "flac"):
+            config_dict = TranscribeRequest._flac_config
+        
+        elif (self.file_extension in ["wav", "x-wav"]):
+            config_dict = TranscribeRequest._wav_config
+            logger.info("Setting as wav with config" + json.dumps(config_dict))
+        
+        elif (self.file_extension in ["mp3", "mpeg"]):
+            # strangely enough, if send base64 of mp3 file, but use flac_config, returns results like the flac file, but smaller file size. In part, possibly due ot the fact that there is multiple speakers set for flacConfig currently
+            config_dict = TranscribeRequest._mp3_config
+        
+        else:
+            # This is for other audio files...but not sure if we should support anything else
+            config_dict = TranscribeRequest._base_config
+            logger.info("Setting as default with config" + json.dumps(config_dict))
+
+
+        # copy, so we don't change the class's config for every other request
+        config_dict = dict(config_dict)
+
+        # use what's in the file header when we can, so Google doesn't have to tell us we got it wrong
+        audio_info = self.get_audio_info() or {}
+        if audio_info.get("encoding"):
+            config_dict["encoding"] = enums.RecognitionConfig.AudioEncoding[audio_info["encoding"]]
+        if audio_info.get("sample_rate_hertz"):
+            # has to match the file (at least for mp3s)
+            config_dict["sample_rate_hertz"] = audio_info["sample_rate_hertz"]
+        if (audio_info.get("channels") or 1) > 1:
+            self.request_options["multiple_channels"] = True
+
+        if "sample_rate_hertz" in self.request_options:
+            # set when retrying after Google didn't like the sample rate (see _reconfigure_request)
+            config_dict["sample_rate_hertz"] = self.request_options["sample_rate_hertz"]
+
+        if (self.request_options.get("multiple_channels")):
+            logger.info("Sending with multiple channels")
+            # if we couldn't read the header, I think there's normally just two
+            config_dict["audio_channel_count"] = audio_info.get("channels") or 2
+            config_dict["enable_separate_recognition_per_channel"] = True
+        
+        logger.info("setting up with file: " + self.filename)
+        # TODO consider sending their config object...though maybe has same results. But either way, check out the options in beta https://googleapis.dev/python/speech/latest/gapic/v1p1beta1/types.html#google.cloud.speech_v1p1beta1.types.RecognitionConfig
+        logger.debug("setting up with config" + json.dumps(config_dict))
+        
+        request_params = {
+            "audio": audio,
+            "config": config_dict,
+        }
 
-        except Exception as error:
-            # mark request status in firestore 
-            self.mark_as_server_error(error)
-            # bubble up error
-            raise error
+        self.request_params = request_params
 
 
     # for when status "processing-file" (aka received_by_server)
@@ -361,79 +620,180 @@ class TranscribeRequest:
         logger.info("----------------------------------------------------------------")
         logger.info("Sending long running request")
         logger.info("----------------------------------------------------------------")
-        try:
-            logger.info(f"Attempt # {self.attempt_count()}")
+        if self.finish_from_cache():
+            return
 
+        if self.should_chunk():
+            return self.request_chunked_recognize()
+
+        # sample rates we've sent so far, so we don't send the same one twice
+        tried_sample_rates = [self.request_params["config"].get("sample_rate_hertz")]
+
+        def send():
+            logger.info(f"Attempt # {self.attempt_count()}")
             logger.info("options here is: " +  json.dumps(self.request_options))
             logger.info("sendng with config" + json.dumps(self.request_params["config"]))
             # this is initial response, not complete transcript yet
-            # TODO handle if there's no file there, ie it got deleted but they request again or something
-            operation_future = speech_client.long_running_recognize(self.request_params['config'], self.request_params['audio'], retry=reset_retry)
+            # waits here if we're already sending Google as much as our quota allows (see admission.py)
+            with admission.admit(self.admission_wait()), metrics.external_call("speech", "long_running_recognize"):
+                return speech_client.long_running_recognize(self.request_params['config'], self.request_params['audio'], retry=reset_retry)
+
+        def on_error(error, error_class):
+            if not isinstance(error, admission.AdmissionTimeout):
+                # never got to Google, so not a failed attempt
+                self.failed_attempts += 1
+
+        try:
+            # retries (or not) depending on what kind of error it is (see retry_policy.py)
+            operation_future = retry_policy.call_with_retries(
+                send,
+                reconfigure=lambda action: self._reconfigure_request(action, tried_sample_rates),
+                budget=self.retry_budget(),
+                on_error=on_error,
+            )
             # NOTE for some reason operation_future.metadata returns None
             self.mark_as_transcribing(operation_future)
 
-        except Exception as error:
+        except admission.AdmissionTimeout:
+            # never got to Google, so not a transcribing error. Whoever called us decides (e.g., the job queue tries again later)
+            raise
 
-            # TODO or maybe try passing in details to the REtry arg?
+        except Exception as error:
             logger.error('Error while doing a long-running request:')
             logger.error(traceback.format_exc())
-            #logger.error(error)
+            # note that it might be our fault for sending them something, but we are not the ones directly throwing the error, so it is a transcribing error
+            self.mark_as_transcribing_error(error)
 
-            # TODO add back in maybe, but for now keep things simple
-            if (self.failed_attempts < 2):
-                # need at least two, one for if internal error, and then if another is for channels 
-                self.failed_attempts += 1
+    def retry_budget(self):
+        """
+        web requests only get RETRY["WEB_BUDGET_SECONDS"] of waiting, since someone's waiting on the response (and gunicorn might kill the worker). The worker sets retry_wait_seconds to wait longer
+        """
+        max_wait_seconds = settings.RETRY["WEB_BUDGET_SECONDS"] if self.retry_wait_seconds is None else self.retry_wait_seconds
+        return retry_policy.RetryBudget(max_wait_seconds=max_wait_seconds)
+
+    def admission_wait(self):
+        """
+        how long to wait for our turn to send to Google (see admission.py). Same idea as retry_budget, the worker sets admission_wait_seconds to wait longer
+        """
+        return settings.ADMISSION["WEB_MAX_WAIT_SECONDS"] if self.admission_wait_seconds is None else self.admission_wait_seconds
+
+    def _reconfigure_request(self, action, tried_sample_rates):
+        """
+        changes what we send to Google, after an error that says what we sent was wrong
+        - returns False if there's nothing left to try
+        - if that fails, it raises to request_long_running_recognize, which marks it as a transcribing error. So doesn't use setup_request, which would mark it as a server error first
+        """
+        if action == retry_policy.RECONFIGURE_CHANNELS:
+            if self.request_options.get("multiple_channels"):
+                return False
+
+            logger.info("trying again, but with multiple channel configuration.")
+            self.request_options["multiple_channels"] = True
+
+        elif action == retry_policy.RECONFIGURE_SAMPLE_RATE:
+            # what the header says first, then let Google figure it out, then what we use for mp3s by default
+            candidates = [(self.get_audio_info() or {}).get("sample_rate_hertz"), None, 16000]
+            untried = [sample_rate for sample_rate in candidates if sample_rate not in tried_sample_rates]
+            if not untried:
+                return False
+
+            logger.info(f"trying again, but with sample rate hertz {untried[0]}")
+            self.request_options["sample_rate_hertz"] = untried[0]
+            tried_sample_rates.append(untried[0])
+
+        else:
+            return False
+
+        # update the params to send
+        self._build_request_params()
+        return True
 
-                # https://cloud.google.com/speech-to-text/docs/error-messages
-                if (str(error) in [
-                    # got with fileout.wav. code 3 
-                    "Must use single channel (mono) audio, but WAV header indicates 2 channels.",  
-                    # or is it this one?
-                    "400 Must use single channel (mono) audio, but WAV header indicates 2 channels.",
-                    # got with fileout.flac 
-                    "400 Invalid audio channel count",
-                    "400 audio_channel_count `1` in RecognitionConfig must either be unspecified or match the value in the FLAC header `2`.",
-                ]):
-
-                    # try again with different channel configuration
-                    logger.info("trying again, but with multiple channel configuration.")
-                    self.request_options["multiple_channels"] = True
-                    # call this again, to update the params to send
-                    self.setup_request()
-                    self.request_long_running_recognize()
-
-                elif ("Connection reset by peer" in str(error)):
-                    # NOTE should not get these anymore due to new retry strategy
-                    # NOTE I hate this error... just retry it
-                    # I think teh full str is: ('Connection aborted.', ConnectionResetError(104, 'Connection reset by peer'))
-                    # at least sometimes
-                    self.request_long_running_recognize()
-
-                elif ("13" in str(error)):
-                    # this is internal error Error while doing a long-running request: Error: 13 INTERNAL
-                    # not tested TODO
-
-                    logger.info("internal Google error, so just trying same thing again")
-                    self.request_long_running_recognize()
-
-                elif ("WAV header indicates an unsupported format." == str(error)):
-                    # TODO panic
-                    # not tested TODO
-                    # TODO don't let them retry too many times, it'll hit some quota or something probably
-                    # don't bother retrying...
-                    self.mark_as_transcribing_error(error)
-
-                elif "400 Invalid recognition 'config': bad sample rate hertz." == str(error):
-                    # TODO try again with different hertz? 
-                    pass
-
-                else:
-                    logger.error("well then what was our error??")
-                    logger.error(str(error))
-                    self.mark_as_transcribing_error(error)
-            else:
-                # note that it might be our fault for sending them something, but we are not the ones directly throwing the error, so it is a transcribing error
-                self.mark_as_transcribing_error(error)
+
+    ##################################################
+    # reusing transcripts (see transcript_cache.py)
+    ################################################
+
+    def finish_from_cache(self):
+        """
+        if we've already transcribed this same audio with the same config, copies that transcript instead of asking Google again
+        - returns True if it did
+        - sets cache_key either way, so once Google is done we can store the transcript for next time
+        """
+        if not settings.TRANSCRIPT_CACHE["ENABLED"] or not self.file_path:
+            return False
+
+        try:
+            # what was uploaded, since that's what's the same between uploads (flac we convert it to might not be byte for byte the same)
+            with metrics.external_call("storage", "download"):
+                self.content_hash = transcript_cache.content_hash(bucket.blob(self.original_file_path or self.file_path))
+            self.cache_key = transcript_cache.cache_key(self.content_hash, self.request_params["config"])
+            cached = transcript_cache.lookup(self.cache_key)
+
+        except Exception as error:
+            # only a nice-to-have, so just send to Google like normal
+            logger.error(f"error checking transcript cache for {self.file_path}")
+            logger.error(error)
+            return False
+
+        if cached is None:
+            return False
+
+        entry, manifest, utterances = cached
+        logger.info(f"already transcribed this audio, copying {entry['transcript_path']}")
+        # our own id, not the operation the transcript came from. Requests sharing a transaction_id would share a transcript doc name, and get coalesced together (see coalescing.py)
+        self.transaction_id = f"cache-{self.id}"
+        self.transcript_metadata = {
+            **manifest.get("transcript_metadata", {}),
+            "cached_from": entry["transcript_path"],
+            "cached_transaction_id": entry["transaction_id"],
+        }
+
+        # same as when Google finishes (see _handle_operation), all in one batch
+        with self.batched_writes():
+            self._update_status(TRANSCRIPTION_STATUSES[3], other={ # transcribing
+                "transaction_id": self.transaction_id,
+            })
+            self.mark_as_transcribed()
+            self.handle_transcript_results(utterances)
+            self.persist_transcript_data()
+            self.persist()
+
+        return True
+
+
+    ##################################################
+    # chunked recognition (see chunking.py)
+    ################################################
+
+    def should_chunk(self):
+        return bool(self.chunked) and settings.CHUNKING["ENABLED"] and bool(self.file_path) and ChunkedRecognition(self).can_chunk()
+
+    def is_chunked_transaction(self):
+        return bool(self.transaction_id) and self.transaction_id.startswith("chunked-")
+
+    def chunk_config(self):
+        """
+        config for every chunk. Chunks are always mono flac, so no need to guess the encoding, channels or sample rate
+        """
+        return dict(TranscribeRequest._flac_config)
+
+    def request_chunked_recognize(self):
+        """
+        splits the file into chunks and sends the first ones to Google. The rest get sent as we check progress
+        """
+        logger.info(f"Sending {self.filename} in chunks")
+        try:
+            ChunkedRecognition(self).start(self.chunk_config())
+            self.transaction_id = f"chunked-{self.id}"
+            self._update_status(TRANSCRIPTION_STATUSES[3], other={ # transcribing
+                "transaction_id": self.transaction_id,
+                **self._cache_fields(),
+            })
+
+        except Exception as error:
+            logger.error('Error while sending chunks:')
+            logger.error(traceback.format_exc())
+            self.mark_as_transcribing_error(error)
 
 
     # TODO remane "process transcript results"
@@ -495,47 +855,91 @@ class TranscribeRequest:
 
         logger.info("setting data to transcripts")
 
-        # cleanup storage and db records
-        # TODO add error handling if fail to delete, so that it is marked as not deleted. Perhaps a separate try/catch so we know this is what fails, and not something after.
-        # Or alternatively, something that tracks each ste_p and marks the last completed ste_p so we know where something stopped and can pick it up later/try again later
-        # TODO put in separate method
-        for path in [self.file_path, self.original_file_path]:
-            if (path):
-                # delete file from cloud storage (bucket assigned in the admin initializeApp call)
-
-                try:
-                    blob = bucket.blob(path)
-                    if reset_retry(blob.exists)():
-                        logger.info("deleting file from " + path)
-                        reset_retry(blob.delete)()
-                        logger.info("deleted file from " + path)
-
-                except Exception as error:
-                    # typically something like: "ConnectionResetError: [Errno 104] Connection reset by peer"
-                    # tracked here: https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348
-                    # official temp solution is here: https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348
-                    logger.error("error deleting file " + path)
-                    logger.error(error)
-                    if "Connection reset by peer" in str(error):
-                        # if the above decorator doesn't work, retry here
-                        pass
-
-        # mark upload as finished transcribing
-        self.mark_as_processed()
+        # uploaded files get deleted in the background once this batch is committed (see storage_cleanup.py), so we don't wait on storage here
+        with self.batched_writes() as unit_of_work:
+            storage_cleanup.schedule([self.file_path, self.original_file_path], unit_of_work)
+
+            # mark upload as finished transcribing
+            self.mark_as_processed()
+
         return
 
 
     ##############################
     # File manipulation methods
     ##########################
-    def makeItFlac(self, data, options = {}):
+    def transcode_timeout(self):
         """
-        converts file (eg mp3, wav, mp4) to flac file
+        how long converting to flac can take. Same idea as retry_budget, the worker sets transcode_timeout_seconds to take longer. 0 means don't convert
+        """
+        return settings.TRANSCODING["WEB_TIMEOUT_SECONDS"] if self.transcode_timeout_seconds is None else self.transcode_timeout_seconds
+
+    def should_convert_to_flac(self):
+        if not settings.TRANSCODING["ENABLED"] or not self.file_path:
+            return False
+
+        if not self.transcode_timeout():
+            logger.info("not converting to flac in a web request, sending file to Google as is")
+            return False
+
+        if self.file_extension not in TRANSCODE_TO_FLAC_TYPES:
+            return False
+
+        if shutil.which(settings.TRANSCODING["FFMPEG"]) is None:
+            logger.info("ffmpeg isn't installed, so sending file to Google as is")
+            return False
+
+        return True
+
+    def send_to_google(self):
+        """
+        everything after validating, up until Google has it
+        """
+        # convert to flac if needed. Still "processing-file" while this happens
+        self.makeItFlac()
+
+        logger.debug("== setting up request payload to send to Google")
+        self.setup_request()
+
+        logger.debug("== sending request payload to Google")
+        self.request_long_running_recognize()
+
+    def makeItFlac(self):
+        """
+        converts file (eg mp3, wav) in storage to mono flac file, next to the original (see transcoding.py)
         - Use case is that even mp3 files seem to work better when converted to flac first for whatever reason
-        - base on https://github.com/firebase/functions-samples/blob/master/ffmpeg-convert-audio/functions/index.js
-        - TODO might be better in the future, for more flexibility and ease of use, to just use ffmpeg-static and bash code rather than a wrapper, so can write exactly as it would be in the command line. However, have to figure out how to install a binary in heroku...and note that they cycle machines
+        - happens while status is still "processing-file"
+        - afterwards, file_path is the flac and original_file_path is what was uploaded. Both get deleted once the transcript is done
+        - does nothing if the file doesn't need converting (or we can't convert it)
+        - if converting fails, just sends the original. It's only a nice-to-have
         """
-        pass
+        if not self.should_convert_to_flac():
+            return
+
+        flac_path = transcoding.flac_path_for(self.file_path)
+        # ffmpeg can't write the duration into the flac header when streaming, so remember it from the original
+        original_duration = (self.get_audio_info() or {}).get("duration_seconds")
+        logger.info(f"converting {self.file_path} to {flac_path}")
+        try:
+            transcoding.transcode_to_flac(self.file_path, flac_path, timeout=self.transcode_timeout())
+
+        except transcoding.TranscodingError as error:
+            logger.error(f"error converting {self.file_path}, sending original instead")
+            logger.error(error)
+            return
+
+        self.original_file_path = self.file_path
+        self.file_path = flac_path
+        self.file_type = "audio/flac"
+        self.file_extension = "flac"
+        self._set_request_options()
+        # the header is different now, so read it again next time we need it
+        self.audio_info = None
+        if original_duration and self.get_audio_info() and not self.audio_info.get("duration_seconds"):
+            self.audio_info["duration_seconds"] = original_duration
+
+        # so if we get resumed later, we don't convert it again
+        self.persist()
 
 
     # maybe use later
@@ -557,15 +961,20 @@ class TranscribeRequest:
     def refresh_from_db(self):
         """ 
         ultimately db should be source of truth, so occassionally need to pull directly from there
+        - returns whether the doc was there
         """
         ref = self.transcribe_request_ref()
-        transcribe_request_doc = ref.get()
+        with metrics.external_call("firestore", "get"):
+            transcribe_request_doc = ref.get()
 
         if transcribe_request_doc.exists:
             # TODO remove this later, just for now as we're actively developing this method
             logger.info("Transcribe Request record found: ")
             file_data = transcribe_request_doc.to_dict()
             logger.info(file_data)
+            # docs the client made don't always have these, but we already know them
+            file_data.setdefault("id", self.id)
+            file_data.setdefault("user_id", self.user_id)
 
             # set to this class instance
             self._set_attributes_from_dictionary(file_data)
@@ -574,12 +983,97 @@ class TranscribeRequest:
             logger.info("Uh oh...no transcribe Request record found...")
             # TODO handle, this means we need to request transcript again
 
+        return transcribe_request_doc.exists
+
+    @contextmanager
+    def batched_writes(self):
+        """
+        everything written to firestore inside this block gets committed together in one batch when the block exits
+        - if we're already inside a batched_writes block, just joins that one, and the outer block commits
+        - if the block raises, nothing that was queued gets written
+        """
+        if self._unit_of_work is not None:
+            yield self._unit_of_work
+            return
+
+        self._unit_of_work = UnitOfWork(db)
+        try:
+            yield self._unit_of_work
+            self._unit_of_work.commit()
+        except Exception:
+            self._unit_of_work.discard()
+            raise
+        finally:
+            self._unit_of_work = None
+
+    @staticmethod
+    @contextmanager
+    def batched_writes_for(transcribe_requests):
+        """
+        like batched_writes, but for several requests at once, so e.g., marking a whole batch of files as received is one commit
+        """
+        unit_of_work = UnitOfWork(db)
+        for transcribe_request in transcribe_requests:
+            transcribe_request._unit_of_work = unit_of_work
+
+        try:
+            yield unit_of_work
+            unit_of_work.commit()
+        except Exception:
+            unit_of_work.discard()
+            raise
+        finally:
+            for transcribe_request in transcribe_requests:
+                transcribe_request._unit_of_work = None
+
+    def _set_document(self, ref, data, merge=False):
+        with self.batched_writes() as unit_of_work:
+            unit_of_work.set(ref, data, merge=merge)
+
+    def _add_document(self, collection_ref, data):
+        with self.batched_writes() as unit_of_work:
+            return unit_of_work.add(collection_ref, data)
+
+    def to_dict(self, fields):
+        """
+        returns dict with just these fields, leaving out empty ones
+        """
+        data = {name: getattr(self, name) for name in fields}
+        return TranscribeRequest.cleanup_dictionary(data)
+
+    def request_document(self):
+        return self.to_dict(TranscribeRequest.REQUEST_DOCUMENT_FIELDS)
+
+    def transcript_document(self):
+        return self.to_dict(TranscribeRequest.TRANSCRIPT_DOCUMENT_FIELDS)
+
+    def response_data(self):
+        """
+        for sending back to the client in our json responses
+        """
+        return self.to_dict(TranscribeRequest.RESPONSE_FIELDS)
 
     def persist(self):
-        data = self.__dict__
-        cleaned_data = TranscribeRequest.cleanup_dictionary(data)
         transcribe_request_ref = self.transcribe_request_ref()
-        transcribe_request_ref.set(cleaned_data, merge=True)
+        with self.batched_writes() as unit_of_work:
+            unit_of_work.after_commit(lambda: request_cache.invalidate(self))
+            self._set_document(transcribe_request_ref, {**self.request_document(), **self._version_updates()}, merge=True)
+
+    def _version_state(self):
+        return (self.status, self.transcript_metadata.get("progress_percent"), self.updated_at)
+
+    def _version_updates(self):
+        """
+        for writes to the transcribeRequests doc: adds one to version if anything a client would see changed since we last did
+        - e.g., persisting progress that hasn't moved doesn't count, so the client still gets "unchanged"
+        """
+        state = self._version_state()
+        if state == self._versioned_state:
+            return {}
+
+        self._versioned_state = state
+        self.version = (self.version or 0) + 1
+        return {"version": firestore.Increment(1)}
 
 
     def persist_transcript_data(self):
@@ -590,13 +1084,10 @@ class TranscribeRequest:
         - sets data to the transcript ref in firestore
         - only for completed transcripts (incomplete should be at transcribeRequests ref)
         - doc_name is unique identifier for this transcription, different for each version of the transcript even for the same file
-
-        TODO only set attributes needed for the transcript, don't want everything on this thing!
+        - only sets the fields in TRANSCRIPT_DOCUMENT_FIELDS, and the utterances get split into pages (see transcript_storage.py) so big transcripts don't go over firestore's doc size limit
         """
-        data = self.__dict__
-        cleaned_data = TranscribeRequest.cleanup_dictionary(data)
         doc_ref = self.transcript_document_ref()
-        doc_ref.set(cleaned_data)
+        transcript_storage.write_transcript(doc_ref, self.transcript_document(), self.utterances, self._set_document)
 
     #############################
     # status marking methods (for persisting in firestore)
@@ -613,13 +1104,20 @@ class TranscribeRequest:
 
         operation_name = operation_future.operation.name
         logger.info("operation name is: " + operation_name)
+        # otherwise only firestore has it, and e.g., the transcript cache entry and transcript doc name get None
+        self.transaction_id = operation_name
 
 
         # https://google-cloud-python.readthedocs.io/en/0.32.0/core/operation.html
         self._update_status(TRANSCRIPTION_STATUSES[3], other={ # transcribing
             "transaction_id": operation_name,
+            **self._cache_fields(),
         }) 
 
+    def _cache_fields(self):
+        # so that whoever finds out Google is done (maybe the worker) can store the transcript in the cache
+        return {"content_hash": self.content_hash, "cache_key": self.cache_key} if self.cache_key else {}
+
     def mark_as_transcribed(self):
 
         self._update_status(TRANSCRIPTION_STATUSES[4]) # processing-transcription
@@ -663,38 +1161,78 @@ class TranscribeRequest:
             "time": timestamp()
         }
 
+        self._record_status_change(status)
         self.status = status
+        self.updated_at = event_log["time"]
+        self.updated_at_time = utc_now()
         if other_in_event.get("error"):
             error = other_in_event.get("error")
             # set error on obj for easy access
             self.error = str(error)
         else:
             self.error = ""
-        self.event_logs.append(event_log)
 
         transcribe_request_ref = self.transcribe_request_ref()
 
         updates = {
             **other,
             "status": status,
-            "updated_at": timestamp(),
+            "updated_at": self.updated_at,
+            "updated_at_time": self.updated_at_time,
             "error": self.error, # either sets as error or blank string
+            **self._version_updates(),
         }
 
 
-        # update status (and whatever is in other) to firestore 
-        transcribe_request_ref.set(updates, merge=True)
-        logger.info("updated status")
-        logger.info(updates)
+        # status and event log go out together in one batch (or with the rest of the batch, if we're already in one)
+        with self.batched_writes() as unit_of_work:
+            # whatever got cached for this request is out of date now
+            unit_of_work.after_commit(lambda: request_cache.invalidate(self))
+            # update status (and whatever is in other) to firestore 
+            self._set_document(transcribe_request_ref, updates, merge=True)
+            logger.info("updated status")
+            logger.info(updates)
+
+            # log the new event
+            event_log_ref = transcribe_request_ref.collection(EVENT_LOGS_COLLECTION)
+            event_log_doc_ref = self._add_document(event_log_ref, event_log)
+            # keep our copy up to date, without having to read it back
+            self._event_logs[event_log_doc_ref.id] = event_log
+
 
-        # log the new event
-        event_log_ref = transcribe_request_ref.collection("eventLogs")
-        event_log_ref.add(event_log) 
+    def _record_status_change(self, status):
+        """
+        how long we were in the status we're leaving (see metrics.py)
+        - updated_at is when we got into it, possibly in another process. Not updated_at_time, since that also moves when Google makes progress (see _heartbeat)
+        """
+        metrics.status_changes.inc(status=status)
+        if not self.status or self.status == status or not (self.updated_at or self.updated_at_time):
+            return
+
+        try:
+            elapsed = seconds_since(self.updated_at) if self.updated_at else self.elapsed_since_last_event()
+            metrics.status_seconds.observe(max(elapsed, 0), status=self.status)
+        except ValueError:
+            logger.error(f"can't tell how long we were in {self.status}, updated_at is {self.updated_at}")
 
 
     ################################    
     # class variables
     ################################
+    # seconds with nothing happening before we assume a request stopped, before adding time for bigger files (see stalled_after_seconds)
+    # - used to be compared against elapsed_since_last_event's digit subtraction, where 100 was about a minute. Now they're real seconds, so we wait a bit longer than before
+    # - only statuses that can get stuck. Anything else (done or errored) has already stopped
+    STALLED_AFTER_SECONDS = {
+        TRANSCRIPTION_STATUSES[0]: 0, # uploading
+        # we mark as received almost instantaneously, but sometimes the server might have been sleeping, et cetera
+        TRANSCRIPTION_STATUSES[1]: 200, # uploaded
+        # only some quick variable setting, some firestore calls, and a quick roundtrip to Google's API that confirms they started (unless converting to flac)
+        TRANSCRIPTION_STATUSES[2]: 100, # processing-file
+        TRANSCRIPTION_STATUSES[3]: 100, # transcribing
+        # should be pretty fast, just iterate over transcript and set to firestore a few times
+        TRANSCRIPTION_STATUSES[4]: 100, # processing-transcription
+    }
+
     # encoding: 
     # - Google: "The FLAC and WAV audio file format_s include a header that describes the included audio content. You can request recognition for WAV files that contain either LINEAR16 or MULAW encoded audio. If you send FLAC or WAV audio file format in your request, you do not need to specify an AudioEncoding; the audio encoding format is determined from the file header. If you specify an AudioEncoding when you send send FLAC or WAV audio, the encoding configuration must match the encoding described in the audio header; otherwise the request returns an google.rpc.Code.INVALID_ARGUMENT error code."
 
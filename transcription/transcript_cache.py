@@ -0,0 +1,89 @@
+"""
+Reusing transcripts for audio we've already transcribed
+- transcripts are normally keyed by filename and lastModified, so the same audio uploaded again (under another name, or by another user) would get sent to Google, and billed, again
+- instead, we hash the file's contents (streamed, so never all in memory) together with the recognition config that affects the results (encoding, channels, model etc). If we already have a transcript for that key, the request just gets a copy of it
+- cache entries live in the transcriptCache collection, one doc per key, pointing at the transcript they came from:
+    {"transcript_path": "users/abc/transcripts/sermon.flac-at-123", "transaction_id": "123", "content_hash": "...", "created_at": "..."}
+"""
+import hashlib
+import json
+from .helpers import *
+from . import transcript_storage
+logger = logging.getLogger('testlogger')
+
+TRANSCRIPT_CACHE_COLLECTION = "transcriptCache"
+
+# how much of the file to read at a time while hashing
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# parts of the config that change what Google sends back. Anything else (e.g., the file's uri) doesn't go into the key
+CONFIG_KEY_FIELDS = [
+    "encoding",
+    "sample_rate_hertz",
+    "audio_channel_count",
+    "enable_separate_recognition_per_channel",
+    "language_code",
+    "model",
+    "max_alternatives",
+    "enable_automatic_punctuation",
+    "enable_word_confidence",
+    "enable_word_time_offsets",
+]
+
+
+def content_hash(blob, chunk_size=HASH_CHUNK_SIZE):
+    """
+    sha256 of the blob's contents, reading it a chunk at a time
+    """
+    digest = hashlib.sha256()
+    with blob.open("rb") as reader:
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def cache_key(file_hash, config):
+    """
+    same file + same config that matters => same key
+    """
+    effective_config = {field: config.get(field) for field in CONFIG_KEY_FIELDS}
+    # encoding is an IntEnum, so it goes in as its number
+    serialized = json.dumps(effective_config, sort_keys=True, default=str)
+    return hashlib.sha256(f"{file_hash}:{serialized}".encode("utf-8")).hexdigest()
+
+
+def cache_ref(key):
+    return db.collection(TRANSCRIPT_CACHE_COLLECTION).document(key)
+
+
+def lookup(key):
+    """
+    returns (cache entry, manifest, utterances) of the cached transcript, or None if there isn't one
+    - also None if the transcript it points to has since been deleted
+    """
+    entry = cache_ref(key).get().to_dict()
+    if entry is None:
+        return None
+
+    manifest, utterances = transcript_storage.read_transcript(db.document(entry["transcript_path"]))
+    if manifest is None:
+        logger.info(f"cached transcript {entry['transcript_path']} is gone, ignoring cache entry")
+        return None
+
+    return entry, manifest, utterances
+
+
+def store(key, file_hash, transcript_ref, transaction_id, set_document):
+    """
+    - set_document(ref, data) does the actual write, so it can go out in the same batch as the transcript itself
+    """
+    set_document(cache_ref(key), {
+        "transcript_path": transcript_ref.path,
+        "transaction_id": transaction_id,
+        "content_hash": file_hash,
+        "created_at": timestamp(),
+    })
@@ -0,0 +1,323 @@
+"""
+Storage format for finished transcripts
+- long files make for huge transcripts (we ask Google for word offsets, word confidence and 3 alternatives), and a single firestore doc can't go over 1 MiB
+- so utterances get split into pages of about TRANSCRIPT_PAGE_WORDS words, each one a separate doc in the transcript's "pages" subcollection that can be read on its own
+- in each page, word level data is stored as columns (word ids into the page's vocabulary, start/end offsets in ms, confidence in thousandths) and the whole page is a zlib compressed json blob
+- the transcript doc itself becomes a manifest: the request's metadata, plus which utterances and times each page covers
+- the frontend still reads "utterances" straight off the transcript doc, so those stay on the manifest too, as long as they fit (TRANSCRIPT_INLINE_UTTERANCES_MAX_BYTES). Bigger ones never fit in one doc anyway. For those (and once the frontend moves over, for all of them), transcript/ returns the old shape (see legacy_document)
+
+Transcript doc:
+    {..., "transcript_format": "paged-v1", "page_count": 2, "utterance_count": 40, "word_count": 9000, "pages": [{"first_utterance": 0, "utterance_count": 22, "word_count": 5001, "start_ms": 0, "end_ms": 1800000}, ...]}
+Page doc (transcripts/{doc}/pages/00000):
+    {"index": 0, "first_utterance": 0, "blob": <zlib compressed json>}
+"""
+import json
+import re
+import zlib
+from django.conf import settings
+
+TRANSCRIPT_FORMAT = "paged-v1"
+PAGES_COLLECTION = "pages"
+# what the manifest has that transcript docs didn't before paging
+MANIFEST_FIELDS = ["transcript_format", "page_count", "utterance_count", "word_count", "pages"]
+
+# e.g., "1.500s" or "12s", which is how Google sends durations
+_DURATION_PATTERN = re.compile(r"^(\d+)(?:\.(\d+))?s$")
+
+
+#########################
+# durations
+#########################
+
+def duration_to_ms(duration):
+    """
+    takes duration string from Google (e.g., "1.500s") and returns int of milliseconds
+    - returns None if there's no duration
+    """
+    if duration is None:
+        return None
+
+    match = _DURATION_PATTERN.match(duration)
+    if not match:
+        raise ValueError(f"Not a duration: {duration}")
+
+    seconds, fraction = match.groups()
+    # only keep ms, Google only sends in 100ms increments anyways
+    milliseconds = int((fraction or "0").ljust(3, "0")[:3])
+    return int(seconds) * 1000 + milliseconds
+
+
+def ms_to_duration(ms):
+    """
+    the reverse of duration_to_ms, formatted the same way Google formats them
+    """
+    if ms is None:
+        return None
+
+    seconds, milliseconds = divmod(ms, 1000)
+    if milliseconds == 0:
+        return f"{seconds}s"
+
+    return f"{seconds}.{milliseconds:03d}s"
+
+
+#########################
+# packing a page
+#########################
+
+def _confidence_to_int(confidence):
+    return None if confidence is None else round(confidence * 1000)
+
+
+def _int_to_confidence(value):
+    return None if value is None else value / 1000
+
+
+def pack_page(utterances):
+    """
+    takes list of utterances (results from Google, as dicts) and returns dict with word level data as columns
+    - everything other than the words is kept as it was
+    """
+    vocabulary = []
+    word_ids_by_word = {}
+    columns = {
+        "word_ids": [],
+        "start_ms": [],
+        "end_ms": [],
+        "confidence": [],
+        # anything else Google sent for a word (e.g., speakerTag). Usually all None, so compresses to almost nothing
+        "extra": [],
+    }
+
+    packed_utterances = []
+    for utterance in utterances:
+        packed_alternatives = []
+        for alternative in utterance.get("alternatives", []):
+            first_word = len(columns["word_ids"])
+            for word in alternative.get("words", []):
+                text = word.get("word", "")
+                if text not in word_ids_by_word:
+                    word_ids_by_word[text] = len(vocabulary)
+                    vocabulary.append(text)
+
+                columns["word_ids"].append(word_ids_by_word[text])
+                columns["start_ms"].append(duration_to_ms(word.get("startTime")))
+                columns["end_ms"].append(duration_to_ms(word.get("endTime")))
+                columns["confidence"].append(_confidence_to_int(word.get("confidence")))
+                extra = {k: v for k, v in word.items() if k not in ["word", "startTime", "endTime", "confidence"]}
+                columns["extra"].append(extra or None)
+
+            packed_alternative = {k: v for k, v in alternative.items() if k != "words"}
+            if "words" in alternative:
+                packed_alternative["word_range"] = [first_word, len(columns["word_ids"])]
+            packed_alternatives.append(packed_alternative)
+
+        packed_utterances.append({**utterance, "alternatives": packed_alternatives})
+
+    return {
+        "vocabulary": vocabulary,
+        "utterances": packed_utterances,
+        "words": columns,
+    }
+
+
+def unpack_page(page):
+    """
+    the reverse of pack_page, returns list of utterances
+    """
+    vocabulary = page["vocabulary"]
+    columns = page["words"]
+
+    utterances = []
+    for packed_utterance in page["utterances"]:
+        alternatives = []
+        for packed_alternative in packed_utterance.get("alternatives", []):
+            alternative = {k: v for k, v in packed_alternative.items() if k != "word_range"}
+            if "word_range" in packed_alternative:
+                start, end = packed_alternative["word_range"]
+                alternative["words"] = [_unpack_word(vocabulary, columns, i) for i in range(start, end)]
+            alternatives.append(alternative)
+
+        utterances.append({**packed_utterance, "alternatives": alternatives})
+
+    return utterances
+
+
+def _unpack_word(vocabulary, columns, i):
+    word = {}
+    if columns["start_ms"][i] is not None:
+        word["startTime"] = ms_to_duration(columns["start_ms"][i])
+    if columns["end_ms"][i] is not None:
+        word["endTime"] = ms_to_duration(columns["end_ms"][i])
+    word["word"] = vocabulary[columns["word_ids"][i]]
+    if columns["confidence"][i] is not None:
+        word["confidence"] = _int_to_confidence(columns["confidence"][i])
+    word.update(columns["extra"][i] or {})
+    return word
+
+
+def compress_page(page):
+    return zlib.compress(json.dumps(page, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def decompress_page(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+#########################
+# splitting into pages
+#########################
+
+def _word_count(utterance):
+    return sum(len(alternative.get("words", [])) for alternative in utterance.get("alternatives", []))
+
+
+def _time_range(utterance):
+    """
+    returns (start_ms, end_ms) of the utterance's words, or (None, None) if it doesn't have any
+    """
+    starts = []
+    ends = []
+    for alternative in utterance.get("alternatives", []):
+        for word in alternative.get("words", []):
+            starts.append(duration_to_ms(word.get("startTime")))
+            ends.append(duration_to_ms(word.get("endTime")))
+
+    starts = [start for start in starts if start is not None]
+    ends = [end for end in ends if end is not None]
+    return (min(starts) if starts else None, max(ends) if ends else None)
+
+
+def split_into_pages(utterances, page_words=None):
+    """
+    returns list of lists of utterances, each with about page_words words
+    - never splits an utterance, so a page can go over if a single utterance is huge
+    """
+    page_words = page_words or settings.TRANSCRIPT_PAGE_WORDS
+    pages = []
+    current = []
+    current_words = 0
+
+    for utterance in utterances:
+        words = max(_word_count(utterance), 1)
+        if current and current_words + words > page_words:
+            pages.append(current)
+            current = []
+            current_words = 0
+
+        current.append(utterance)
+        current_words += words
+
+    if current or not pages:
+        pages.append(current)
+
+    return pages
+
+
+def build_documents(metadata, utterances, page_words=None, inline_max_bytes=None):
+    """
+    takes transcript metadata (whatever else should be on the transcript doc) and utterances
+    returns (manifest dict, list of page dicts), ready to set to firestore
+    - utterances also go on the manifest if they're under inline_max_bytes (as json), for clients that read them from there
+    """
+    manifest_pages = []
+    page_docs = []
+    first_utterance = 0
+
+    for index, page_utterances in enumerate(split_into_pages(utterances or [], page_words)):
+        ranges = [_time_range(utterance) for utterance in page_utterances]
+        starts = [start for start, end in ranges if start is not None]
+        ends = [end for start, end in ranges if end is not None]
+
+        manifest_pages.append({
+            "first_utterance": first_utterance,
+            "utterance_count": len(page_utterances),
+            "word_count": sum(_word_count(utterance) for utterance in page_utterances),
+            "start_ms": min(starts) if starts else None,
+            "end_ms": max(ends) if ends else None,
+        })
+        page_docs.append({
+            "index": index,
+            "first_utterance": first_utterance,
+            "blob": compress_page(pack_page(page_utterances)),
+        })
+        first_utterance += len(page_utterances)
+
+    manifest = {
+        **metadata,
+        "transcript_format": TRANSCRIPT_FORMAT,
+        "page_count": len(page_docs),
+        "utterance_count": first_utterance,
+        "word_count": sum(page["word_count"] for page in manifest_pages),
+        "pages": manifest_pages,
+    }
+
+    if inline_max_bytes is None:
+        inline_max_bytes = settings.TRANSCRIPT_INLINE_UTTERANCES_MAX_BYTES
+    if utterances and inline_max_bytes and len(json.dumps(utterances, ensure_ascii=False).encode("utf-8")) <= inline_max_bytes:
+        manifest["utterances"] = utterances
+
+    return manifest, page_docs
+
+
+def legacy_document(manifest, utterances):
+    """
+    the transcript doc like it was before paging: the request's metadata plus all the utterances
+    """
+    document = {key: value for key, value in manifest.items() if key not in MANIFEST_FIELDS}
+    document["utterances"] = utterances
+    return document
+
+
+def page_document_id(index):
+    # zero padded so they sort in order
+    return f"{index:05d}"
+
+
+#########################
+# reading/writing firestore
+#########################
+
+def write_transcript(transcript_ref, metadata, utterances, set_document, page_words=None):
+    """
+    - set_document(ref, data) does the actual write, so the caller can batch the writes (see TranscribeRequest._set_document)
+    """
+    manifest, page_docs = build_documents(metadata, utterances, page_words)
+    pages_ref = transcript_ref.collection(PAGES_COLLECTION)
+
+    set_document(transcript_ref, manifest)
+    for page_doc in page_docs:
+        set_document(pages_ref.document(page_document_id(page_doc["index"])), page_doc)
+
+    return manifest
+
+
+def read_page(transcript_ref, index):
+    """
+    returns list of utterances on just this page. One read, no matter how long the transcript is
+    """
+    page_doc = transcript_ref.collection(PAGES_COLLECTION).document(page_document_id(index)).get()
+    if not page_doc.exists:
+        return []
+
+    return unpack_page(decompress_page(page_doc.to_dict()["blob"]))
+
+
+def read_transcript(transcript_ref):
+    """
+    returns (manifest, list of all utterances)
+    - handles transcripts from before we started paging them too
+    """
+    manifest = transcript_ref.get().to_dict()
+    if manifest is None:
+        return None, []
+
+    if manifest.get("transcript_format") != TRANSCRIPT_FORMAT:
+        return manifest, manifest.get("utterances", [])
+
+    page_docs = transcript_ref.collection(PAGES_COLLECTION).order_by("index").stream()
+    utterances = []
+    for page_doc in page_docs:
+        utterances.extend(unpack_page(decompress_page(page_doc.to_dict()["blob"])))
+
+    return manifest, utterances
@@ -0,0 +1,69 @@
+"""
+Unit of work for firestore writes
+- a lifecycle step (e.g., a status change, or a full check_transcription_progress cycle) queues up all of its writes, and they get committed together in a single WriteBatch. One RPC instead of one per write
+"""
+from . import metrics
+import logging
+logger = logging.getLogger('testlogger')
+
+# firestore won't take more than this many writes in one batch
+MAX_WRITES_PER_BATCH = 500
+
+
+class UnitOfWork:
+    def __init__(self, client):
+        self.client = client
+        # list of (ref, data, merge). data None means delete
+        self.writes = []
+        # called once everything is committed, e.g., work that needs the writes to be there first
+        self.callbacks = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref, data, merge))
+
+    def delete(self, ref):
+        self.writes.append((ref, None, False))
+
+    def add(self, collection_ref, data):
+        """
+        like CollectionReference.add, but queued. Returns the new document's ref
+        """
+        doc_ref = collection_ref.document()
+        self.set(doc_ref, data)
+        return doc_ref
+
+    def after_commit(self, callback):
+        self.callbacks.append(callback)
+
+    def commit(self):
+        """
+        sends everything that was queued. Returns the number of batches committed (normally 1, or 0 if nothing was queued)
+        """
+        batch_count = 0
+        for start in range(0, len(self.writes), MAX_WRITES_PER_BATCH):
+            batch = self.client.batch()
+            for ref, data, merge in self.writes[start:start + MAX_WRITES_PER_BATCH]:
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data, merge=merge)
+
+            with metrics.external_call("firestore", "commit"):
+                batch.commit()
+            batch_count += 1
+
+        logger.debug(f"committed {len(self.writes)} writes in {batch_count} batch(es)")
+        self.writes = []
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+        return batch_count
+
+    def discard(self):
+        if self.writes:
+            logger.info(f"discarding {len(self.writes)} uncommitted writes")
+
+        self.writes = []
+        self.callbacks = []
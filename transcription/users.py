@@ -0,0 +1,140 @@
+"""
+Looking up users' info (email, custom quotas) from firestore
+- shared by every request in the process, so a user submitting a bunch of files at once doesn't cause the same two reads for every file
+- entries expire after USER_CACHE["TTL_SECONDS"]. If USER_CACHE["WATCH"] is on, we also listen to the user's firestore docs and drop the entry as soon as either one changes
+    * one watch per user, however many requests missed at once. It stops once the entry leaves the cache (expired, pushed out, or invalidated). Expired entries get dropped by a background thread, not just when someone reads them, so nobody keeps listening to users we don't have anymore
+"""
+import time
+from django.conf import settings
+from .helpers import *
+from .cache import TTLCache
+from . import metrics
+logger = logging.getLogger('testlogger')
+
+# user_id => list of firestore watches, so we can stop listening once the user leaves the cache
+_watches = {}
+_watches_lock = threading.Lock()
+_expiring = threading.Event()
+
+
+def _stop_watching(user_id, profile):
+    with _watches_lock:
+        watches = _watches.pop(user_id, [])
+
+    for watch in watches:
+        # might be getting called from the watch's own callback thread, so don't unsubscribe from inside it
+        threading.Thread(target=watch.unsubscribe, daemon=True).start()
+
+
+user_cache = TTLCache(
+    max_size=settings.USER_CACHE["MAX_SIZE"],
+    ttl=settings.USER_CACHE["TTL_SECONDS"],
+    on_evict=_stop_watching,
+)
+metrics.register_stats("user_cache", user_cache.stats)
+
+
+def user_ref(user_id):
+    return db.collection('users').document(user_id)
+
+
+def custom_quotas_ref(email):
+    return db.collection('customQuotas').document(email)
+
+
+def get_user_profile(user_id):
+    """
+    returns dict with user's "email" and "custom_quotas" (empty dict if there are no custom quotas set for this user)
+    - all users should have an email, so there should be no concern about retriving email from this record in firestore
+    """
+    profile = user_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    with metrics.external_call("firestore", "get"):
+        email = user_ref(user_id).get().to_dict()["email"]
+    logger.info(f"checking firestore at customQuotas/{email}")
+    with metrics.external_call("firestore", "get"):
+        custom_quotas_result = custom_quotas_ref(email).get()
+
+    profile = {
+        "email": email,
+        "custom_quotas": custom_quotas_result.to_dict() if custom_quotas_result.exists else {},
+    }
+    user_cache.set(user_id, profile)
+
+    if settings.USER_CACHE["WATCH"]:
+        _watch(user_id, email)
+        _start_expiring()
+
+    return profile
+
+
+def invalidate_user(user_id):
+    """
+    drop what we have for this user, e.g., after changing their quotas
+    """
+    user_cache.invalidate(user_id)
+
+
+def _watch(user_id, email):
+    """
+    listen for changes to the user and customQuotas docs, and drop the cached profile as soon as either changes
+    """
+    with _watches_lock:
+        # e.g., two requests for the same user missed at once. The first one's watch covers both
+        if user_id in _watches:
+            return
+
+        watches = _watches[user_id] = []
+        try:
+            for ref in [user_ref(user_id), custom_quotas_ref(email)]:
+                watches.append(ref.on_snapshot(_invalidate_on_change(user_id)))
+
+        except Exception as error:
+            # not a big deal, the entry will still expire
+            logger.error(f"couldn't watch user {user_id}")
+            logger.error(error)
+
+    # left the cache before we started watching, so nothing called _stop_watching for these
+    if user_id not in user_cache:
+        _stop_watching(user_id, None)
+
+
+def _start_expiring():
+    """
+    one thread per process that drops expired entries, so their watches stop too
+    """
+    with _watches_lock:
+        if _expiring.is_set():
+            return
+        _expiring.set()
+
+    threading.Thread(target=_expire_forever, name="user-cache-expiry", daemon=True).start()
+
+
+def _expire_forever():
+    while True:
+        time.sleep(settings.USER_CACHE["TTL_SECONDS"])
+        try:
+            user_cache.expire()
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+def _invalidate_on_change(user_id):
+    """
+    returns callback for on_snapshot
+    - the first snapshot fires right away with the data we just read, so skip that one
+    """
+    state = {"initial_snapshot": True}
+
+    def on_change(doc_snapshots, changes, read_time):
+        if state["initial_snapshot"]:
+            state["initial_snapshot"] = False
+            return
+
+        logger.info(f"user {user_id} changed, dropping cached profile")
+        invalidate_user(user_id)
+
+    return on_change
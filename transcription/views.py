@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.http import HttpResponseServerError
+from django.http import HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotModified, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 import os
 import json
@@ -10,6 +12,14 @@ from .helpers import TRANSCRIPTION_STATUSES
 
 # from .transcribe import request_long_running_recognize, setup_request
 from .transcribe_class import TranscribeRequest
+from .users import user_ref
+from . import progress_stream
+from . import batch_submission
+from . import jobs
+from . import admission
+from . import metrics
+from . import request_cache
+from . import transcript_storage
 
 from copy import deepcopy
 import logging
@@ -39,6 +49,10 @@ def transcribe(req):
             file_data = json.loads(req.body)
             transcribe_request = TranscribeRequest(file_data)
 
+            if jobs.should_enqueue():
+                # worker does the rest (see jobs.py), client can follow along with check-status or progress
+                return _enqueued_response(transcribe_request, jobs.enqueue_transcribe(file_data))
+
             # mark request as received in firestore 
             transcribe_request.mark_as_received()
 
@@ -46,20 +60,10 @@ def transcribe(req):
             transcribe_request.validate_request()
             logger.debug("transcribe request validated!")
 
-            logger.debug("== setting up request payload to send to Google")
-            transcribe_request.setup_request()
-             
-            logger.debug("== sending request payload to Google")
-            transcribe_request.request_long_running_recognize()
-            # an async func, should not stop returning the response
-
-            # TODO later, optionally convert file
-            # transcribe
+            transcribe_request.send_to_google()
 
             # if get here, either it is now transcribing or we handled the error (though that doesn't mean that we continued to retry)
-            response = HttpResponse(json.dumps({
-                "current_request_data": transcribe_request.__dict__
-            }), content_type='application/json')
+            response = _transcribe_response(transcribe_request)
             
             logger.info(response)
 
@@ -93,69 +97,22 @@ def resume_request(req):
         transcribe_request = TranscribeRequest(file_data)
 
         # check to see current status
-        transcribe_request.refresh_from_db()
+        # only trust the cache if it's done. Errors get resumed, so for those we want what firestore says right now
+        request_cache.refresh(transcribe_request, statuses=request_cache.FINISHED_STATUSES)
         status = transcribe_request.status
         logger.info(f"Status is now {status}")
 
+        if transcribe_request.transaction_complete():
+            # nothing to resume, so no need to validate either (the file's probably deleted by now anyway)
+            return _resume_response(ALREADY_DONE_MESSAGE)
+
         # check the request using our internal criteria before even sending to Google
         transcribe_request.validate_request()
         logger.debug("transcribe request validated!")
 
-        if transcribe_request.last_request_has_stopped() == False:
-            logger.info("making them wait a little bit longer")
-            message = "Please wait a little longer before requesting, it's only been {} so far".format(transcribe_request.elapsed_since_last_event())
-
-        elif status == TRANSCRIPTION_STATUSES[0]: # uploading
-            # whoops...shouldn't be here!
-            # check if there is a file and storage, then restart if there is
-            # if there isn't, tell client to prompt reupload
-            # TODO use better python exception
-            transcribe_request.mark_as_server_error(Exception("404 No such object"))
-            
-            message = "they should try uploading again"
-
-        elif status == TRANSCRIPTION_STATUSES[1]: # uploaded
-            # should not allow client to request a resume if only uploaded, unless updated_at was long enough ago. But eventually will check server side as well
-            # check updated_at, then restart if too long ago
-            # TODO 
-
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-        elif status == TRANSCRIPTION_STATUSES[2]: # processing-file (aka server has received)
-            # check updated_at, then restart if too long ago
-            # note that this stage often takes a while, since sometimes it means converting large files from one format to flac
-            # TODO 
-
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-
-        elif status == TRANSCRIPTION_STATUSES[3]: # transcribing
-            # check with google via operation
-            # use transaction_id
-
-            # if status says our server is currently processing, then wait a couple seconds, check db again, and if still processing, then assume it errored out somewhere
-            # TODO 
-            message = "Not yet handling "
-
-        elif status == TRANSCRIPTION_STATUSES[4]: # "processing-transcription" (means that transcription is complete)
-            # TODO 
-            message = "Not yet handling "
-
-        elif status == TRANSCRIPTION_STATUSES[5]: # "transcription-processed"
-            # do nothing...tell client it's all done. 
-            message = "Not yet handling "
+        message = _resume(transcribe_request)
 
-        elif status == TRANSCRIPTION_STATUSES[6]: # server-error
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-        elif status == TRANSCRIPTION_STATUSES[7]: # transcribing-error
-            # try transcribing again, unless error requires changing the file or options first
-            # TODO setup to handle different errors from Google. For now, just handling as any other error
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-        return HttpResponse(json.dumps({
-            "message": message
-        }), content_type='application/json')
+        return _resume_response(message)
 
     except Exception as error:
         logger.error("error resuming request")
@@ -170,9 +127,8 @@ def check_status(req):
     - Client will poll this endpoint periodically to check on how things are
     - Does stuff like resume_request but only checks, doesn't actually transcribe
     - If everything runs smoothly, will keep asking until Google is done transcribing and then will get the transcription
-
-    TODO 
-    - Maybe move to background worker, and just poll whether or not client asks
+    - The worker (transcription/poller.py) is what asks Google for progress, so this is just a read from firestore. Only if the poller is turned off do we ask Google from here
+    - if nothing changed since the client last asked, sends back a 304 (if it sent the ETag we gave it, in If-None-Match) or a tiny "unchanged" body (if it sent the version we gave it)
     """
     # get operation from Google
     # https://cloud.google.com/resource-manager/reference/rest/v1/operations/get
@@ -181,30 +137,99 @@ def check_status(req):
 
     try:
         file_data = json.loads(req.body)
+        # what the client saw last time. Not from our doc, so don't let it stand in for ours
+        seen_version = file_data.pop("version", None)
         transcribe_request = TranscribeRequest(file_data)
 
-        # check to see current status
-        # TODO maybe only check Google depending on current status?
-        transcribe_request.refresh_from_db()
-        transcribe_request.check_transcription_progress() 
+        # check to see current status. Done or errored ones might not even need firestore
+        request_cache.refresh(transcribe_request)
 
-        return HttpResponse(json.dumps({
-            "message": "finished checking status",
-            "progress_percent": transcribe_request.transcript_metadata["progress_percent"],
-            "current_request_data": transcribe_request.__dict__
+        if transcribe_request.should_check_with_google():
+            transcribe_request.check_transcription_progress() 
 
-        }), content_type='application/json')
+        return _conditional_status_response(req, transcribe_request, seen_version)
 
 
     except Exception as error:
-        logger.error("error resuming request")
+        logger.error("error checking status")
         error_response = _log_error(error, transcribe_request)
         return error_response
 
+
+@csrf_exempt
+def transcribe_batch(req):
+    """
+    Like transcribe, but for a list of files at once (see batch_submission.py)
+    - body is {"files": [<same payload transcribe takes>, ...]}
+    - returns {"results": [...]}, one per file in the same order, each with "ok", "error", and "current_request_data" (if we got far enough to have a request). With the job queue on, also "job_id"
+    - files that fail don't stop the rest
+    """
+    try:
+        if req.method != "POST":
+            return HttpResponse("<html><body>Needs to be a post....</body></html>")
+
+        file_datas = json.loads(req.body)["files"]
+        results = batch_submission.submit_batch(file_datas)
+
+        return _batch_response(results)
+
+    except Exception as error:
+        # only for the batch as a whole (e.g., bad json). Errors for each file go in its result
+        logger.error(traceback.format_exc())
+        return HttpResponseBadRequest(str(error))
+
+
+def progress(req):
+    """
+    Server-sent events with the request's status and progress, so the client doesn't have to keep polling check-status
+    - GET progress/?id=<request id>&user_id=<user id>, e.g., with EventSource in the browser
+    - one watcher per request on this server, no matter how many tabs are watching (see progress_stream.py)
+    - on reconnect, EventSource sends Last-Event-ID, so we only send what they missed. Can also send it as last_event_id param
+    - NOTE with gunicorn's sync workers, each open stream takes up a worker the whole time. Use gthread workers or ASGI (config/asgi.py) if using this
+    """
+    params = _progress_params(req)
+    if params is None:
+        return HttpResponseBadRequest("needs id and user_id")
+
+    return _progress_response(progress_stream.stream(*params))
+
+def transcript(req):
+    """
+    the finished transcript, in the shape the transcript doc had before it got split into pages: the request's metadata plus all the utterances
+    - GET transcript/?id=<request id>&user_id=<user id>
+    - for clients that read utterances straight off the transcript doc, when the transcript is too big to keep them there too (see transcript_storage.py)
+    """
+    params = _progress_params(req)
+    if params is None:
+        return HttpResponseBadRequest("needs id and user_id")
+
+    document = _legacy_transcript(*params[:2])
+    if document is None:
+        return HttpResponseNotFound("no transcript for this request")
+
+    return HttpResponse(json.dumps(document), content_type='application/json')
+
+def prometheus_metrics(req):
+    """
+    timings and counts for this process, in Prometheus' text format (see metrics.py)
+    """
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def admission_stats(req):
+    """
+    how many requests are waiting to go to Google, and how long they've waited (see admission.py), for this process
+    """
+    return HttpResponse(json.dumps(admission.stats()), content_type='application/json')
+
 ##########################################
 # Controller Helpers
 #######################
 def _log_error(error, transcribe_request):
+    if isinstance(error, admission.AdmissionTimeout):
+        # we're sending Google all our quota allows right now. Nothing went wrong with the request, so leave its status alone and have them try again
+        logger.info(f"too busy to send to Google: {error}")
+        return _busy_response(transcribe_request)
+
     logger.error(traceback.format_exc())
     # TODO move this error handling to more granular handling so can handle better. Don't do it here.
     if transcribe_request:
@@ -218,6 +243,192 @@ def _log_error(error, transcribe_request):
 
     return HttpResponseServerError("Server errored out during transcription request")
 
+def _busy_response(transcribe_request):
+    response = HttpResponse(json.dumps({
+        "error": "Too many requests to Google right now, try again in a little bit",
+        "current_request_data": transcribe_request.response_data() if transcribe_request else None,
+    }), content_type='application/json', status=503)
+    response["Retry-After"] = str(int(settings.ADMISSION["WEB_MAX_WAIT_SECONDS"]) or 1)
+    return response
+
+def _transcribe_response(transcribe_request):
+    return HttpResponse(json.dumps({
+        "current_request_data": transcribe_request.response_data()
+    }), content_type='application/json')
+
+
+def _enqueued_response(transcribe_request, job_id):
+    return HttpResponse(json.dumps({
+        "job_id": job_id,
+        "current_request_data": transcribe_request.response_data()
+    }), content_type='application/json')
+
+
+def _resume(transcribe_request):
+    """
+    decides what to do to get a stopped request going again, depending on its status
+    - returns message for the client
+    """
+    status = transcribe_request.status
+
+    if transcribe_request.last_request_has_stopped() == False:
+        logger.info("making them wait a little bit longer")
+        message = "Please wait a little longer before requesting, it's only been {:.0f} seconds so far".format(transcribe_request.elapsed_since_last_event())
+
+    elif status == TRANSCRIPTION_STATUSES[0]: # uploading
+        # whoops...shouldn't be here!
+        # check if there is a file and storage, then restart if there is
+        # if there isn't, tell client to prompt reupload
+        # TODO use better python exception
+        transcribe_request.mark_as_server_error(Exception("404 No such object"))
+        
+        message = "they should try uploading again"
+
+    elif status == TRANSCRIPTION_STATUSES[1]: # uploaded
+        # should not allow client to request a resume if only uploaded, unless updated_at was long enough ago. But eventually will check server side as well
+        # check updated_at, then restart if too long ago
+        # TODO 
+
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+    elif status == TRANSCRIPTION_STATUSES[2]: # processing-file (aka server has received)
+        # check updated_at, then restart if too long ago
+        # note that this stage often takes a while, since sometimes it means converting large files from one format to flac
+        # TODO 
+
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+
+    elif status == TRANSCRIPTION_STATUSES[3]: # transcribing
+        # check with google via operation
+        # use transaction_id
+
+        # if status says our server is currently processing, then wait a couple seconds, check db again, and if still processing, then assume it errored out somewhere
+        # TODO 
+        message = "Not yet handling "
+
+    elif status == TRANSCRIPTION_STATUSES[4]: # "processing-transcription" (means that transcription is complete)
+        # TODO 
+        message = "Not yet handling "
+
+    elif status == TRANSCRIPTION_STATUSES[5]: # "transcription-processed"
+        # do nothing...tell client it's all done. 
+        message = ALREADY_DONE_MESSAGE
+
+    elif status == TRANSCRIPTION_STATUSES[6]: # server-error
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+    elif status == TRANSCRIPTION_STATUSES[7]: # transcribing-error
+        # try transcribing again, unless error requires changing the file or options first
+        # TODO setup to handle different errors from Google. For now, just handling as any other error
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+    return message
+
+
+ALREADY_DONE_MESSAGE = "Already done transcribing, nothing to resume"
+
+def _resume_response(message):
+    return HttpResponse(json.dumps({
+        "message": message
+    }), content_type='application/json')
+
+
+def _batch_response(results):
+    return HttpResponse(json.dumps({
+        "results": results,
+    }), content_type='application/json')
+
+
+def _progress_params(req):
+    """
+    returns (user_id, request_id, last_event_id), or None if missing any of the ones we need
+    """
+    request_id = req.GET.get("id")
+    user_id = req.GET.get("user_id")
+    if not request_id or not user_id:
+        return None
+
+    last_event_id = req.headers.get("Last-Event-ID") or req.GET.get("last_event_id")
+    return user_id, request_id, last_event_id
+
+
+def _legacy_transcript(user_id, request_id):
+    """
+    returns the transcript doc in its old shape (see transcript_storage.legacy_document), or None if the request isn't done or has no transcript
+    """
+    # has the transaction_id and filename, which the transcript doc is named after
+    with metrics.external_call("firestore", "get"):
+        doc = user_ref(user_id).collection("transcribeRequests").document(request_id).get()
+    if not doc.exists:
+        return None
+
+    transcribe_request = TranscribeRequest.from_document(doc)
+    if transcribe_request.status != TRANSCRIPTION_STATUSES[5]: # transcription-processed
+        return None
+
+    manifest, utterances = transcript_storage.read_transcript(transcribe_request.transcript_document_ref())
+    if manifest is None:
+        return None
+
+    return transcript_storage.legacy_document(manifest, utterances)
+
+
+def _progress_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # otherwise nginx and the like hold on to events until they have a full buffer
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _status_response(transcribe_request):
+    return HttpResponse(json.dumps({
+        "message": "finished checking status",
+        "progress_percent": transcribe_request.transcript_metadata.get("progress_percent", 0),
+        "current_request_data": transcribe_request.response_data()
+
+    }), content_type='application/json')
+
+
+def _etag(transcribe_request):
+    # weak, since the same version can be serialized a little differently (e.g., key order)
+    if transcribe_request.version is None:
+        # from before we kept versions
+        return None
+
+    return f'W/"{transcribe_request.id}-{transcribe_request.version}"'
+
+
+def _if_none_match(req):
+    return [etag.strip() for etag in req.headers.get("If-None-Match", "").split(",") if etag.strip()]
+
+
+def _conditional_status_response(req, transcribe_request, seen_version=None):
+    """
+    _status_response, unless the client already has this version
+    """
+    etag = _etag(transcribe_request)
+    if etag is None:
+        return _status_response(transcribe_request)
+
+    if etag in _if_none_match(req) or "*" in _if_none_match(req):
+        response = HttpResponseNotModified()
+
+    elif seen_version is not None and seen_version == transcribe_request.version:
+        # for clients that can't do anything with a 304 from a POST
+        response = HttpResponse(json.dumps({
+            "unchanged": True,
+            "version": transcribe_request.version,
+        }), content_type='application/json')
+
+    else:
+        response = _status_response(transcribe_request)
+
+    response["ETag"] = etag
+    return response
+
+
 def _resume_transcribing_or_processing(transcribe_request):
     # go through and make sure to mark as received if not already
     if transcribe_request.server_has_received() == False:
@@ -228,8 +439,7 @@ def _resume_transcribing_or_processing(transcribe_request):
     if transcribe_request.transaction_id == None: 
         # setup the request again
         logger.info("now setting up ")
-        transcribe_request.setup_request()
-        transcribe_request.request_long_running_recognize()
+        transcribe_request.send_to_google()
 
         message = "Starting to ask Google for transcription again"
 